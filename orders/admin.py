@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.contrib import admin
-from .models import Order, OrderItem, OrderDiscount, Return, Refund, Shipping
+from django.utils import timezone
+from .models import LedgerEntry, Order, OutboxEvent, OrderItem, OrderDiscount, Return, Refund, Shipping
 
 
 class OrderItemInline(admin.TabularInline):
@@ -16,6 +18,17 @@ class OrderItemInline(admin.TabularInline):
     subtotal.short_description = 'Subtotal'
 
 
+class LedgerEntryInline(admin.TabularInline):
+    model = LedgerEntry
+    extra = 0
+    fields = ('kind', 'amount', 'refund', 'note', 'created_by', 'created_at')
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class OrderDiscountInline(admin.TabularInline):
     model = OrderDiscount
     extra = 0
@@ -34,7 +47,7 @@ class ShippingAdmin(admin.ModelAdmin):
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ('order_number', 'user', 'total_amount', 'status', 'created_at', 'paid_at')
+    list_display = ('order_number', 'user', 'item_count', 'total_amount', 'status', 'created_at', 'paid_at')
     list_filter = ('status', 'created_at', 'paid_at')
     search_fields = (
         'order_number',
@@ -46,18 +59,19 @@ class OrderAdmin(admin.ModelAdmin):
         'shipping_address__street_address'
     )
     readonly_fields = (
-        'id', 'order_number', 'user', 'total_amount',
-        'discount_amount', 'refunded_amount', 'created_at', 'updated_at', 'paid_at'
+        'id', 'order_number', 'user', 'item_count', 'units_count', 'subtotal', 'total_amount',
+        'discount_amount', 'refunded_amount', 'created_at', 'updated_at', 'paid_at',
+        'receipt_file', 'receipt_refunded_amount'
     )
     ordering = ('-created_at',)
-    inlines = [OrderItemInline, OrderDiscountInline]
+    inlines = [OrderItemInline, OrderDiscountInline, LedgerEntryInline]
     
     fieldsets = (
         ('Order Info', {
             'fields': ('id', 'order_number', 'user', 'status')
         }),
         ('Amounts', {
-            'fields': ('total_amount', 'shipping_fee', 'discount_amount', 'tax_amount', 'refunded_amount')
+            'fields': ('item_count', 'units_count', 'subtotal', 'total_amount', 'shipping_fee', 'discount_amount', 'refunded_amount')
         }),
         ('Shipping', {
             'fields': ('shipping_address', 'tracking_number', 'customer_notes')
@@ -65,6 +79,9 @@ class OrderAdmin(admin.ModelAdmin):
         ('Timestamps', {
             'fields': ('created_at', 'updated_at', 'paid_at', 'shipped_at', 'delivered_at')
         }),
+        ('Receipt', {
+            'fields': ('receipt_file', 'receipt_refunded_amount')
+        }),
     )
 
 
@@ -126,4 +143,67 @@ class RefundAdmin(admin.ModelAdmin):
         ('Timestamps', {
             'fields': ('created_at', 'completed_at')
         }),
-    )
\ No newline at end of file
+    )
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('order', 'kind', 'amount', 'refund', 'created_by', 'created_at')
+    list_filter = ('kind', 'created_at')
+    search_fields = ('order__order_number', 'refund__refund_number', 'note')
+    readonly_fields = ('id', 'order', 'refund', 'kind', 'amount', 'note', 'created_by', 'created_at')
+    ordering = ('-created_at',)
+
+    # Append-only: corrections are new entries posted with LedgerEntry.post
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class DeliveryFilter(admin.SimpleListFilter):
+    title = 'delivery'
+    parameter_name = 'delivery'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('pending', 'Pending'),
+            ('exhausted', 'Out of attempts'),
+            ('processed', 'Processed'),
+        )
+
+    def queryset(self, request, queryset):
+        max_attempts = settings.OUTBOX_MAX_ATTEMPTS
+        if self.value() == 'pending':
+            return queryset.filter(processed_at__isnull=True, attempts__lt=max_attempts)
+        if self.value() == 'exhausted':
+            return queryset.filter(processed_at__isnull=True, attempts__gte=max_attempts)
+        if self.value() == 'processed':
+            return queryset.filter(processed_at__isnull=False)
+        return queryset
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('topic', 'object_id', 'attempts', 'created_at', 'available_at', 'processed_at')
+    # Events out of attempts are never claimed again: find them under "Out of attempts" and retry them
+    list_filter = (DeliveryFilter, 'topic')
+    search_fields = ('topic', 'object_id', 'last_error')
+    readonly_fields = (
+        'id', 'topic', 'object_type', 'object_id', 'payload', 'attempts',
+        'last_error', 'created_at', 'available_at', 'processed_at'
+    )
+    ordering = ('-created_at',)
+    actions = ['retry_now']
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry_now(self, request, queryset):
+        updated = queryset.filter(processed_at__isnull=True).update(attempts=0, available_at=timezone.now())
+        self.message_user(request, f"{updated} events queued for the next drain_outbox run")
+    retry_now.short_description = "Retry now"
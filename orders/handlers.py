@@ -0,0 +1,20 @@
+"""
+Outbox handlers (see orders.outbox), imported by OrdersConfig.ready().
+Handlers may see an event more than once and must be idempotent.
+"""
+from . import outbox
+from .models import Refund
+from .receipts import generate_receipt
+
+
+@outbox.register('order.paid', 'order.refunds_reconciled', 'order.receipt_missing')
+def render_receipt(event):
+    generate_receipt(event.object_id)
+
+
+@outbox.register('refund.completed')
+def rerender_receipt(event):
+    # Only re-rendered when the refunded amount differs from the stored receipt
+    order_id = Refund.objects.filter(pk=event.object_id).values_list('order_id', flat=True).first()
+    if order_id:
+        generate_receipt(order_id)
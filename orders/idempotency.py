@@ -0,0 +1,87 @@
+"""
+Idempotency-Key support for create endpoints. A client that retries a POST
+with the same key gets the stored response back instead of a second order,
+return or refund.
+"""
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+def request_fingerprint(data):
+    """Hash of the request body, so a key can't be reused for a different request"""
+    body = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+class IdempotentCreateMixin:
+    """
+    Makes ModelViewSet.create honor the Idempotency-Key header.
+
+    The key row is inserted and locked in the same transaction that creates
+    the object, so a concurrent duplicate blocks on it and then replays the
+    stored response. Requests that fail with an exception roll the key back
+    and can be retried.
+    """
+
+    def get_idempotency_scope(self):
+        return f"{self.basename}.create"
+
+    def create(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER, '').strip()
+        if not key:
+            return super().create(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        fingerprint = request_fingerprint(request.data)
+        expires_at = timezone.now() + timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS)
+
+        with transaction.atomic():
+            record, created = IdempotencyKey.objects.get_or_create(
+                user=request.user,
+                scope=self.get_idempotency_scope(),
+                key=key,
+                defaults={'request_hash': fingerprint, 'expires_at': expires_at},
+            )
+            if not created:
+                # Waits here while another request with this key is still running
+                record = IdempotencyKey.objects.select_for_update().get(pk=record.pk)
+                if record.is_expired:
+                    record.request_hash = fingerprint
+                    record.response_status = None
+                    record.response_body = None
+                    record.expires_at = expires_at
+                elif record.request_hash != fingerprint:
+                    return Response(
+                        {'error': f'This {HEADER} was already used with a different request.'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    )
+                elif record.response_status is not None:
+                    return Response(
+                        record.response_body,
+                        status=record.response_status,
+                        headers={'Idempotent-Replayed': 'true'},
+                    )
+
+            response = super().create(request, *args, **kwargs)
+            if response.status_code < 500:
+                record.response_status = response.status_code
+                record.response_body = response.data
+                record.save()
+
+        return response
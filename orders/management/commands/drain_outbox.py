@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from orders import outbox
+
+
+class Command(BaseCommand):
+    help = "Deliver pending order lifecycle events to their handlers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE, help="Events claimed per transaction")
+        parser.add_argument('--forever', action='store_true', help="Keep polling instead of exiting once the outbox is empty")
+        parser.add_argument('--interval', type=float, default=5, help="Seconds to wait between polls of an empty outbox")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        delivered = 0
+        while True:
+            taken = outbox.drain(batch_size)
+            delivered += taken
+            if taken < batch_size:
+                if not options['forever']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Handled {delivered} outbox events"))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+
+from orders.models import Order
+from orders.receipts import generate_receipt
+
+
+class Command(BaseCommand):
+    help = "Render receipts of paid orders that have none or whose refunds changed since"
+
+    def handle(self, *args, **options):
+        order_ids = list(
+            Order.objects.filter(paid_at__isnull=False)
+            .filter(
+                Q(receipt_file='')
+                | Q(receipt_refunded_amount__isnull=True)
+                | ~Q(receipt_refunded_amount=F('refunded_amount'))
+            )
+            .values_list('pk', flat=True)
+        )
+        rendered = sum(generate_receipt(order_id) for order_id in order_ids)
+        self.stdout.write(self.style.SUCCESS(f"Rendered {rendered} receipts"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Order
+from orders.summary import summary_columns
+
+
+class Command(BaseCommand):
+    help = "Recompute item_count, units_count and subtotal of orders from their items"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Orders updated per UPDATE statement")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        order_ids = list(Order.objects.order_by('pk').values_list('pk', flat=True))
+
+        for start in range(0, len(order_ids), batch_size):
+            Order.objects.filter(pk__in=order_ids[start:start + batch_size]).update(**summary_columns())
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt summaries of {len(order_ids)} orders"))
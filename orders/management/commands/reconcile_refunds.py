@@ -0,0 +1,71 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import DecimalField, Sum, Value
+from django.db.models.functions import Coalesce
+
+from orders.models import LedgerEntry, Order, Refund
+from orders.outbox import record_event
+
+
+class Command(BaseCommand):
+    help = "Check every order's refunded_amount against the sum of its ledger entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Orders checked per query")
+        parser.add_argument('--fix', action='store_true', help="Reset mismatched balances to the ledger total")
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help="First post ledger entries for completed refunds that predate the ledger",
+        )
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            self.backfill()
+
+        ledger_total = Coalesce(
+            Sum('ledger_entries__amount'),
+            Value(Decimal('0.00')),
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        )
+        mismatches = []
+        checked = 0
+        last_pk = None
+        while True:
+            orders = Order.objects.order_by('pk')
+            if last_pk is not None:
+                orders = orders.filter(pk__gt=last_pk)
+            batch = list(
+                orders.annotate(ledger_total=ledger_total)
+                .values_list('pk', 'order_number', 'refunded_amount', 'ledger_total')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            checked += len(batch)
+            last_pk = batch[-1][0]
+            mismatches += [row for row in batch if row[2] != row[3]]
+
+        for pk, order_number, refunded_amount, total in mismatches:
+            self.stderr.write(f"{order_number}: refunded_amount {refunded_amount}, ledger {total}")
+            if options['fix']:
+                # The event re-renders the receipt, which still shows the old amount
+                with transaction.atomic():
+                    Order.objects.filter(pk=pk).update(refunded_amount=total)
+                    order = Order.objects.only('status').get(pk=pk)
+                    record_event(order, 'refunds_reconciled', refunded_amount=str(total))
+
+        if mismatches and not options['fix']:
+            raise CommandError(f"{len(mismatches)} of {checked} orders don't match their ledger")
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {checked} orders, {len(mismatches)} {'fixed' if options['fix'] else 'mismatched'}"
+        ))
+
+    def backfill(self):
+        # Entries are written directly: the balances already include these refunds
+        refunds = Refund.objects.filter(status='COMPLETED', ledger_entry__isnull=True)
+        entries = LedgerEntry.objects.bulk_create(
+            LedgerEntry(order_id=refund.order_id, refund=refund, kind=LedgerEntry.REFUND, amount=refund.amount)
+            for refund in refunds
+        )
+        self.stdout.write(f"Posted {len(entries)} ledger entries for earlier refunds")
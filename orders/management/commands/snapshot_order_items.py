@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import OrderItem
+
+
+class Command(BaseCommand):
+    help = "Fill the product snapshot of order items created before snapshots existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Order items written per UPDATE")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        fields = ['product_slug', 'product_thumbnail', 'product_category', 'product_attributes']
+        # Keep the name the customer saw at purchase time
+        items = OrderItem.objects.filter(product_slug='').select_related('product__category').order_by('pk')
+
+        updated = 0
+        batch = []
+        for item in items.iterator(chunk_size=batch_size):
+            snapshot = OrderItem.product_snapshot(item.product)
+            for field in fields:
+                setattr(item, field, snapshot[field])
+            batch.append(item)
+            if len(batch) == batch_size:
+                updated += OrderItem.objects.bulk_update(batch, fields)
+                batch = []
+        if batch:
+            updated += OrderItem.objects.bulk_update(batch, fields)
+
+        self.stdout.write(self.style.SUCCESS(f"Snapshotted {updated} order items"))
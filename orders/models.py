@@ -1,9 +1,15 @@
 import uuid
 from decimal import Decimal
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 
+from utils.storage import receipt_storage
+
+from .transitions import apply_transition
+
 
 class Shipping(models.Model):
     """Shipping address information for orders"""
@@ -46,7 +52,16 @@ class Order(models.Model):
     shipping_fee = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     discount_amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
     refunded_amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'))
+
+    # Summary of the items still kept, see orders.summary
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    units_count = models.PositiveIntegerField(default=0, editable=False)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), editable=False)
     
+    # Rendered by orders.receipts once the order is paid, re-rendered when refunds change it
+    receipt_file = models.FileField(upload_to='receipts/', storage=receipt_storage, blank=True, editable=False)
+    receipt_refunded_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, editable=False)
+
     tracking_number = models.CharField(max_length=100, blank=True, null=True)
     customer_notes = models.TextField(blank=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
@@ -93,6 +108,12 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey('products.Product', on_delete=models.PROTECT, related_name='order_items')
     product_name = models.CharField(max_length=200)
+    # Snapshot of the product at purchase time, order history never reads the live catalog
+    product_slug = models.CharField(max_length=200, blank=True)
+    product_thumbnail = models.CharField(max_length=500, blank=True)
+    product_category = models.CharField(max_length=100, blank=True)
+    product_attributes = models.JSONField(default=dict, blank=True)
+    variant = models.CharField(max_length=100, blank=True, default='')
     quantity = models.PositiveIntegerField(default=1)
     price_at_purchase = models.DecimalField(max_digits=10, decimal_places=2)
     quantity_returned = models.PositiveIntegerField(default=0)
@@ -103,6 +124,24 @@ class OrderItem(models.Model):
     class Meta:
         ordering = ['created_at']
 
+    @staticmethod
+    def product_snapshot(product):
+        """Item fields copied from a product with its category loaded"""
+        dimensions = {
+            name: str(getattr(product, name))
+            for name in ('length', 'width', 'height')
+            if getattr(product, name) is not None
+        }
+        if dimensions:
+            dimensions['measurement_unit'] = product.measurement_unit
+        return {
+            'product_name': product.name,
+            'product_slug': product.slug or '',
+            'product_thumbnail': product.thumbnail_url,
+            'product_category': product.category.name,
+            'product_attributes': {'currency': product.currency, **dimensions},
+        }
+
     @property
     def subtotal(self):
         """Calculate subtotal for this item"""
@@ -180,17 +219,16 @@ class Return(models.Model):
         return self.status not in ['COMPLETED', 'CANCELLED', 'REJECTED']
 
     def approve(self, amount=None):
-        """Approve the return request"""
-        self.status = 'APPROVED'
-        self.approved_at = timezone.now()
-        self.approved_refund_amount = amount or self.requested_refund_amount
-        self.save()
+        """Approve the return request, raises TransitionConflict if it is no longer REQUESTED"""
+        apply_transition(
+            self, ['REQUESTED'], 'APPROVED',
+            approved_at=timezone.now(),
+            approved_refund_amount=amount or self.requested_refund_amount,
+        )
 
     def reject(self, reason):
-        """Reject the return request with a reason"""
-        self.status = 'REJECTED'
-        self.rejection_reason = reason
-        self.save()
+        """Reject the return request with a reason, raises TransitionConflict if it is no longer REQUESTED"""
+        apply_transition(self, ['REQUESTED'], 'REJECTED', rejection_reason=reason)
 
     def __str__(self):
         return f"{self.return_number} - {self.order.order_number}"
@@ -231,18 +269,142 @@ class Refund(models.Model):
 
     def mark_completed(self, transaction_id=None):
         """Mark refund as completed and update order"""
-        self.status = 'COMPLETED'
-        self.completed_at = timezone.now()
+        from products.inventory import order_status_changed
+
+        changes = {'completed_at': timezone.now()}
         if transaction_id:
-            self.transaction_id = transaction_id
-        self.save()
-        
-        # Update order refunded amount
-        self.order.refunded_amount += self.amount
-        # Change order status to REFUNDED if fully refunded
-        if self.order.refunded_amount >= self.order.total_amount:
-            self.order.status = 'REFUNDED'
-        self.order.save()
+            changes['transaction_id'] = transaction_id
+
+        with transaction.atomic():
+            apply_transition(self, ['PENDING'], 'COMPLETED', **changes)
+            LedgerEntry.post(self.order, self.amount, kind=LedgerEntry.REFUND, refund=self)
+
+            # The balance update above locked the order row, so this read is current
+            order = self.order
+            order.refresh_from_db(fields=['refunded_amount', 'total_amount', 'status'])
+            if order.refunded_amount >= order.total_amount and order.status != 'REFUNDED':
+                previous_status = order.status
+                apply_transition(order, [previous_status], 'REFUNDED')
+                # A fully refunded order that never shipped gives its units back
+                order_status_changed(order, previous_status)
+
+    def __str__(self):
+        return f"{self.refund_number} - {self.amount}"
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only record of money given back on an order. Order.refunded_amount
+    is the running sum of its entries, see reconcile_refunds.
+    """
+    REFUND = 'REFUND'
+    ADJUSTMENT = 'ADJUSTMENT'
+    KIND_CHOICES = [
+        (REFUND, 'Refund'),
+        (ADJUSTMENT, 'Adjustment'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='ledger_entries')
+    refund = models.OneToOneField(
+        Refund, on_delete=models.RESTRICT, null=True, blank=True, related_name='ledger_entry'
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Positive gives money back, negative adjustments correct earlier entries
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    note = models.CharField(max_length=255, blank=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at']
+        verbose_name_plural = "Ledger Entries"
+        indexes = [
+            models.Index(fields=['order', 'created_at']),
+        ]
+
+    @classmethod
+    def post(cls, order, amount, kind=ADJUSTMENT, refund=None, note='', created_by=None):
+        """Append an entry and move the order's balance by it in the same transaction"""
+        with transaction.atomic():
+            entry = cls.objects.create(
+                order=order, amount=amount, kind=kind, refund=refund, note=note, created_by=created_by
+            )
+            Order.objects.filter(pk=order.pk).update(
+                refunded_amount=F('refunded_amount') + amount,
+                updated_at=timezone.now(),
+            )
+        return entry
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Ledger entries can't be changed, post a correcting entry instead.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger entries can't be deleted, post a correcting entry instead.")
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.amount} on {self.order.order_number}"
+
+
+class IdempotencyKey(models.Model):
+    """Stored response of a create request, replayed when a client retries with the same Idempotency-Key"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='idempotency_keys')
+    scope = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'scope', 'key'], name='unique_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    @property
+    def is_expired(self):
+        return self.expires_at <= timezone.now()
+
+    def __str__(self):
+        return f"{self.scope}:{self.key}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Lifecycle event written in the same transaction as the change it
+    describes, delivered to handlers later by drain_outbox (see orders.outbox)
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    topic = models.CharField(max_length=100)
+    object_type = models.CharField(max_length=50)
+    object_id = models.UUIDField()
+    payload = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(
+                fields=['available_at'],
+                condition=models.Q(processed_at__isnull=True),
+                name='outbox_pending_idx',
+            ),
+            models.Index(fields=['object_type', 'object_id']),
+        ]
 
     def __str__(self):
-        return f"{self.refund_number} - {self.amount}"
\ No newline at end of file
+        return f"{self.topic} {self.object_id}"
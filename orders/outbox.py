@@ -0,0 +1,116 @@
+"""
+Transactional outbox for order, return and refund lifecycle events.
+
+record_event() writes an OutboxEvent in the caller's transaction, so an
+event exists exactly when its change was committed. The drain_outbox
+command later hands each event to the handlers registered for its topic.
+Delivery is at least once: a handler can see an event again after a
+crash or after another handler of the same topic failed, so handlers
+must be idempotent.
+
+    @outbox.register('order.paid')
+    def send_receipt(event):
+        ...
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+_handlers = defaultdict(list)
+
+
+def register(*topics):
+    """Decorator subscribing a handler to one or more topics"""
+    def decorator(handler):
+        for topic in topics:
+            if handler not in _handlers[topic]:
+                _handlers[topic].append(handler)
+        return handler
+    return decorator
+
+
+def handlers_for(topic):
+    return list(_handlers.get(topic, ()))
+
+
+def record_event(instance, event, **payload):
+    """Write `<model>.<event>` for `instance`, e.g. order.cancelled. Call inside the change's transaction."""
+    object_type = instance._meta.model_name
+    return OutboxEvent.objects.create(
+        topic=f"{object_type}.{event}",
+        object_type=object_type,
+        object_id=instance.pk,
+        payload={'status': getattr(instance, 'status', None), **payload},
+    )
+
+
+def retry_delay(attempts):
+    delay = settings.OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.OUTBOX_MAX_RETRY_SECONDS))
+
+
+def dispatch(event):
+    for handler in handlers_for(event.topic):
+        # A failing handler's writes are undone, the event is retried as a whole
+        with transaction.atomic():
+            handler(event)
+
+
+def claim(batch_size):
+    """
+    Take up to `batch_size` due events. Rows are picked with SKIP LOCKED and
+    leased for OUTBOX_LEASE_SECONDS in one short transaction, so several
+    workers can drain side by side and no lock is held while handlers run.
+    An event whose worker died becomes due again when its lease runs out.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True, available_at__lte=now, attempts__lt=settings.OUTBOX_MAX_ATTEMPTS)
+            .order_by('available_at')[:batch_size]
+        )
+        OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+            available_at=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+        )
+    return events
+
+
+def deliver(event):
+    """Run the event's handlers and record the outcome on its own row"""
+    try:
+        dispatch(event)
+    except Exception as e:
+        event.attempts += 1
+        event.last_error = str(e)
+        event.available_at = timezone.now() + retry_delay(event.attempts)
+        if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            # claim() skips it from now on, it waits for "Retry now" in the admin
+            logger.error(f"Outbox event {event.id} ({event.topic}) gave up after {event.attempts} attempts: {str(e)}")
+        else:
+            logger.warning(f"Outbox event {event.id} ({event.topic}) failed, attempt {event.attempts}: {str(e)}")
+    else:
+        event.processed_at = timezone.now()
+        event.last_error = ''
+    OutboxEvent.objects.filter(pk=event.pk).update(
+        attempts=event.attempts,
+        last_error=event.last_error,
+        available_at=event.available_at,
+        processed_at=event.processed_at,
+    )
+
+
+def drain(batch_size=None):
+    """Deliver one batch of due events, returns how many were taken"""
+    events = claim(batch_size or settings.OUTBOX_BATCH_SIZE)
+    for event in events:
+        deliver(event)
+    return len(events)
@@ -0,0 +1,110 @@
+"""
+PDF receipts for paid orders. Rendered off the request path by outbox
+handlers (orders.handlers) when an order is paid, and again whenever its
+refunded amount no longer matches the one on the stored receipt or its
+file went missing. Files go
+to the private, content-addressed receipt storage, so re-rendering
+identical content never stores a second copy.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from utils.pdf import render_pdf
+
+from .models import Order, OrderDiscount
+
+CURRENCY = 'RWF'
+# Courier at 9pt fits 73 columns between the page margins
+COLUMNS = (40, 5, 14, 14)
+WIDTH = sum(COLUMNS)
+
+
+def _money(amount):
+    return f"{amount:,.2f}"
+
+
+def _date(value):
+    return timezone.localtime(value).strftime('%Y-%m-%d %H:%M') if value else '-'
+
+
+def _row(*cells):
+    name, *numbers = cells
+    return ('mono', 9, name[:COLUMNS[0] - 1].ljust(COLUMNS[0]) + ''.join(
+        str(cell).rjust(width) for cell, width in zip(numbers, COLUMNS[1:])
+    ))
+
+
+def _total(label, amount):
+    return ('mono', 9, f"{label}:".rjust(WIDTH - COLUMNS[-1]) + _money(amount).rjust(COLUMNS[-1]))
+
+
+def receipt_lines(order):
+    """(font, size, text) lines of the receipt, only from data fixed at purchase or refund time"""
+    shipping = order.shipping_address
+    items = list(order.items.all())
+    lines = [
+        ('bold', 18, settings.COMPANY_NAME),
+        ('bold', 13, 'Receipt'),
+        ('regular', 10, ''),
+        ('regular', 10, f"Order: {order.order_number}"),
+        ('regular', 10, f"Ordered: {_date(order.created_at)}"),
+        ('regular', 10, f"Paid: {_date(order.paid_at)}"),
+        ('regular', 10, f"Customer: {order.user.full_name} <{order.user.email}>"),
+    ]
+    if shipping:
+        address = ', '.join(part for part in (shipping.street_address, shipping.sector, shipping.district) if part)
+        lines.append(('regular', 10, f"Ship to: {address} ({shipping.shipping_phone})"))
+
+    lines += [('regular', 10, ''), _row('Item', 'Qty', f'Price ({CURRENCY})', f'Amount ({CURRENCY})'), ('mono', 9, '-' * WIDTH)]
+    for item in items:
+        name = f"{item.product_name} ({item.variant})" if item.variant else item.product_name
+        lines.append(_row(name, item.quantity, _money(item.price_at_purchase), _money(item.subtotal)))
+    lines.append(('mono', 9, '-' * WIDTH))
+
+    lines.append(_total('Subtotal', sum((item.subtotal for item in items), Decimal('0.00'))))
+    if order.discount_amount:
+        discount_names = ', '.join(d.discount.name for d in order.order_discounts.all() if d.discount)
+        lines.append(_total(f"Discount {discount_names}".strip(), -order.discount_amount))
+    lines += [
+        _total('Shipping', order.shipping_fee),
+        _total('Total', order.total_amount),
+    ]
+    if order.refunded_amount:
+        lines += [
+            _total('Refunded', -order.refunded_amount),
+            _total('Net paid', order.final_amount),
+        ]
+
+    lines += [('regular', 10, ''), ('regular', 9, f"Questions about this order? {settings.SUPPORT_EMAIL}")]
+    return lines
+
+
+def needs_receipt(order):
+    return order.paid_at is not None and (
+        not order.receipt_file or order.receipt_refunded_amount != order.refunded_amount
+    )
+
+
+def generate_receipt(order_id):
+    """Render and store the receipt if it is missing or stale, returns whether it did"""
+    order = (
+        Order.objects.select_related('user', 'shipping_address')
+        .prefetch_related('items', Prefetch('order_discounts', queryset=OrderDiscount.objects.select_related('discount')))
+        .filter(pk=order_id)
+        .first()
+    )
+    if order is None or not needs_receipt(order):
+        return False
+
+    pdf = render_pdf(receipt_lines(order))
+    order.receipt_file.save(f"{order.order_number}.pdf", ContentFile(pdf), save=False)
+    # A refund that landed meanwhile leaves the amount changed and queues its own render
+    Order.objects.filter(pk=order.pk, refunded_amount=order.refunded_amount).update(
+        receipt_file=order.receipt_file.name,
+        receipt_refunded_amount=order.refunded_amount,
+    )
+    return True
@@ -1,8 +1,15 @@
 from rest_framework import serializers
-from decimal import Decimal
+from decimal import ROUND_HALF_UP, Decimal
+from django.db import transaction
+from django.db.models import Prefetch
+from django.db.models.functions import Upper
 from django.utils import timezone
 from .models import Order, OrderItem, OrderDiscount, Return, Refund, Shipping
+from .outbox import record_event
+from .transitions import ORDER_TRANSITIONS, apply_transition
 from products.models import Product, Discount
+from products import inventory
+from products.pricing import effective_price
 
 
 class ShippingSerializer(serializers.ModelSerializer):
@@ -24,9 +31,7 @@ class ShippingSerializer(serializers.ModelSerializer):
 
 
 class OrderItemSerializer(serializers.ModelSerializer):
-    """Serializer for order items with product details"""
-    product_name = serializers.CharField(read_only=True)
-    product_slug = serializers.CharField(source='product.slug', read_only=True)
+    """Serializer for order items, product details come from the snapshot taken at purchase"""
     product_thumbnail = serializers.SerializerMethodField()
     subtotal = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
     quantity_available_for_return = serializers.IntegerField(read_only=True)
@@ -39,6 +44,9 @@ class OrderItemSerializer(serializers.ModelSerializer):
             'product_name',
             'product_slug',
             'product_thumbnail',
+            'product_category',
+            'product_attributes',
+            'variant',
             'quantity',
             'price_at_purchase',
             'subtotal',
@@ -51,6 +59,10 @@ class OrderItemSerializer(serializers.ModelSerializer):
         read_only_fields = [
             'id',
             'product_name',
+            'product_slug',
+            'product_category',
+            'product_attributes',
+            'variant',
             'subtotal',
             'quantity_returned',
             'refunded_amount',
@@ -61,25 +73,21 @@ class OrderItemSerializer(serializers.ModelSerializer):
     
     def get_product_thumbnail(self, obj):
         """Get product thumbnail with proper context handling"""
-        first_media = obj.product.media.first()
-        if first_media and first_media.image:
+        thumbnail_url = obj.product_thumbnail
+        if thumbnail_url:
             request = self.context.get('request')
             if request:
-                return request.build_absolute_uri(first_media.image.url)
-            return first_media.image.url
+                return request.build_absolute_uri(thumbnail_url)
+            return thumbnail_url
         return None
 
 
 class OrderItemCreateSerializer(serializers.Serializer):
     """Simplified serializer for creating order items"""
-    product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.filter(published=True))
+    # Products are loaded for the whole cart at once in OrderCreateSerializer.validate_items
+    product = serializers.UUIDField()
+    variant = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
     quantity = serializers.IntegerField(min_value=1)
-    
-    def validate_product(self, value):
-        """Validate product is available for purchase"""
-        if not value.published:
-            raise serializers.ValidationError("This product is not available for purchase.")
-        return value
 
 
 class OrderDiscountSerializer(serializers.ModelSerializer):
@@ -107,8 +115,7 @@ class OrderDiscountSerializer(serializers.ModelSerializer):
 
 
 class OrderListSerializer(serializers.ModelSerializer):
-    """Lightweight serializer for order lists"""
-    item_count = serializers.SerializerMethodField()
+    """Lightweight serializer for order lists, reads only columns of the order row"""
     status_display = serializers.CharField(source='get_status_display', read_only=True)
     final_amount = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
     
@@ -122,14 +129,12 @@ class OrderListSerializer(serializers.ModelSerializer):
             'status',
             'status_display',
             'item_count',
+            'units_count',
+            'subtotal',
             'created_at',
             'paid_at',
             'delivered_at',
         ]
-    
-    def get_item_count(self, obj):
-        """Get count of items in order"""
-        return obj.items.count()
 
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -151,6 +156,9 @@ class OrderSerializer(serializers.ModelSerializer):
             'user',
             'user_name',
             'user_email',
+            'item_count',
+            'units_count',
+            'subtotal',
             'total_amount',
             'shipping_fee',
             'discount_amount',          
@@ -174,6 +182,9 @@ class OrderSerializer(serializers.ModelSerializer):
             'id',
             'order_number',
             'user',
+            'item_count',
+            'units_count',
+            'subtotal',
             'total_amount',
             'discount_amount',      
             'refunded_amount',
@@ -210,101 +221,119 @@ class OrderCreateSerializer(serializers.Serializer):
     discount_code = serializers.CharField(required=False, allow_blank=True, write_only=True)
     
     def validate_items(self, value):
-        """Validate items list"""
+        """Validate items list and load every product with its current price in one query"""
         if not value:
             raise serializers.ValidationError("Order must contain at least one item.")
         if len(value) > 50:
             raise serializers.ValidationError("Maximum 50 items per order.")
+
+        product_ids = {item['product'] for item in value}
+        products = (
+            Product.objects.filter(pk__in=product_ids, published=True)
+            .select_related('category')
+            .annotate(price=effective_price())
+            .in_bulk()
+        )
+        missing = product_ids - set(products)
+        if missing:
+            raise serializers.ValidationError(
+                f"These products are not available for purchase: {', '.join(sorted(map(str, missing)))}"
+            )
+
+        for item in value:
+            item['product'] = products[item['product']]
         return value
+
+    def validate_discount_code(self, value):
+        """Resolve the code through the UPPER(name) index"""
+        if not value:
+            return None
+        now = timezone.now()
+        discount = (
+            Discount.objects.alias(name_upper=Upper('name'))
+            .filter(name_upper=value.strip().upper(), is_active=True, start_date__lte=now, end_date__gte=now)
+            .first()
+        )
+        if discount is None:
+            raise serializers.ValidationError("Invalid or expired discount code.")
+        return discount
     
     def create(self, validated_data):
-        """Create order with shipping address and items"""
+        """Create shipping, order, items and discount as one unit"""
         items_data = validated_data.pop('items')
         shipping_data = validated_data.pop('shipping')
-        discount_code = validated_data.pop('discount_code', None)
+        discount_obj = validated_data.pop('discount_code', None)
         user = self.context['request'].user
         
-        # Step 1: Create Shipping object
-        shipping = Shipping.objects.create(**shipping_data)
-        
-        # Step 2: Calculate subtotal and prepare order items
+        # Step 1: Price the items (product-level discounts were applied in SQL by validate_items).
+        # Amounts are kept in cents, as stored, so the total matches the sum of the stored items.
+        cent = Decimal('0.01')
         subtotal = Decimal('0.00')
         order_items = []
-        
         for item_data in items_data:
             product = item_data['product']
             quantity = item_data['quantity']
-            
-            # Get final price (with product-level discounts if applicable)
-            price = product.unit_price
-            
-            active_product_discounts = product.product_discounts.filter(
-                discount__is_active=True,
-                discount__start_date__lte=timezone.now(),
-                discount__end_date__gte=timezone.now()
-            )
-            
-            if active_product_discounts.exists():
-                discount = active_product_discounts.first().discount
-                if discount.discount_type == 'percentage':
-                    price = price * (1 - discount.discount_value / 100)
-                elif discount.discount_type == 'fixed':
-                    price = max(price - discount.discount_value, Decimal('0.00'))
-            
+            price = product.price.quantize(cent, rounding=ROUND_HALF_UP)
             subtotal += price * quantity
-            order_items.append({
-                'product': product,
-                'product_name': product.name,
-                'quantity': quantity,
-                'price_at_purchase': price,
-            })
+            order_items.append(OrderItem(
+                product=product,
+                **OrderItem.product_snapshot(product),
+                variant=item_data['variant'].strip(),
+                quantity=quantity,
+                price_at_purchase=price,
+            ))
         
-        # Step 3: Apply order-level discount if provided
+        # Step 2: Apply order-level discount if provided
         discount_amount = Decimal('0.00')
-        discount_obj = None
-        
-        if discount_code:
-            try:
-                discount_obj = Discount.objects.get(
-                    name__iexact=discount_code,
-                    is_active=True,
-                    start_date__lte=timezone.now(),
-                    end_date__gte=timezone.now()
-                )
-                if discount_obj.discount_type == 'percentage':
-                    discount_amount = subtotal * (discount_obj.discount_value / 100)
-                elif discount_obj.discount_type == 'fixed':
-                    discount_amount = min(discount_obj.discount_value, subtotal)
-            except Discount.DoesNotExist:
-                raise serializers.ValidationError({"discount_code": "Invalid or expired discount code."})
+        if discount_obj:
+            if discount_obj.discount_type == 'percentage':
+                discount_amount = (subtotal * (discount_obj.discount_value / 100)).quantize(cent, rounding=ROUND_HALF_UP)
+            elif discount_obj.discount_type == 'fixed':
+                discount_amount = min(discount_obj.discount_value, subtotal)
         
-        # Step 4: Calculate total
+        # Step 3: Calculate total
         shipping_fee = shipping_data.get('shipping_fee', Decimal('0.00'))
         total_amount = subtotal + shipping_fee - discount_amount
         
-        # Step 5: Create Order with Shipping ForeignKey
-        order = Order.objects.create(
-            user=user,
-            shipping_address=shipping,
-            total_amount=total_amount,
-            shipping_fee=shipping_fee,
-            discount_amount=discount_amount,
-            customer_notes=validated_data.get('customer_notes', ''),
-        )
-        
-        # Step 6: Create order items
-        for item_data in order_items:
-            OrderItem.objects.create(order=order, **item_data)
-        
-        # Step 7: Create order discount if applied
-        if discount_obj:
-            OrderDiscount.objects.create(order=order, discount=discount_obj)
+        # Step 4: Write everything or nothing, a failure can't leave a stray Shipping row
+        with transaction.atomic():
+            shipping = Shipping.objects.create(**shipping_data)
+            order = Order.objects.create(
+                user=user,
+                shipping_address=shipping,
+                item_count=len(order_items),
+                units_count=sum(item.quantity for item in order_items),
+                subtotal=subtotal,
+                total_amount=total_amount,
+                shipping_fee=shipping_fee,
+                discount_amount=discount_amount,
+                customer_notes=validated_data.get('customer_notes', ''),
+            )
+            for item in order_items:
+                item.order = order
+            OrderItem.objects.bulk_create(order_items)
+            if discount_obj:
+                OrderDiscount.objects.create(order=order, discount=discount_obj)
+            record_event(order, 'created', total_amount=order.total_amount)
+            # Last, so the cart's stock rows stay locked as briefly as possible
+            try:
+                inventory.reserve((item.product_id, item.variant, item.quantity) for item in order_items)
+            except inventory.InsufficientStock as exc:
+                raise serializers.ValidationError({'items': [
+                    f"Only {stock.available} left of {stock.product.name}"
+                    + (f" ({stock.variant})" if stock.variant else "")
+                    for stock, quantity in exc.shortages
+                ]})
         
         return order
     
     def to_representation(self, instance):
         """Return detailed order representation"""
-        return OrderSerializer(instance, context=self.context).data
+        order = Order.objects.select_related('user', 'shipping_address').prefetch_related(
+            'items',
+            Prefetch('order_discounts', queryset=OrderDiscount.objects.select_related('discount')),
+        ).get(pk=instance.pk)
+        return OrderSerializer(order, context=self.context).data
 
 
 class OrderUpdateSerializer(serializers.ModelSerializer):
@@ -319,18 +348,35 @@ class OrderUpdateSerializer(serializers.ModelSerializer):
             'delivered_at',
         ]
     
+    def validate_status(self, value):
+        current = self.instance.status if self.instance else None
+        if current and value != current and value not in ORDER_TRANSITIONS.get(current, ()):
+            labels = dict(Order.STATUS_CHOICES)
+            raise serializers.ValidationError(f'An order can\'t go from "{labels[current]}" to "{labels[value]}".')
+        return value
+
     def update(self, instance, validated_data):
-        """Update order and auto-set timestamps"""
-        status = validated_data.get('status')
-        
-        if status == 'PAID' and not instance.paid_at:
-            instance.paid_at = timezone.now()
-        elif status == 'SHIPPED' and not instance.shipped_at:
-            instance.shipped_at = timezone.now()
-        elif status == 'DELIVERED' and not instance.delivered_at:
-            instance.delivered_at = timezone.now()
-        
-        return super().update(instance, validated_data)
+        """Update order details, then move its status through ORDER_TRANSITIONS with timestamps, stock and event"""
+        status = validated_data.pop('status', instance.status)
+        previous_status = instance.status
+
+        with transaction.atomic():
+            if validated_data:
+                for field, value in validated_data.items():
+                    setattr(instance, field, value)
+                instance.save(update_fields=[*validated_data, 'updated_at'])
+
+            if status != previous_status:
+                changes = {}
+                if status == 'PAID' and not instance.paid_at:
+                    changes['paid_at'] = timezone.now()
+                elif status == 'SHIPPED' and not instance.shipped_at:
+                    changes['shipped_at'] = timezone.now()
+                elif status == 'DELIVERED' and not instance.delivered_at:
+                    changes['delivered_at'] = timezone.now()
+                apply_transition(instance, [previous_status], status, **changes)
+                inventory.order_status_changed(instance, previous_status)
+        return instance
 
 
 class ReturnSerializer(serializers.ModelSerializer):
@@ -401,7 +447,10 @@ class ReturnSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         """Create return request with current user"""
         validated_data['user'] = self.context['request'].user
-        return super().create(validated_data)
+        with transaction.atomic():
+            instance = super().create(validated_data)
+            record_event(instance, 'created', order_id=instance.order_id)
+        return instance
 
 
 class ReturnApproveSerializer(serializers.Serializer):
@@ -479,7 +528,10 @@ class RefundSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         """Create refund with current user"""
         validated_data['user'] = self.context['request'].user
-        return super().create(validated_data)
+        with transaction.atomic():
+            instance = super().create(validated_data)
+            record_event(instance, 'created', order_id=instance.order_id)
+        return instance
 
 
 class RefundCompleteSerializer(serializers.Serializer):
@@ -0,0 +1,40 @@
+"""
+Order summary columns (item_count, units_count, subtotal) as SQL, so they
+can be recomputed for one order or the whole table with a single UPDATE:
+Order.objects.filter(...).update(**summary_columns())
+Returned units don't count towards the summary.
+"""
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import OrderItem
+
+AMOUNT_FIELD = DecimalField(max_digits=10, decimal_places=2)
+KEPT_UNITS = F('quantity') - F('quantity_returned')
+
+
+def _items_total(aggregate, output_field, empty):
+    totals = (
+        OrderItem.objects.filter(order=OuterRef('pk'))
+        .order_by()
+        .values('order')
+        .annotate(total=aggregate)
+        .values('total')
+    )
+    return Coalesce(Subquery(totals, output_field=output_field), Value(empty, output_field=output_field))
+
+
+def summary_columns():
+    return {
+        'item_count': _items_total(
+            Count('pk', filter=Q(quantity__gt=F('quantity_returned'))), IntegerField(), 0
+        ),
+        'units_count': _items_total(Sum(KEPT_UNITS), IntegerField(), 0),
+        'subtotal': _items_total(
+            Sum(ExpressionWrapper(KEPT_UNITS * F('price_at_purchase'), output_field=AMOUNT_FIELD)),
+            AMOUNT_FIELD,
+            Decimal('0.00'),
+        ),
+    }
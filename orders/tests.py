@@ -1,3 +1,636 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
 
-# Create your tests here.
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from orders import outbox
+from orders.models import IdempotencyKey, LedgerEntry, Order, OrderItem, OutboxEvent, Refund, Return, Shipping
+from orders.receipts import generate_receipt
+from orders.transitions import TransitionConflict, apply_transition
+from orders.views import ReturnViewSet
+from products.models import Discount, Product, ProductDiscount, ServiceCategory, Stock
+from utils.storage import ContentAddressedFileSystemStorage
+
+
+class OrderTestMixin:
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email="buyer@example.com", full_name="Buyer", phone_number="0781000001", password="pass12345"
+        )
+        self.client.force_authenticate(self.user)
+        self.category = ServiceCategory.objects.create(name="Home")
+        self.products = [
+            Product.objects.create(
+                category=self.category, name=f"Item {i}", short_description="Item",
+                unit_price=Decimal("1000"), published=True, is_for_sale=True
+            )
+            for i in range(30)
+        ]
+
+    def make_discount(self, name, discount_type, value):
+        return Discount.objects.create(
+            name=name, discount_type=discount_type, discount_value=Decimal(value),
+            start_date=timezone.now() - timedelta(days=1), end_date=timezone.now() + timedelta(days=1),
+        )
+
+    def order_payload(self, products, **extra):
+        payload = {
+            "items": [{"product": str(product.pk), "quantity": 2} for product in products],
+            "shipping": {"shipping_phone": "0781000002", "district": "Gasabo", "sector": "Kimironko",
+                         "shipping_fee": "500"},
+        }
+        payload.update(extra)
+        return payload
+
+    def create_order(self, products, **extra):
+        return self.client.post("/api/v1/orders/orders/", self.order_payload(products, **extra), format="json")
+
+
+class OrderCreateTest(OrderTestMixin, TestCase):
+
+    def count_queries(self, products):
+        with CaptureQueriesContext(connection) as context:
+            response = self.create_order(products)
+        self.assertEqual(response.status_code, 201)
+        return len(context.captured_queries)
+
+    def test_query_budget_does_not_depend_on_cart_size(self):
+        single = self.count_queries(self.products[:1])
+        full = self.count_queries(self.products)
+
+        self.assertEqual(single, full)
+        self.assertLessEqual(full, 14)
+
+    def test_prices_product_discounts_and_discount_code(self):
+        ProductDiscount.objects.create(
+            product=self.products[0], discount=self.make_discount("Spring", Discount.PERCENTAGE, "10")
+        )
+        self.make_discount("WELCOME5", Discount.FIXED, "500")
+
+        response = self.create_order(self.products[:2], discount_code="welcome5")
+
+        self.assertEqual(response.status_code, 201)
+        # (900 + 1000) * 2 + 500 shipping - 500 code
+        self.assertEqual(Decimal(response.data["total_amount"]), Decimal("3800.00"))
+        self.assertEqual(len(response.data["items"]), 2)
+        self.assertEqual(len(response.data["order_discounts"]), 1)
+        prices = sorted(OrderItem.objects.values_list("price_at_purchase", flat=True))
+        self.assertEqual(prices, [Decimal("900.00"), Decimal("1000.00")])
+
+    def test_total_matches_stored_items_for_fractional_prices(self):
+        Product.objects.filter(pk=self.products[0].pk).update(unit_price=Decimal("10.01"))
+        ProductDiscount.objects.create(
+            product=self.products[0], discount=self.make_discount("Odd", Discount.PERCENTAGE, "15")
+        )
+
+        order = Order.objects.get(pk=self.create_order(self.products[:1]).data["id"])
+
+        item = order.items.get()
+        self.assertEqual(item.price_at_purchase, Decimal("8.51"))
+        self.assertEqual(order.subtotal, item.price_at_purchase * item.quantity)
+        self.assertEqual(order.total_amount, order.subtotal + order.shipping_fee)
+
+    def test_invalid_code_creates_nothing(self):
+        response = self.create_order(self.products[:1], discount_code="NOPE")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("discount_code", response.data)
+        self.assertFalse(Shipping.objects.exists())
+
+    def test_unpublished_products_are_rejected(self):
+        Product.objects.filter(pk=self.products[1].pk).update(published=False)
+
+        response = self.create_order(self.products[:2])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(self.products[1].pk), str(response.data["items"]))
+
+    def test_failure_rolls_back_shipping(self):
+        with patch.object(OrderItem.objects, "bulk_create", side_effect=RuntimeError("db down")):
+            with self.assertRaises(RuntimeError):
+                self.create_order(self.products[:3])
+
+        self.assertFalse(Shipping.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+
+class IdempotencyKeyTest(OrderTestMixin, TestCase):
+
+    def test_retry_replays_the_first_response(self):
+        first = self.client.post(
+            "/api/v1/orders/orders/", self.order_payload(self.products[:2]), format="json",
+            HTTP_IDEMPOTENCY_KEY="checkout-1",
+        )
+        retry = self.client.post(
+            "/api/v1/orders/orders/", self.order_payload(self.products[:2]), format="json",
+            HTTP_IDEMPOTENCY_KEY="checkout-1",
+        )
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.json()["id"], first.json()["id"])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.client.post(
+            "/api/v1/orders/orders/", self.order_payload(self.products[:1]), format="json",
+            HTTP_IDEMPOTENCY_KEY="checkout-1",
+        )
+        response = self.client.post(
+            "/api/v1/orders/orders/", self.order_payload(self.products[:2]), format="json",
+            HTTP_IDEMPOTENCY_KEY="checkout-1",
+        )
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_request_can_be_retried(self):
+        Product.objects.filter(pk=self.products[0].pk).update(published=False)
+        failed = self.client.post(
+            "/api/v1/orders/orders/", self.order_payload(self.products[:1]), format="json",
+            HTTP_IDEMPOTENCY_KEY="checkout-1",
+        )
+        Product.objects.filter(pk=self.products[0].pk).update(published=True)
+        retry = self.client.post(
+            "/api/v1/orders/orders/", self.order_payload(self.products[:1]), format="json",
+            HTTP_IDEMPOTENCY_KEY="checkout-1",
+        )
+
+        self.assertEqual(failed.status_code, 400)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_expired_keys_run_again_and_are_purged(self):
+        self.client.post(
+            "/api/v1/orders/orders/", self.order_payload(self.products[:1]), format="json",
+            HTTP_IDEMPOTENCY_KEY="checkout-1",
+        )
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+
+        call_command("purge_idempotency_keys", stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        response = self.client.post(
+            "/api/v1/orders/orders/", self.order_payload(self.products[:1]), format="json",
+            HTTP_IDEMPOTENCY_KEY="checkout-1",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Order.objects.count(), 2)
+
+
+class StockReservationTest(OrderTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product = self.products[0]
+        self.stock = Stock.objects.create(product=self.product, variant="Large", on_hand=3)
+        self.staff = User.objects.create_user(
+            email="staff@example.com", full_name="Staff", phone_number="0781000003", password="pass12345"
+        )
+        self.staff.is_staff = True
+        self.staff.save()
+
+    def checkout(self, quantity):
+        payload = self.order_payload([])
+        payload["items"] = [
+            {"product": str(self.product.pk), "variant": "Large", "quantity": quantity},
+            {"product": str(self.products[1].pk), "quantity": 5},
+        ]
+        return self.client.post("/api/v1/orders/orders/", payload, format="json")
+
+    def test_checkout_reserves_tracked_variants(self):
+        response = self.checkout(2)
+
+        self.assertEqual(response.status_code, 201)
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.on_hand, self.stock.reserved), (3, 2))
+
+    def test_checkout_cannot_oversell(self):
+        self.assertEqual(self.checkout(2).status_code, 201)
+        response = self.checkout(2)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Only 1 left", str(response.data["items"]))
+        self.assertEqual(Order.objects.count(), 1)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.reserved, 2)
+
+    def test_cancel_releases_reservation(self):
+        order_id = self.checkout(2).data["id"]
+
+        response = self.client.post(f"/api/v1/orders/orders/{order_id}/cancel/")
+
+        self.assertEqual(response.status_code, 200)
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.on_hand, self.stock.reserved), (3, 0))
+
+    def test_shipping_commits_and_completed_return_restocks(self):
+        order_id = self.checkout(2).data["id"]
+        self.client.force_authenticate(self.staff)
+
+        self.client.patch(f"/api/v1/orders/orders/{order_id}/", {"status": "PAID"}, format="json")
+        self.client.patch(f"/api/v1/orders/orders/{order_id}/", {"status": "SHIPPED"}, format="json")
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.on_hand, self.stock.reserved), (1, 0))
+
+        order = Order.objects.get(pk=order_id)
+        return_obj = Return.objects.create(
+            order=order, user=self.user, reason="Damaged", detailed_reason="Broken",
+            requested_refund_amount=Decimal("1000"), status="APPROVED",
+        )
+        response = self.client.post(f"/api/v1/orders/returns/{return_obj.pk}/complete/")
+
+        self.assertEqual(response.status_code, 200)
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.on_hand, self.stock.reserved), (3, 0))
+        self.assertFalse(order.items.filter(quantity_returned=0).exists())
+        order.refresh_from_db()
+        self.assertEqual((order.item_count, order.units_count, order.subtotal), (0, 0, Decimal("0.00")))
+
+
+class OrderSummaryTest(OrderTestMixin, TestCase):
+
+    def test_summary_is_written_at_creation(self):
+        response = self.create_order(self.products[:3])
+
+        order = Order.objects.get(pk=response.data["id"])
+        self.assertEqual((order.item_count, order.units_count, order.subtotal), (3, 6, Decimal("6000.00")))
+
+    def test_list_query_count_does_not_depend_on_page_size(self):
+        self.create_order(self.products[:3])
+        with CaptureQueriesContext(connection) as one_order:
+            self.client.get("/api/v1/orders/orders/")
+        for _ in range(4):
+            self.create_order(self.products[:3])
+
+        with CaptureQueriesContext(connection) as five_orders:
+            response = self.client.get("/api/v1/orders/orders/")
+
+        self.assertEqual(len(response.data["results"]), 5)
+        self.assertEqual(response.data["results"][0]["item_count"], 3)
+        self.assertEqual(len(five_orders.captured_queries), len(one_order.captured_queries))
+        # COUNT for the paginator, then the page itself
+        self.assertEqual(len(five_orders.captured_queries), 2)
+
+    def test_rebuild_command_recomputes_from_items(self):
+        order_id = self.create_order(self.products[:2]).data["id"]
+        OrderItem.objects.filter(order_id=order_id, product=self.products[0]).update(quantity_returned=2)
+        Order.objects.update(item_count=0, units_count=0, subtotal=0)
+
+        call_command("rebuild_order_summaries", stdout=StringIO())
+
+        order = Order.objects.get(pk=order_id)
+        self.assertEqual((order.item_count, order.units_count, order.subtotal), (1, 2, Decimal("2000.00")))
+
+
+class OrderItemSnapshotTest(OrderTestMixin, TestCase):
+
+    def test_order_detail_renders_from_snapshot(self):
+        Product.objects.filter(pk=self.products[0].pk).update(thumbnail_url="/media/item-0.jpg", length=Decimal("4"))
+        order_id = self.create_order(self.products[:3]).data["id"]
+        Product.objects.filter(pk=self.products[0].pk).update(slug="renamed", thumbnail_url="/media/new.jpg")
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f"/api/v1/orders/orders/{order_id}/")
+
+        item = next(item for item in response.data["items"] if item["product"] == self.products[0].pk)
+        self.assertEqual(item["product_slug"], self.products[0].slug)
+        self.assertEqual(item["product_thumbnail"], "http://testserver/media/item-0.jpg")
+        self.assertEqual(item["product_category"], "Home")
+        self.assertEqual(item["product_attributes"]["length"], "4.00")
+        self.assertFalse([query for query in context.captured_queries if '"products_product' in query["sql"]])
+
+    def test_backfill_command_fills_missing_snapshots(self):
+        order_id = self.create_order(self.products[:2]).data["id"]
+        OrderItem.objects.update(product_slug="", product_category="")
+
+        call_command("snapshot_order_items", stdout=StringIO())
+
+        self.assertFalse(OrderItem.objects.filter(order_id=order_id, product_category="").exists())
+
+
+class StatusTransitionTest(OrderTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.order = Order.objects.get(pk=self.create_order(self.products[:1]).data["id"])
+        self.staff = User.objects.create_user(
+            email="staff@example.com", full_name="Staff", phone_number="0781000003", password="pass12345"
+        )
+        self.staff.is_staff = True
+        self.staff.save()
+
+    def test_transition_writes_only_its_fields(self):
+        stale = Order.objects.get(pk=self.order.pk)
+        Order.objects.filter(pk=self.order.pk).update(tracking_number="TRK-1")
+
+        apply_transition(stale, ["PENDING"], "CANCELLED")
+
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.tracking_number), ("CANCELLED", "TRK-1"))
+
+    def test_lost_race_is_a_conflict(self):
+        stale = Order.objects.get(pk=self.order.pk)
+        Order.objects.filter(pk=self.order.pk).update(status="PAID")
+
+        with self.assertRaises(TransitionConflict):
+            apply_transition(stale, ["PENDING"], "CANCELLED")
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, "PAID")
+
+    def test_staff_status_change_follows_allowed_transitions(self):
+        self.client.force_authenticate(self.staff)
+        url = f"/api/v1/orders/orders/{self.order.pk}/"
+
+        self.assertEqual(self.client.patch(url, {"status": "CANCELLED"}, format="json").status_code, 200)
+        response = self.client.patch(url, {"status": "PAID"}, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.paid_at), ("CANCELLED", None))
+        topics = list(OutboxEvent.objects.filter(object_id=self.order.pk).values_list("topic", flat=True))
+        self.assertEqual(sorted(topics), ["order.cancelled", "order.created"])
+
+    def test_concurrent_approve_and_cancel_of_a_return(self):
+        return_obj = Return.objects.create(
+            order=self.order, user=self.user, reason="Damaged", detailed_reason="Broken",
+            requested_refund_amount=Decimal("1000"),
+        )
+        stale = Return.objects.get(pk=return_obj.pk)
+        self.assertEqual(
+            self.client.post(f"/api/v1/orders/returns/{return_obj.pk}/cancel_return/").status_code, 200
+        )
+
+        # The staff request read the return before the customer cancelled it
+        self.client.force_authenticate(self.staff)
+        with patch.object(ReturnViewSet, "get_object", return_value=stale):
+            response = self.client.post(f"/api/v1/orders/returns/{return_obj.pk}/approve/")
+
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("Cancelled", response.data["error"])
+        return_obj.refresh_from_db()
+        self.assertEqual((return_obj.status, return_obj.approved_at), ("CANCELLED", None))
+
+    def test_refund_completes_once(self):
+        refund = Refund.objects.create(order=self.order, user=self.user, amount=Decimal("500"), reason="Late")
+        stale = Refund.objects.get(pk=refund.pk)
+        refund.mark_completed(transaction_id="TX-1")
+
+        with self.assertRaises(TransitionConflict):
+            stale.mark_completed(transaction_id="TX-2")
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.refunded_amount, Decimal("500.00"))
+        self.assertEqual(Refund.objects.get(pk=refund.pk).transaction_id, "TX-1")
+
+
+class RefundLedgerTest(OrderTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.order = Order.objects.get(pk=self.create_order(self.products[:1]).data["id"])
+
+    def refund(self, amount):
+        return Refund.objects.create(order=self.order, user=self.user, amount=Decimal(amount), reason="Late")
+
+    def test_refunds_loaded_together_both_count(self):
+        # Both refunds carry their own copy of the order, as two concurrent requests would
+        first, second = Refund.objects.select_related("order").filter(
+            pk__in=[self.refund("300").pk, self.refund("400").pk]
+        )
+        first.mark_completed()
+        second.mark_completed()
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.refunded_amount, Decimal("700.00"))
+        self.assertEqual(self.order.ledger_entries.count(), 2)
+
+    def test_full_refund_marks_order_refunded(self):
+        self.refund(self.order.total_amount).mark_completed()
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, "REFUNDED")
+
+    def test_entries_are_append_only(self):
+        entry = LedgerEntry.post(self.order, Decimal("100"), note="Goodwill")
+
+        entry.amount = Decimal("1")
+        with self.assertRaises(ValueError):
+            entry.save()
+        with self.assertRaises(ValueError):
+            entry.delete()
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        self.refund("250").mark_completed()
+        Order.objects.filter(pk=self.order.pk).update(refunded_amount=Decimal("999"))
+
+        with self.assertRaises(CommandError):
+            call_command("reconcile_refunds", stdout=StringIO(), stderr=StringIO())
+        call_command("reconcile_refunds", "--fix", "--batch-size", "1", stdout=StringIO(), stderr=StringIO())
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.refunded_amount, Decimal("250.00"))
+
+
+class OutboxTest(OrderTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        handlers = patch.dict(outbox._handlers)
+        handlers.start()
+        self.addCleanup(handlers.stop)
+        self.order = Order.objects.get(pk=self.create_order(self.products[:1]).data["id"])
+
+    def test_lifecycle_changes_record_events(self):
+        self.client.post(f"/api/v1/orders/orders/{self.order.pk}/cancel/")
+
+        topics = list(OutboxEvent.objects.filter(object_id=self.order.pk).values_list("topic", flat=True))
+        self.assertEqual(topics, ["order.created", "order.cancelled"])
+        self.assertEqual(OutboxEvent.objects.get(topic="order.cancelled").payload["previous_status"], "PENDING")
+
+    def test_lost_transition_records_nothing(self):
+        stale = Order.objects.get(pk=self.order.pk)
+        Order.objects.filter(pk=self.order.pk).update(status="PAID")
+
+        with self.assertRaises(TransitionConflict):
+            apply_transition(stale, ["PENDING"], "CANCELLED")
+        self.assertFalse(OutboxEvent.objects.filter(topic="order.cancelled").exists())
+
+    def test_drain_delivers_to_registered_handlers(self):
+        seen = []
+        outbox.register("order.created")(lambda event: seen.append(event.object_id))
+
+        call_command("drain_outbox", stdout=StringIO())
+
+        self.assertEqual(seen, [self.order.pk])
+        self.assertFalse(OutboxEvent.objects.filter(processed_at__isnull=True).exists())
+
+    def test_failing_handler_is_retried_later_and_rolled_back(self):
+        @outbox.register("order.created")
+        def flaky(event):
+            Order.objects.filter(pk=event.object_id).update(tracking_number="TRK-1")
+            raise RuntimeError("webhook down")
+
+        self.assertEqual(outbox.drain(), 1)
+        event = OutboxEvent.objects.get(topic="order.created")
+        self.assertIsNone(event.processed_at)
+        self.assertEqual((event.attempts, event.last_error), (1, "webhook down"))
+        self.assertGreater(event.available_at, timezone.now())
+        self.assertIsNone(Order.objects.get(pk=self.order.pk).tracking_number)
+        # Not due yet
+        self.assertEqual(outbox.drain(), 0)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_event_out_of_attempts_is_reported_and_can_be_requeued(self):
+        @outbox.register("order.created")
+        def broken(event):
+            raise RuntimeError("webhook down")
+
+        with self.assertLogs("orders.outbox", "WARNING") as logs:
+            outbox.drain()
+            OutboxEvent.objects.update(available_at=timezone.now())
+            outbox.drain()
+        self.assertEqual([record.levelname for record in logs.records], ["WARNING", "ERROR"])
+        OutboxEvent.objects.update(available_at=timezone.now())
+        self.assertEqual(outbox.claim(10), [])
+
+        admin_client = Client()
+        admin_client.force_login(User.objects.create_superuser(
+            email="admin@example.com", full_name="Admin", phone_number="0781000009", password="pass12345"
+        ))
+        event = OutboxEvent.objects.get(topic="order.created")
+        response = admin_client.get("/admin/orders/outboxevent/?delivery=exhausted")
+        self.assertContains(response, str(event.object_id))
+        self.assertNotContains(admin_client.get("/admin/orders/outboxevent/?delivery=pending"), str(event.object_id))
+
+        admin_client.post("/admin/orders/outboxevent/", {"action": "retry_now", "_selected_action": [event.pk]})
+        self.assertEqual(len(outbox.claim(10)), 1)
+
+    def test_claimed_events_are_leased_until_their_worker_gives_up(self):
+        self.assertEqual(len(outbox.claim(10)), 1)
+        self.assertGreater(OutboxEvent.objects.get().available_at, timezone.now())
+        self.assertEqual(outbox.claim(10), [])
+
+        # The worker died, its lease runs out
+        OutboxEvent.objects.update(available_at=timezone.now())
+
+        self.assertEqual(len(outbox.claim(10)), 1)
+
+
+class ReceiptTest(OrderTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        storage = ContentAddressedFileSystemStorage(location=self.media_root, base_url="/media/")
+        storage_patch = patch.object(Order._meta.get_field("receipt_file"), "storage", storage)
+        storage_patch.start()
+        self.addCleanup(storage_patch.stop)
+
+        self.order = Order.objects.get(pk=self.create_order(self.products[:2]).data["id"])
+        self.staff = User.objects.create_user(
+            email="staff@example.com", full_name="Staff", phone_number="0781000003", password="pass12345"
+        )
+        self.staff.is_staff = True
+        self.staff.save()
+
+    def mark_paid(self):
+        self.client.force_authenticate(self.staff)
+        self.client.patch(f"/api/v1/orders/orders/{self.order.pk}/", {"status": "PAID"}, format="json")
+        self.client.force_authenticate(self.user)
+
+    def download(self, **headers):
+        return self.client.get(f"/api/v1/orders/orders/{self.order.pk}/receipt/", **headers)
+
+    def test_receipt_is_rendered_by_the_outbox_once_paid(self):
+        self.assertEqual(self.download().status_code, 404)
+        self.mark_paid()
+        # Paid, but the worker hasn't run yet
+        self.assertEqual(self.download().status_code, 202)
+
+        call_command("drain_outbox", stdout=StringIO())
+        response = self.download()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertIn("private", response["Cache-Control"])
+        self.assertNotIn("public", response["Cache-Control"])
+        body = b"".join(response.streaming_content)
+        self.assertTrue(body.startswith(b"%PDF-"))
+        self.assertIn(self.order.order_number.encode(), body)
+        self.assertEqual(self.download(HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+    def test_receipt_is_only_rerendered_when_refunds_change(self):
+        self.mark_paid()
+        call_command("drain_outbox", stdout=StringIO())
+        self.order.refresh_from_db()
+        first_receipt = self.order.receipt_file.name
+
+        self.assertFalse(generate_receipt(self.order.pk))
+
+        Refund.objects.create(
+            order=self.order, user=self.user, amount=Decimal("500"), reason="Late"
+        ).mark_completed()
+        self.client.force_authenticate(self.user)
+        # The pre-refund receipt isn't served while the new one is pending
+        self.assertEqual(self.download().status_code, 202)
+        call_command("drain_outbox", stdout=StringIO())
+
+        self.assertEqual(self.download().status_code, 200)
+        self.order.refresh_from_db()
+        self.assertNotEqual(self.order.receipt_file.name, first_receipt)
+        self.assertEqual(self.order.receipt_refunded_amount, Decimal("500.00"))
+        with self.order.receipt_file.open("rb") as receipt:
+            self.assertIn(b"Refunded", receipt.read())
+
+    def test_reconciled_refunds_rerender_the_receipt(self):
+        self.mark_paid()
+        call_command("drain_outbox", stdout=StringIO())
+        # A refund the ledger has but the balance missed
+        LedgerEntry.objects.create(order=self.order, kind=LedgerEntry.REFUND, amount=Decimal("300"))
+
+        call_command("reconcile_refunds", "--fix", stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(self.download().status_code, 202)
+        call_command("drain_outbox", stdout=StringIO())
+
+        self.assertEqual(self.download().status_code, 200)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.receipt_refunded_amount, Decimal("300.00"))
+
+    def test_missing_receipt_file_is_rendered_again(self):
+        self.mark_paid()
+        call_command("drain_outbox", stdout=StringIO())
+        self.order.refresh_from_db()
+        self.order.receipt_file.storage.delete(self.order.receipt_file.name)
+
+        self.assertEqual(self.download().status_code, 202)
+        self.assertEqual(self.download().status_code, 202)
+        self.assertEqual(OutboxEvent.objects.filter(topic="order.receipt_missing").count(), 1)
+        call_command("drain_outbox", stdout=StringIO())
+
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF-"))
+
+    def test_other_customers_cannot_download(self):
+        self.mark_paid()
+        call_command("drain_outbox", stdout=StringIO())
+        stranger = User.objects.create_user(
+            email="other@example.com", full_name="Other", phone_number="0781000004", password="pass12345"
+        )
+        self.client.force_authenticate(stranger)
+
+        self.assertEqual(self.download().status_code, 404)
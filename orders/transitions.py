@@ -0,0 +1,63 @@
+"""
+Status transitions for orders, returns and refunds. Each transition is one
+UPDATE ... WHERE pk = ... AND status IN (...), so of two concurrent
+requests only one can move the object; the other gets a 409. Every
+transition also records a `<model>.<new status>` outbox event.
+"""
+from django.db import models, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+# Order statuses staff can move an order to from each status. Refunds reach
+# REFUNDED through Refund.mark_completed, never by editing the order.
+ORDER_TRANSITIONS = {
+    'PENDING': {'PAID', 'CANCELLED', 'REJECTED'},
+    'PAID': {'PROCESSING', 'SHIPPED', 'CANCELLED', 'REJECTED'},
+    'PROCESSING': {'SHIPPED', 'CANCELLED', 'REJECTED'},
+    'SHIPPED': {'DELIVERED'},
+}
+
+
+class TransitionConflict(APIException):
+    """The object left the expected status between reading and updating it"""
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'This object was changed by another request.'
+    default_code = 'conflict'
+
+    def __init__(self, message=None):
+        super().__init__({'error': message or self.default_detail})
+
+
+def apply_transition(instance, from_statuses, to_status, **changes):
+    """
+    Move `instance` to `to_status` if its row is still in one of
+    `from_statuses`, writing only the status, `changes` and auto_now
+    timestamps, plus an outbox event in the same transaction. The
+    instance is updated in place and returned.
+    """
+    # orders.models imports this module, the outbox needs the models loaded
+    from .outbox import record_event
+
+    model = type(instance)
+    now = timezone.now()
+    values = {'status': to_status, **changes}
+    for field in model._meta.concrete_fields:
+        if isinstance(field, models.DateTimeField) and field.auto_now:
+            values[field.name] = now
+
+    with transaction.atomic():
+        updated = model.objects.filter(pk=instance.pk, status__in=from_statuses).update(**values)
+        if not updated:
+            current = model.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+            label = dict(model._meta.get_field('status').choices).get(current, current)
+            raise TransitionConflict(
+                f'This {model._meta.verbose_name} is now "{label}", another request changed it first.'
+            )
+
+        previous_status = instance.status
+        for field, value in values.items():
+            setattr(instance, field, value)
+        record_event(instance, to_status.lower(), previous_status=previous_status)
+    return instance
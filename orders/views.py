@@ -1,9 +1,20 @@
 from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from django.db import transaction
+from django.db.models import F
+from django.utils.cache import patch_cache_control
+from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 from drf_spectacular.utils import extend_schema
+from products import inventory
+from utils.streaming import ranged_file_response
+from .idempotency import IdempotentCreateMixin
 from .models import Order, OrderItem, OrderDiscount, Return, Refund, Shipping
+from .outbox import record_event
+from .receipts import needs_receipt
+from .summary import summary_columns
+from .transitions import apply_transition
 from .serializers import (
     OrderSerializer,
     OrderListSerializer,
@@ -53,7 +64,7 @@ class ShippingViewSet(viewsets.ReadOnlyModelViewSet):
         return Shipping.objects.filter(orders__user=user).distinct()
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(IdempotentCreateMixin, viewsets.ModelViewSet):
  
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
@@ -82,16 +93,16 @@ class OrderViewSet(viewsets.ModelViewSet):
         if not self.request.user.is_authenticated:
             return Order.objects.none()
         
-        # Admin/staff see all orders
+        # Admin/staff see all orders, regular users only their own
         if self.request.user.is_staff or getattr(self.request.user, 'is_admin', False):
-            return Order.objects.all().select_related(
-                'user', 'shipping_address'
-            ).prefetch_related('items', 'order_discounts')
-        
-        # Regular users see only their own orders
-        return Order.objects.filter(user=self.request.user).select_related(
-            'shipping_address'
-        ).prefetch_related('items', 'order_discounts')
+            queryset = Order.objects.all()
+        else:
+            queryset = Order.objects.filter(user=self.request.user)
+
+        # The list reads the summary columns stored on the order row
+        if self.action == 'list':
+            return queryset
+        return queryset.select_related('user', 'shipping_address').prefetch_related('items', 'order_discounts')
 
     def get_permissions(self):
         if self.action in ('update', 'partial_update'):
@@ -116,10 +127,42 @@ class OrderViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        order.status = 'CANCELLED'
-        order.save()
+        with transaction.atomic():
+            apply_transition(order, ['PENDING'], 'CANCELLED')
+            inventory.release(inventory.order_lines(order))
         return Response(OrderSerializer(order, context={'request': request}).data)
 
+    @action(detail=True, methods=['get'])
+    def receipt(self, request, pk=None):
+        """Download the PDF receipt, rendered in the background once the order is paid"""
+        order = self.get_object()
+        if not order.paid_at:
+            return Response(
+                {'error': 'Receipts are available once the order is paid.'},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        preparing = Response(
+            {'message': 'The receipt is being prepared, try again shortly.'},
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Retry-After': '10'},
+        )
+        # Missing, or stale after a refund: don't serve the old receipt meanwhile
+        if needs_receipt(order):
+            return preparing
+
+        # Receipts are on private local storage, always streamed to the authenticated owner
+        try:
+            response = ranged_file_response(request, order.receipt_file.path, content_type='application/pdf')
+        except FileNotFoundError:
+            # Lost from storage: forget it and render it again
+            with transaction.atomic():
+                if Order.objects.filter(pk=order.pk, receipt_file=order.receipt_file.name).update(receipt_file=''):
+                    record_event(order, 'receipt_missing')
+            return preparing
+        response['Content-Disposition'] = f'inline; filename="{order.order_number}.pdf"'
+        patch_cache_control(response, private=True)
+        return response
+
 
 class OrderItemViewSet(viewsets.ReadOnlyModelViewSet):
     
@@ -131,7 +174,7 @@ class OrderItemViewSet(viewsets.ReadOnlyModelViewSet):
             return OrderItem.objects.none()
 
         user = self.request.user
-        qs = OrderItem.objects.select_related('order', 'product')
+        qs = OrderItem.objects.all()
 
         # Admin/staff see all
         if not (user.is_staff or getattr(user, 'is_admin', False)):
@@ -167,7 +210,7 @@ class OrderDiscountViewSet(viewsets.ReadOnlyModelViewSet):
         return qs
 
 
-class ReturnViewSet(viewsets.ModelViewSet):
+class ReturnViewSet(IdempotentCreateMixin, viewsets.ModelViewSet):
  
     serializer_class = ReturnSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -245,8 +288,13 @@ class ReturnViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        return_obj.status = 'COMPLETED'
-        return_obj.save()
+        # The whole order comes back, put what hasn't been returned yet back in stock
+        with transaction.atomic():
+            apply_transition(return_obj, ['APPROVED'], 'COMPLETED')
+            items = return_obj.order.items.filter(quantity_returned__lt=F('quantity'))
+            inventory.restock(items.values_list('product_id', 'variant', F('quantity') - F('quantity_returned')))
+            items.update(quantity_returned=F('quantity'), updated_at=timezone.now())
+            Order.objects.filter(pk=return_obj.order_id).update(**summary_columns(), updated_at=timezone.now())
 
         return Response(ReturnSerializer(return_obj, context={'request': request}).data)
 
@@ -267,13 +315,12 @@ class ReturnViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        return_obj.status = 'CANCELLED'
-        return_obj.save()
+        apply_transition(return_obj, ['REQUESTED'], 'CANCELLED')
 
         return Response(ReturnSerializer(return_obj, context={'request': request}).data)
 
 
-class RefundViewSet(viewsets.ModelViewSet):
+class RefundViewSet(IdempotentCreateMixin, viewsets.ModelViewSet):
    
     serializer_class = RefundSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -333,7 +380,6 @@ class RefundViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        refund.status = 'FAILED'
-        refund.save()
+        apply_transition(refund, ['PENDING'], 'FAILED')
 
         return Response(RefundSerializer(refund, context={'request': request}).data)
\ No newline at end of file
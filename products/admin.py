@@ -1,7 +1,13 @@
 from django.contrib import admin
 from django import forms
 from django.core.exceptions import ValidationError
-from .models import ServiceCategory, Product, ProductMedia, Feedback, CustomRequest, Wishlist, WishlistItem, Discount, ProductDiscount
+from django.db.models import Count
+from django.utils import timezone
+from utils.background import run_in_background
+from .mesh import is_mesh_file
+from . import inventory
+from .models import ServiceCategory, Product, ProductMedia, Feedback, CustomRequest, Wishlist, WishlistItem, Discount, ProductDiscount, Stock
+from .tasks import analyze_product_media, extract_image_metadata
 
 class ProductAdminForm(forms.ModelForm):
     class Meta:
@@ -36,6 +42,14 @@ class ProductAdminForm(forms.ModelForm):
         return cleaned_data
 
 
+def queue_media_processing(media, changed_data, created):
+    """Same background work as API uploads, only for new or replaced files"""
+    if media.image and (created or 'image' in changed_data):
+        run_in_background(extract_image_metadata, media.pk)
+    if is_mesh_file(media.model_3d) and (created or 'model_3d' in changed_data):
+        run_in_background(analyze_product_media, media.pk)
+
+
 class ProductMediaInline(admin.TabularInline):
     model = ProductMedia
     extra = 1
@@ -64,6 +78,18 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ['name', 'short_description']
     readonly_fields = ['slug', 'created_at', 'updated_at']  
     inlines = [ProductMediaInline, FeedbackInline]
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.refresh_thumbnail()
+
+    def save_formset(self, request, form, formset, change):
+        super().save_formset(request, form, formset, change)
+        if formset.model is ProductMedia:
+            for media in formset.new_objects:
+                queue_media_processing(media, [], created=True)
+            for media, changed_data in formset.changed_objects:
+                queue_media_processing(media, changed_data, created=False)
     
     fieldsets = (
         ('Basic Info', {
@@ -92,6 +118,17 @@ class ProductMediaAdmin(admin.ModelAdmin):
     list_display = ['product', 'display_order', 'uploaded_at']
     list_filter = ['uploaded_at']
     search_fields = ['product__name', 'alt_text']
+    readonly_fields = ['model_preview', 'model_metadata']
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        obj.product.refresh_thumbnail()
+        queue_media_processing(obj, form.changed_data, created=not change)
+
+    def delete_model(self, request, obj):
+        product = obj.product
+        super().delete_model(request, obj)
+        product.refresh_thumbnail()
 
 @admin.register(Feedback)
 class FeedbackAdmin(admin.ModelAdmin):
@@ -101,20 +138,24 @@ class FeedbackAdmin(admin.ModelAdmin):
     actions = ['make_published', 'make_unpublished']
     
     def make_published(self, request, queryset):
+        product_ids = set(queryset.values_list('product_id', flat=True))
         queryset.update(published=True)
+        Product.refresh_ratings(product_ids)
     make_published.short_description = "Publish selected feedback"
     
     def make_unpublished(self, request, queryset):
+        product_ids = set(queryset.values_list('product_id', flat=True))
         queryset.update(published=False)
+        Product.refresh_ratings(product_ids)
     make_unpublished.short_description = "Unpublish selected feedback"
 
 
 @admin.register(CustomRequest)
 class CustomRequestAdmin(admin.ModelAdmin):
-    list_display = ['client_name', 'title', 'service_category', 'status', 'created_at']
-    list_filter = ['status', 'service_category', 'created_at']
+    list_display = ['client_name', 'title', 'service_category', 'status', 'assigned_to', 'processing_status', 'created_at']
+    list_filter = ['status', 'processing_status', 'service_category', 'assigned_to', 'created_at']
     search_fields = ['client_name', 'client_email', 'title', 'description']
-    readonly_fields = ['created_at', 'updated_at']
+    readonly_fields = ['created_at', 'updated_at', 'reference_preview', 'processing_status', 'processing_error']
     
     fieldsets = (
         ('Customer Information', {
@@ -123,8 +164,11 @@ class CustomRequestAdmin(admin.ModelAdmin):
         ('Request Details', {
             'fields': ('service_category', 'title', 'description', 'reference_file', 'budget')
         }),
+        ('Reference File Processing', {
+            'fields': ('processing_status', 'processing_error', 'reference_preview')
+        }),
         ('Status & Notes', {
-            'fields': ('status',),
+            'fields': ('status', 'assigned_to', 'assigned_at'),
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at')
@@ -133,16 +177,31 @@ class CustomRequestAdmin(admin.ModelAdmin):
     
     actions = ['mark_in_progress', 'mark_completed', 'mark_cancelled']
     
+    # Each action only moves requests still in a state it applies to, so two
+    # staff members acting on the same rows can't overwrite each other
+
+    def _transition(self, request, queryset, from_statuses, **changes):
+        now = timezone.now()
+        updated = queryset.filter(status__in=from_statuses).update(updated_at=now, **changes)
+        skipped = queryset.count() - updated
+        message = f"{updated} request(s) updated"
+        if skipped:
+            message += f", {skipped} skipped because another staff member already changed them"
+        self.message_user(request, message)
+    
     def mark_in_progress(self, request, queryset):
-        queryset.update(status='IN_PROGRESS')
+        self._transition(
+            request, queryset, ['PENDING'],
+            status='IN_PROGRESS', assigned_to=request.user, assigned_at=timezone.now()
+        )
     mark_in_progress.short_description = "Mark as In Progress"
     
     def mark_completed(self, request, queryset):
-        queryset.update(status='COMPLETED')
+        self._transition(request, queryset, ['PENDING', 'IN_PROGRESS'], status='COMPLETED')
     mark_completed.short_description = "Mark as Completed"
     
     def mark_cancelled(self, request, queryset):
-        queryset.update(status='CANCELLED')
+        self._transition(request, queryset, ['PENDING', 'IN_PROGRESS'], status='CANCELLED')
     mark_cancelled.short_description = "Mark as Cancelled"
 
 
@@ -158,10 +217,14 @@ class WishlistAdmin(admin.ModelAdmin):
     search_fields = ['user__full_name', 'user__email']
     readonly_fields = ['created_at']
     inlines = [WishlistItemInline]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user').annotate(item_count=Count('items'))
     
     def get_item_count(self, obj):
         return obj.item_count
     get_item_count.short_description = 'Items'
+    get_item_count.admin_order_field = 'item_count'
 
 
 @admin.register(WishlistItem)
@@ -198,4 +261,57 @@ class ProductDiscountAdmin(admin.ModelAdmin):
         "created_at",
     )
     list_filter = ("is_valid",)
-    search_fields = ("product__name", "discount__name")
\ No newline at end of file
+    search_fields = ("product__name", "discount__name")
+
+class StockAdminForm(forms.ModelForm):
+    """
+    An edit of on hand is applied as the difference to the count the form
+    was rendered with, so units committed or restocked meanwhile aren't lost.
+    """
+    loaded_on_hand = forms.IntegerField(widget=forms.HiddenInput, required=False)
+
+    class Meta:
+        model = Stock
+        fields = ["product", "variant", "on_hand"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["loaded_on_hand"].initial = self.instance.on_hand
+        self.on_hand_delta = 0
+
+    def clean(self):
+        cleaned_data = super().clean()
+        on_hand, loaded = cleaned_data.get("on_hand"), cleaned_data.get("loaded_on_hand")
+        if self.instance._state.adding or on_hand is None or loaded is None:
+            return cleaned_data
+
+        # Locked until the admin's transaction ends, so the check still holds when saving
+        current = Stock.objects.select_for_update().get(pk=self.instance.pk)
+        self.on_hand_delta = on_hand - loaded
+        if current.on_hand + self.on_hand_delta < current.reserved:
+            self.add_error("on_hand", (
+                f"Would leave {current.on_hand + self.on_hand_delta} on hand, "
+                f"but {current.reserved} units are reserved by orders."
+            ))
+        return cleaned_data
+
+
+@admin.register(Stock)
+class StockAdmin(admin.ModelAdmin):
+    form = StockAdminForm
+    list_display = ("product", "variant", "on_hand", "reserved", "available", "updated_at")
+    search_fields = ("product__name", "variant")
+    readonly_fields = ("reserved", "updated_at")
+    autocomplete_fields = ("product",)
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.save()
+            return
+        # Only write the edited columns, checkouts may have moved `reserved` since the form loaded
+        fields = [name for name in form.changed_data if name not in ("on_hand", "loaded_on_hand")]
+        if fields:
+            obj.save(update_fields=[*fields, "updated_at"])
+        if form.on_hand_delta:
+            inventory.adjust_on_hand(obj.pk, form.on_hand_delta)
+        obj.refresh_from_db(fields=["on_hand", "reserved", "updated_at"])
@@ -0,0 +1,55 @@
+"""
+Image measurements, low-quality placeholders and previews for uploaded images.
+"""
+import base64
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+PLACEHOLDER_SIZE = 16
+PREVIEW_SIZE = 512
+EXIF_ORIENTATION = 0x0112
+
+
+def image_metadata(file):
+    """
+    Width, height, dominant color and a tiny base64 JPEG placeholder (LQIP)
+    of an image. Width and height follow the EXIF orientation, as browsers display it.
+    """
+    with Image.open(file) as img:
+        width, height = img.size
+        orientation = img.getexif().get(EXIF_ORIENTATION)
+        if orientation in (5, 6, 7, 8):
+            width, height = height, width
+
+        # Let JPEG decode at a reduced scale, the placeholder only needs a few pixels
+        img.draft('RGB', (PLACEHOLDER_SIZE * 8, PLACEHOLDER_SIZE * 8))
+        small = img.convert('RGB')
+        small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+
+    palette = small.quantize(colors=8)
+    _, index = max(palette.getcolors())
+    r, g, b = palette.getpalette()[index * 3:index * 3 + 3]
+
+    buffer = BytesIO()
+    small.save(buffer, format='JPEG', quality=60)
+    placeholder = base64.b64encode(buffer.getvalue()).decode('ascii')
+
+    return {
+        'image_width': width,
+        'image_height': height,
+        'dominant_color': f"#{r:02x}{g:02x}{b:02x}",
+        'placeholder': f"data:image/jpeg;base64,{placeholder}",
+    }
+
+
+def preview_image(file, size=PREVIEW_SIZE):
+    """JPEG bytes of an image downscaled to fit in size x size, EXIF orientation applied"""
+    with Image.open(file) as img:
+        img.draft('RGB', (size, size))
+        preview = ImageOps.exif_transpose(img).convert('RGB')
+    preview.thumbnail((size, size))
+
+    buffer = BytesIO()
+    preview.save(buffer, format='JPEG', quality=80)
+    return buffer.getvalue()
@@ -0,0 +1,133 @@
+"""
+Stock bookkeeping for orders. Lines are (product_id, variant, quantity)
+tuples; lines without a Stock row are made to order and are ignored.
+
+Every change is one UPDATE with per-line F() expressions, guarded by a
+condition in the WHERE clause, so two checkouts of the last unit can't
+both succeed. Only the Stock rows of the cart are locked (in primary key
+order, so overlapping carts can't deadlock), checkouts of other products
+never wait on each other.
+"""
+from collections import Counter
+from functools import reduce
+from operator import or_
+
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import Stock
+
+# Order statuses in which the order's units are held, have left the workshop, or are given back
+HOLDING_STATUSES = {'PENDING', 'PAID', 'PROCESSING'}
+SHIPPED_STATUSES = {'SHIPPED', 'DELIVERED'}
+RELEASED_STATUSES = {'CANCELLED', 'REJECTED', 'REFUNDED'}
+
+
+class InsufficientStock(Exception):
+    """Raised by reserve() when some lines can't be covered, nothing is reserved then"""
+
+    def __init__(self, shortages):
+        # [(Stock, requested quantity)]
+        self.shortages = shortages
+        super().__init__(", ".join(f"{stock}, {quantity} requested" for stock, quantity in shortages))
+
+
+def _totals(lines):
+    totals = Counter()
+    for product_id, variant, quantity in lines:
+        totals[(product_id, variant or '')] += quantity
+    return totals
+
+
+def _line(key):
+    product_id, variant = key
+    return Q(product_id=product_id, variant=variant)
+
+
+def _lock(totals):
+    """Tracked Stock rows of the lines, locked for the rest of the transaction"""
+    if not totals:
+        return {}
+    rows = Stock.objects.select_for_update().filter(reduce(or_, map(_line, totals))).order_by('pk')
+    return {(stock.product_id, stock.variant): stock for stock in rows}
+
+
+def _shift(field, totals, sign):
+    """CASE expression moving `field` by each line's quantity"""
+    whens = [When(_line(key), then=F(field) + sign * quantity) for key, quantity in totals.items()]
+    return Case(*whens, default=F(field), output_field=IntegerField())
+
+
+def _floor(expression):
+    return Greatest(expression, Value(0), output_field=IntegerField())
+
+
+def reserve(lines):
+    """Hold units for an order, all lines or none. Call inside the order's transaction."""
+    totals = _totals(lines)
+    stock = _lock(totals)
+    totals = {key: quantity for key, quantity in totals.items() if key in stock}
+    if not totals:
+        return
+
+    covered = reduce(or_, (_line(key) & Q(on_hand__gte=F('reserved') + quantity) for key, quantity in totals.items()))
+    updated = Stock.objects.filter(covered).update(
+        reserved=_shift('reserved', totals, 1),
+        updated_at=timezone.now(),
+    )
+    if updated != len(totals):
+        raise InsufficientStock([
+            (stock[key], quantity) for key, quantity in totals.items()
+            if stock[key].available < quantity
+        ])
+
+
+def release(lines):
+    """Give held units back, e.g. when an unshipped order is cancelled"""
+    totals = _totals(lines)
+    if _lock(totals):
+        Stock.objects.filter(reduce(or_, map(_line, totals))).update(
+            reserved=_floor(_shift('reserved', totals, -1)),
+            updated_at=timezone.now(),
+        )
+
+
+def commit(lines):
+    """Held units left the workshop: drop them from both on hand and reserved"""
+    totals = _totals(lines)
+    if _lock(totals):
+        Stock.objects.filter(reduce(or_, map(_line, totals))).update(
+            on_hand=_floor(_shift('on_hand', totals, -1)),
+            reserved=_floor(_shift('reserved', totals, -1)),
+            updated_at=timezone.now(),
+        )
+
+
+def restock(lines):
+    """Returned units are back on the shelf"""
+    totals = _totals(lines)
+    if _lock(totals):
+        Stock.objects.filter(reduce(or_, map(_line, totals))).update(
+            on_hand=_shift('on_hand', totals, 1),
+            updated_at=timezone.now(),
+        )
+
+
+def adjust_on_hand(stock_id, delta):
+    """Count correction: move on hand by `delta` relative to whatever it is now"""
+    Stock.objects.filter(pk=stock_id).update(on_hand=F('on_hand') + delta, updated_at=timezone.now())
+
+
+def order_lines(order):
+    return order.items.values_list('product_id', 'variant', 'quantity')
+
+
+def order_status_changed(order, previous_status):
+    """Commit or release an order's held units when it ships or is called off"""
+    if previous_status not in HOLDING_STATUSES:
+        return
+    if order.status in SHIPPED_STATUSES:
+        commit(order_lines(order))
+    elif order.status in RELEASED_STATUSES:
+        release(order_lines(order))
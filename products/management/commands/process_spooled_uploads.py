@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from products.models import CustomRequest
+from products.tasks import process_reference_file
+
+
+class Command(BaseCommand):
+    help = "Process custom request uploads left in the spool by a restart or a failed push"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', help="Also retry uploads that failed")
+
+    def handle(self, *args, **options):
+        stale = timezone.now() - timedelta(minutes=settings.UPLOAD_SPOOL_STALE_MINUTES)
+        statuses = [CustomRequest.PROCESSING_QUEUED, CustomRequest.PROCESSING_RUNNING]
+        if options['retry_failed']:
+            statuses.append(CustomRequest.PROCESSING_FAILED)
+
+        stuck = CustomRequest.objects.filter(processing_status__in=statuses, updated_at__lt=stale).exclude(spooled_file='')
+        request_ids = list(stuck.values_list('pk', flat=True))
+        # Requeue first: process_reference_file only claims queued requests
+        CustomRequest.objects.filter(pk__in=request_ids).update(processing_status=CustomRequest.PROCESSING_QUEUED)
+
+        for request_id in request_ids:
+            process_reference_file(request_id)
+        self.stdout.write(self.style.SUCCESS(f"Processed {len(request_ids)} spooled uploads"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored rating aggregates of every product"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        product_ids = list(Product.objects.values_list('pk', flat=True))
+        for start in range(0, len(product_ids), batch_size):
+            Product.refresh_ratings(product_ids[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(f"Refreshed ratings of {len(product_ids)} products"))
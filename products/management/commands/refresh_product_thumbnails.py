@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = "Recompute the cached thumbnail URL of every product"
+
+    def handle(self, *args, **options):
+        count = 0
+        for product in Product.objects.only('pk').iterator():
+            product.refresh_thumbnail()
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Refreshed {count} product thumbnails"))
@@ -0,0 +1,89 @@
+from itertools import groupby
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import F, OuterRef, Q, Subquery
+
+from products.models import Product, WishlistItem
+from products.pricing import related_effective_price
+from utils.send_email import send_email_batch
+
+
+class Command(BaseCommand):
+    help = "Email customers a digest of wishlisted products that got cheaper or went back on sale"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report the alerts without sending them")
+
+    def handle(self, *args, **options):
+        # Items added before price tracking start from the current price
+        WishlistItem.objects.filter(alert_price__isnull=True).update(
+            price_at_add=related_effective_price(),
+            alert_price=related_effective_price(),
+            alert_for_sale=Subquery(Product.objects.filter(pk=OuterRef('product')).values('is_for_sale')[:1]),
+        )
+
+        # Forget the sale state of products that went off sale, so coming back is alerted again
+        WishlistItem.objects.filter(alert_for_sale=True, product__is_for_sale=False).update(alert_for_sale=False)
+
+        items = list(
+            WishlistItem.objects.annotate(current_price=related_effective_price())
+            .filter(product__published=True)
+            .filter(
+                Q(current_price__lt=F('alert_price'))
+                | Q(product__is_for_sale=True, alert_for_sale=False)
+            )
+            .select_related('product', 'wishlist__user')
+            .order_by('wishlist__user_id', 'product__name')
+        )
+        if not items:
+            self.stdout.write("No price alerts to send")
+            return
+
+        digests = [
+            (user, list(user_items))
+            for user, user_items in groupby(items, key=lambda item: item.wishlist.user)
+        ]
+
+        if options['dry_run']:
+            self.stdout.write(f"Would alert {len(digests)} customers about {len(items)} products")
+            return
+
+        sent = send_email_batch(
+            {
+                'recipient': user.email,
+                'subject': "Prices dropped on your wishlist",
+                'template': "emails/price_drop_digest.html",
+                'context': {
+                    "full_name": user.full_name,
+                    "items": [self.describe(item) for item in user_items],
+                    "wishlist_link": f"{settings.SITE_URL}/wishlist",
+                    "company_name": settings.COMPANY_NAME,
+                    "support_email": settings.SUPPORT_EMAIL,
+                },
+            }
+            for user, user_items in digests
+        )
+
+        # Only move the baseline for customers who actually got the email
+        notified = [item for item in items if item.wishlist.user.email in sent]
+        for item in notified:
+            item.alert_price = item.current_price
+            item.alert_for_sale = item.product.is_for_sale
+        WishlistItem.objects.bulk_update(notified, ['alert_price', 'alert_for_sale'], batch_size=500)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Sent {len(sent)} digests covering {len(notified)} wishlisted products"
+        ))
+
+    def describe(self, item):
+        product = item.product
+        return {
+            "name": product.name,
+            "currency": product.currency,
+            "old_price": item.alert_price,
+            "new_price": item.current_price,
+            "price_dropped": item.alert_price is not None and item.current_price < item.alert_price,
+            "back_on_sale": product.is_for_sale and not item.alert_for_sale,
+            "link": f"{settings.SITE_URL}/products/{product.slug}",
+        }
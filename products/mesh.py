@@ -0,0 +1,197 @@
+"""
+Vectorized STL/OBJ reading and measurements for 3D models.
+Meshes are handled as triangle arrays of shape (N, 3, 3).
+"""
+import os
+import re
+import struct
+
+import numpy as np
+
+MESH_EXTENSIONS = ('.stl', '.obj')
+PREVIEW_MAX_TRIANGLES = 20000
+
+BINARY_STL_DTYPE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attributes', '<u2'),
+])
+
+ASCII_STL_VERTEX = re.compile(rb'vertex\s+(\S+)\s+(\S+)\s+(\S+)')
+
+
+class MeshError(ValueError):
+    """Raised when a file cannot be read as a triangle mesh"""
+
+
+def is_mesh_file(file):
+    """True for STL/OBJ files, accepts a file name or a FieldFile"""
+    name = getattr(file, 'name', file)
+    return bool(name) and os.path.splitext(name)[1].lower() in MESH_EXTENSIONS
+
+
+def read_mesh(data, name):
+    """Parse STL (binary or ASCII) or OBJ bytes into an (N, 3, 3) float64 array"""
+    extension = os.path.splitext(name)[1].lower()
+    if extension == '.stl':
+        triangles = _read_stl(data)
+    elif extension == '.obj':
+        triangles = _read_obj(data)
+    else:
+        raise MeshError(f"Unsupported mesh format: {extension or name}")
+
+    if not len(triangles):
+        raise MeshError("Mesh contains no triangles")
+    if not np.isfinite(triangles).all():
+        raise MeshError("Mesh contains invalid coordinates")
+    return triangles
+
+
+def face_count(data, name):
+    """
+    Number of triangles read_mesh() would build from STL/OBJ bytes, counted
+    without building them: vertex records for STL, fan triangles for OBJ.
+    """
+    extension = os.path.splitext(name)[1].lower()
+    if extension == '.stl':
+        if len(data) >= 84:
+            count = struct.unpack_from('<I', data, 80)[0]
+            if 84 + count * BINARY_STL_DTYPE.itemsize == len(data):
+                return count
+        return sum(1 for _ in ASCII_STL_VERTEX.finditer(data)) // 3
+    if extension == '.obj':
+        # 'f' plus n indices makes n - 2 triangles
+        return sum(max(len(line.split()) - 3, 0) for line in data.splitlines() if line.startswith(b'f '))
+    return 0
+
+
+def _parse_floats(values):
+    try:
+        return np.array(values, dtype=np.bytes_).astype(np.float64)
+    except ValueError:
+        raise MeshError("Mesh contains invalid coordinates")
+
+
+def _read_stl(data):
+    # Binary STL: 80 byte header, uint32 count, 50 bytes per triangle
+    if len(data) >= 84:
+        count = struct.unpack_from('<I', data, 80)[0]
+        if 84 + count * BINARY_STL_DTYPE.itemsize == len(data):
+            records = np.frombuffer(data, dtype=BINARY_STL_DTYPE, count=count, offset=84)
+            return records['vertices'].astype(np.float64)
+
+    if not data.lstrip()[:5].lower() == b'solid':
+        raise MeshError("Not a valid STL file")
+
+    vertices = ASCII_STL_VERTEX.findall(data)
+    if len(vertices) % 3:
+        raise MeshError("STL file has incomplete facets")
+    return _parse_floats(vertices).reshape(-1, 3, 3)
+
+
+def _read_obj(data):
+    vertices = []
+    faces = []
+    for line in data.splitlines():
+        if line.startswith(b'v '):
+            coords = line.split()[1:4]
+            if len(coords) != 3:
+                raise MeshError("OBJ vertex needs three coordinates")
+            vertices.append(coords)
+        elif line.startswith(b'f '):
+            # Indices are 1-based, negative ones are relative to the last vertex
+            try:
+                indices = [int(token.split(b'/')[0]) for token in line.split()[1:]]
+            except ValueError:
+                raise MeshError("OBJ face has invalid indices")
+            faces.append([i - 1 if i > 0 else len(vertices) + i for i in indices])
+
+    points = _parse_floats(vertices).reshape(-1, 3)
+
+    # Triangulate polygons as fans, one vectorized pass per polygon size
+    triangles = []
+    by_size = {}
+    for face in faces:
+        if len(face) >= 3:
+            by_size.setdefault(len(face), []).append(face)
+    for size, group in by_size.items():
+        group = np.array(group, dtype=np.int64)
+        if group.min() < 0 or group.max() >= len(points):
+            raise MeshError("OBJ face references a missing vertex")
+        for i in range(1, size - 1):
+            triangles.append(group[:, [0, i, i + 1]])
+
+    if not triangles:
+        return np.empty((0, 3, 3))
+    return points[np.concatenate(triangles)]
+
+
+def measure(triangles):
+    """Bounding box, volume, surface area and triangle count of a mesh"""
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    surface_area = 0.5 * np.linalg.norm(np.cross(b - a, c - a), axis=1).sum()
+    # Sum of signed tetrahedra volumes, exact for closed meshes
+    volume = abs(np.einsum('ij,ij->i', a, np.cross(b, c)).sum()) / 6.0
+
+    points = triangles.reshape(-1, 3)
+    lower = points.min(axis=0)
+    upper = points.max(axis=0)
+    return {
+        'triangle_count': int(len(triangles)),
+        'bounding_box': {
+            'min': lower.round(4).tolist(),
+            'max': upper.round(4).tolist(),
+            'size': (upper - lower).round(4).tolist(),
+        },
+        'volume': round(float(volume), 4),
+        'surface_area': round(float(surface_area), 4),
+    }
+
+
+def _cluster(vertices, faces, resolution):
+    """Merge vertices sharing a grid cell and drop collapsed or repeated triangles"""
+    lower = vertices.min(axis=0)
+    extent = float((vertices.max(axis=0) - lower).max()) or 1.0
+    cells = np.floor((vertices - lower) / (extent / resolution)).astype(np.int64)
+    cells = np.minimum(cells, resolution - 1)
+
+    _, cluster, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cluster = cluster.reshape(-1)
+    centers = np.zeros((len(counts), 3))
+    np.add.at(centers, cluster, vertices)
+    centers /= counts[:, None]
+
+    faces = cluster[faces]
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    faces = faces[keep]
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    return centers[faces[np.sort(first)]]
+
+
+def decimate(triangles, max_triangles=PREVIEW_MAX_TRIANGLES):
+    """Vertex-clustering decimation down to at most max_triangles"""
+    if len(triangles) <= max_triangles:
+        return triangles
+
+    vertices, inverse = np.unique(triangles.reshape(-1, 3), axis=0, return_inverse=True)
+    faces = inverse.reshape(-1, 3)
+
+    resolution = 256
+    preview = _cluster(vertices, faces, resolution)
+    while len(preview) > max_triangles and resolution > 2:
+        resolution = max(2, int(resolution * 0.7))
+        preview = _cluster(vertices, faces, resolution)
+    return preview
+
+
+def write_binary_stl(triangles, header=b'rwooga preview'):
+    """Serialize triangles as a binary STL"""
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    normals = np.cross(b - a, c - a)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+    records = np.zeros(len(triangles), dtype=BINARY_STL_DTYPE)
+    records['normal'] = normals
+    records['vertices'] = triangles
+    return header[:80].ljust(80, b'\0') + struct.pack('<I', len(triangles)) + records.tobytes()
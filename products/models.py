@@ -1,12 +1,16 @@
 import uuid
 from django.db import models
+from django.db.models import Avg, Count
+from django.db.models.functions import Upper
 from django.utils import timezone
-from decimal import Decimal
+from decimal import ROUND_HALF_UP, Decimal
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.text import slugify
 from django.core.validators import FileExtensionValidator
+from utils.storage import cached_url, media_storage
 
 
 class ServiceCategory(models.Model):
@@ -72,6 +76,14 @@ class Product(models.Model):
     available_colors = models.CharField(max_length=200, blank=True)
     available_materials = models.CharField(max_length=200, blank=True)
     is_for_sale = models.BooleanField(default=False)  
+    average_rating = models.FloatField(blank=True, null=True, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    thumbnail_url = models.CharField(
+        max_length=500,
+        blank=True,
+        editable=False,
+        help_text="Cached URL of the first media image, see refresh_thumbnail()"
+    )
 
     @property
     def product_volume(self):
@@ -93,7 +105,10 @@ class Product(models.Model):
         super().save(*args, **kwargs)
 
     def get_final_price(self):
+        # Same rule as products.pricing.effective_price(): percentages compound first, then fixed
+        # amounts, rounded to cents
         price = self.unit_price or Decimal("0.00")  
+        fixed = Decimal("0")
 
         for pd in self.product_discounts.select_related("discount"):
             discount = pd.discount
@@ -101,9 +116,43 @@ class Product(models.Model):
                 if discount.discount_type == Discount.PERCENTAGE:
                     price -= price * (discount.discount_value / Decimal("100"))
                 elif discount.discount_type == Discount.FIXED:
-                    price -= discount.discount_value
-
-        return max(price, Decimal("0.00"))
+                    fixed += discount.discount_value
+
+        return max(price - fixed, Decimal("0.00")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+    @classmethod
+    def refresh_ratings(cls, product_ids):
+        """Recompute stored rating aggregates from published feedback, once per product"""
+        product_ids = set(product_ids)
+        if not product_ids:
+            return
+        stats = {
+            row['product_id']: row
+            for row in Feedback.objects.filter(product_id__in=product_ids, published=True)
+            .order_by()
+            .values('product_id')
+            .annotate(average=Avg('rating'), count=Count('id'))
+        }
+        cls.objects.bulk_update(
+            [
+                cls(
+                    pk=pk,
+                    average_rating=stats[pk]['average'] if pk in stats else None,
+                    rating_count=stats[pk]['count'] if pk in stats else 0,
+                )
+                for pk in product_ids
+            ],
+            ['average_rating', 'rating_count'],
+        )
+
+    def refresh_thumbnail(self):
+        """Cache the first media image URL on the product row"""
+        first_media = self.media.first()
+        url = ''
+        if first_media and first_media.image:
+            url = cached_url(first_media.image)
+        Product.objects.filter(pk=self.pk).update(thumbnail_url=url)
+        self.thumbnail_url = url
 
     def __str__(self):
         return self.name
@@ -129,20 +178,42 @@ class ProductMedia(models.Model):
         on_delete=models.CASCADE
     )
 
-    model_3d = models.FileField(upload_to="products/models/", blank=True, null=True)
+    model_3d = models.FileField(upload_to="products/models/", storage=media_storage, blank=True, null=True)
     image = models.ImageField(
         upload_to="products/images/",
+        storage=media_storage,
         blank=True,
         null=True,
         validators=[validate_image_size]
     )
     video_file = models.FileField(
         upload_to="products/videos/",
+        storage=media_storage,
         blank=True,
         null=True,
         validators=[validate_video_size]
     )
     video_url = models.URLField(blank=True)
+    image_width = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    image_height = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    dominant_color = models.CharField(max_length=7, blank=True, editable=False)
+    placeholder = models.TextField(
+        blank=True,
+        editable=False,
+        help_text="Tiny base64 JPEG shown blurred while the image loads"
+    )
+    model_preview = models.FileField(
+        upload_to="products/models/previews/",
+        storage=media_storage,
+        blank=True,
+        null=True,
+        help_text="Decimated copy of the 3D model for the web viewer"
+    )
+    model_metadata = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Bounding box, volume, surface area and triangle count of the 3D model"
+    )
 
     alt_text = models.CharField(max_length=200, blank=True)
     display_order = models.PositiveIntegerField(default=0)
@@ -169,14 +240,35 @@ class Feedback(models.Model):
         related_name="feedbacks",
         on_delete=models.CASCADE
     )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="feedbacks",
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True
+    )
     client_name = models.CharField(max_length=200)
     message = models.TextField()
     rating = models.PositiveIntegerField(
         validators=[MinValueValidator(1), MaxValueValidator(5)]
     )
     published = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "Feedback"
+        verbose_name_plural = "Feedback"
+        indexes = [
+            # Product review tabs: published feedback of one product, newest first
+            models.Index(fields=['product', 'published', '-created_at']),
+            # Public listing and the moderation queue
+            models.Index(fields=['published', 'created_at']),
+            # Duplicate submission check
+            models.Index(fields=['content_hash', 'created_at']),
+        ]
+
     def __str__(self):
         return f"{self.client_name} - {self.product.name}"
 
@@ -201,6 +293,12 @@ class Discount(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Case-insensitive discount code lookup at checkout
+            models.Index(Upper('name'), name='discount_name_upper_idx'),
+        ]
+
     def is_valid(self):
         now = timezone.now()
         return self.is_active and self.start_date <= now <= self.end_date
@@ -229,10 +327,33 @@ class ProductDiscount(models.Model):
 
     def __str__(self):
         return f"{self.product.name} - {self.discount.name}"
+
+
+class Stock(models.Model):
+    """
+    Inventory of a product variant. Products without a stock row are made to
+    order and never run out. Quantities only change through products.inventory.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="stock")
+    variant = models.CharField(max_length=100, blank=True, default="", help_text="e.g. size/color, blank for the plain product")
+    on_hand = models.PositiveIntegerField(default=0, help_text="Units in the workshop, including reserved ones")
+    reserved = models.PositiveIntegerField(default=0, help_text="Units held by orders that haven't shipped")
+    updated_at = models.DateTimeField(auto_now=True)
+
     class Meta:
-        ordering = ['-created_at']
-        verbose_name = "Feedback"
-        verbose_name_plural = "Feedback"
+        constraints = [
+            models.UniqueConstraint(fields=["product", "variant"], name="unique_stock_per_variant"),
+            models.CheckConstraint(condition=models.Q(reserved__lte=models.F("on_hand")), name="stock_reserved_lte_on_hand"),
+        ]
+
+    @property
+    def available(self):
+        return self.on_hand - self.reserved
+
+    def __str__(self):
+        name = f"{self.product.name} ({self.variant})" if self.variant else self.product.name
+        return f"{name}: {self.available} available"
 
 #customer request
 class CustomRequest(models.Model):
@@ -242,6 +363,20 @@ class CustomRequest(models.Model):
         ('COMPLETED', 'Completed'),
         ('CANCELLED', 'Cancelled'),
     ]
+
+    # Reference file intake, see products.tasks.process_reference_file
+    PROCESSING_NONE = 'NONE'
+    PROCESSING_QUEUED = 'QUEUED'
+    PROCESSING_RUNNING = 'PROCESSING'
+    PROCESSING_READY = 'READY'
+    PROCESSING_FAILED = 'FAILED'
+    PROCESSING_STATUS_CHOICES = [
+        (PROCESSING_NONE, 'No file'),
+        (PROCESSING_QUEUED, 'Queued'),
+        (PROCESSING_RUNNING, 'Processing'),
+        (PROCESSING_READY, 'Ready'),
+        (PROCESSING_FAILED, 'Failed'),
+    ]
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     
@@ -264,11 +399,38 @@ class CustomRequest(models.Model):
     
     reference_file = models.FileField(
     upload_to="custom_requests/", 
+    storage=media_storage,
     blank=True, 
     null=True,
     validators=[FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'jpeg', 'png', 'stl', 'obj'])],
     help_text="Upload reference images or sketches"
 )
+    reference_metadata = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Measurements of the reference file when it is a 3D model"
+    )
+    reference_preview = models.FileField(
+        upload_to="custom_requests/previews/",
+        storage=media_storage,
+        blank=True,
+        null=True,
+        editable=False,
+        help_text="Downscaled image or simplified mesh of the reference file"
+    )
+    spooled_file = models.CharField(
+        max_length=255,
+        blank=True,
+        editable=False,
+        help_text="Upload waiting in local spool storage to be pushed to media storage"
+    )
+    processing_status = models.CharField(
+        max_length=20,
+        choices=PROCESSING_STATUS_CHOICES,
+        default=PROCESSING_NONE,
+        editable=False
+    )
+    processing_error = models.CharField(max_length=255, blank=True, editable=False)
     
     budget = models.DecimalField(
         max_digits=10, 
@@ -277,8 +439,29 @@ class CustomRequest(models.Model):
         blank=True,
         help_text="Your approximate budget in RWF"
     )
+
+    material = models.CharField(max_length=50, blank=True, help_text="Material to print with, see QUOTE_MATERIAL_RATES")
+    length = models.DecimalField(max_digits=6, decimal_places=2, validators=[MinValueValidator(0)], blank=True, null=True)
+    width = models.DecimalField(max_digits=6, decimal_places=2, validators=[MinValueValidator(0)], blank=True, null=True)
+    height = models.DecimalField(max_digits=6, decimal_places=2, validators=[MinValueValidator(0)], blank=True, null=True)
+    quote = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        help_text="Instant estimate from the 3D model or the stated dimensions, see products.quotes"
+    )
     
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')    
+    assigned_to = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="assigned_custom_requests",
+        help_text="Staff member working on this request"
+    )
+    assigned_at = models.DateTimeField(null=True, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -286,6 +469,13 @@ class CustomRequest(models.Model):
         ordering = ['-created_at']
         verbose_name = "Custom Request"
         verbose_name_plural = "Custom Requests"
+        indexes = [
+            # Duplicate submission check
+            models.Index(fields=['content_hash', 'created_at']),
+            # Work queue: oldest pending request, optionally of one category
+            models.Index(fields=['status', 'service_category', 'created_at']),
+            models.Index(fields=['status', 'created_at']),
+        ]
 
     def __str__(self):
         return f"{self.client_name} - {self.title}"
@@ -293,23 +483,67 @@ class CustomRequest(models.Model):
 class Wishlist(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="wishlisted_by")
-    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="wishlists")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
-        unique_together = ['user', 'product']  
         ordering = ['-created_at']
         verbose_name = "Wishlist"
         verbose_name_plural = "Wishlists"
+        constraints = [
+            models.UniqueConstraint(fields=['user'], name='unique_wishlist_per_user'),
+        ]
 
     def __str__(self):
-        return f"{self.user.full_name} - {self.product.name}"
+        return f"{self.user.full_name}'s wishlist"
+
+    @staticmethod
+    def cache_key(user_id, version):
+        return f"wishlist:product_ids:{user_id}:{version}"
+
+    @staticmethod
+    def version_key(user_id):
+        return f"wishlist:version:{user_id}"
+
+    @classmethod
+    def cache_version(cls, user_id):
+        key = cls.version_key(user_id)
+        version = cache.get(key)
+        if version is None:
+            # A fresh token, so an evicted version never points back at an old set
+            cache.add(key, uuid.uuid4().hex, None)
+            version = cache.get(key)
+        return version
+
+    @classmethod
+    def product_ids_for(cls, user):
+        """
+        Ids of the products in a user's wishlist, cached until the wishlist changes.
+        The version is read before the items: a set read before a write commits is
+        stored under the version that write replaces, so it is never served.
+        """
+        key = cls.cache_key(user.pk, cls.cache_version(user.pk))
+        product_ids = cache.get(key)
+        if product_ids is None:
+            product_ids = frozenset(
+                WishlistItem.objects.filter(wishlist__user=user).values_list('product_id', flat=True)
+            )
+            cache.set(key, product_ids, settings.WISHLIST_CACHE_TIMEOUT)
+        return product_ids
+
+    @classmethod
+    def invalidate_cache(cls, user_id):
+        """Call after the wishlist change is committed"""
+        cache.set(cls.version_key(user_id), uuid.uuid4().hex, None)
 
 class WishlistItem(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     wishlist = models.ForeignKey(Wishlist, on_delete=models.CASCADE, related_name="items")
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="wishlist_items")
+    price_at_add = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True, editable=False)
+    # Price and sale state the customer was last told about, see send_price_drop_alerts
+    alert_price = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True, editable=False)
+    alert_for_sale = models.BooleanField(default=False, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -320,4 +554,16 @@ class WishlistItem(models.Model):
 
     def __str__(self):
         return f"{self.wishlist.user.full_name} - {self.product.name}"
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.price_at_add is None:
+            from .pricing import current_prices
+            price, for_sale = current_prices([self.product_id])[self.product_id]
+            self.set_price_baseline(price, for_sale)
+        super().save(*args, **kwargs)
+
+    def set_price_baseline(self, price, for_sale):
+        self.price_at_add = price
+        self.alert_price = price
+        self.alert_for_sale = for_sale
     
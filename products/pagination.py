@@ -0,0 +1,20 @@
+from rest_framework.pagination import CursorPagination
+
+
+class FeedbackCursorPagination(CursorPagination):
+    """
+    Keyset paging over feedback: each page continues after the last row
+    of the previous one instead of counting an OFFSET.
+    """
+    page_size = 20
+    ordering = ('-created_at', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        # Ignore the view's ?ordering=, keyset paging relies on a fixed order
+        return self.ordering
+
+
+class ModerationQueuePagination(FeedbackCursorPagination):
+    """Oldest pending feedback first"""
+    page_size = 50
+    ordering = ('created_at', 'id')
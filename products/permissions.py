@@ -64,4 +64,6 @@ class IsOwnerOnly(permissions.BasePermission):
         return request.user and request.user.is_authenticated
     
     def has_object_permission(self, request, view, obj):
-        return obj.user == request.user
\ No newline at end of file
+        # Wishlist items belong to the user of their wishlist
+        owner_id = obj.wishlist.user_id if hasattr(obj, 'wishlist') else obj.user_id
+        return owner_id == request.user.pk
\ No newline at end of file
@@ -0,0 +1,79 @@
+"""
+Effective product prices as SQL expressions, so prices of many products
+can be compared or filtered in one query instead of calling
+Product.get_final_price() per row. Both follow the same rule: active
+percentage discounts compound (10% and 10% take off 19%), then active
+fixed discounts are subtracted, and the result never goes below zero.
+Both are rounded to cents, like the price columns they are stored in and
+compared against, so listings, wishlists and checkout show the same price.
+"""
+from decimal import Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Exp, Greatest, Ln, Round
+from django.utils import timezone
+
+from .models import Discount, Product, ProductDiscount
+
+PRICE_FIELD = DecimalField(max_digits=12, decimal_places=2)
+RATE_FIELD = DecimalField(max_digits=40, decimal_places=30)
+ZERO = Value(Decimal("0.00"), output_field=PRICE_FIELD)
+ONE = Value(Decimal("1"), output_field=RATE_FIELD)
+PERCENT = Value(Decimal("0.01"), output_field=RATE_FIELD)
+# Stands in for the zero left by a 100% discount, where LN() is undefined.
+# Any price times this rounds to 0.00.
+NOTHING_LEFT = Value(Decimal("1E-30"), output_field=RATE_FIELD)
+
+
+def _active_discounts(discount_type, now):
+    return (
+        ProductDiscount.objects.filter(
+            product=OuterRef('pk'),
+            is_valid=True,
+            discount__discount_type=discount_type,
+            discount__is_active=True,
+            discount__start_date__lte=now,
+            discount__end_date__gte=now,
+        )
+        .order_by()
+        .values('product')
+    )
+
+
+def _fixed_total(now):
+    totals = _active_discounts(Discount.FIXED, now).annotate(total=Sum('discount__discount_value')).values('total')
+    return Coalesce(Subquery(totals, output_field=PRICE_FIELD), ZERO)
+
+
+def _percentage_factor(now):
+    """Share of the price left after all percentage discounts, the product of (1 - p/100)"""
+    remaining = Greatest(ONE - F('discount__discount_value') * PERCENT, NOTHING_LEFT, output_field=RATE_FIELD)
+    factors = (
+        _active_discounts(Discount.PERCENTAGE, now)
+        .annotate(factor=Exp(Sum(Ln(remaining))))
+        .values('factor')
+    )
+    return Coalesce(Subquery(factors, output_field=RATE_FIELD), ONE)
+
+
+def effective_price():
+    """Expression for Product querysets: Product.objects.annotate(price=effective_price())"""
+    now = timezone.now()
+    price = Coalesce(F('unit_price'), ZERO) * _percentage_factor(now) - _fixed_total(now)
+    return ExpressionWrapper(Round(Greatest(price, ZERO), 2), output_field=PRICE_FIELD)
+
+
+def related_effective_price(product_field='product'):
+    """Effective price of the product referenced by `product_field` on another model"""
+    products = Product.objects.filter(pk=OuterRef(product_field)).annotate(price=effective_price())
+    return Subquery(products.values('price')[:1], output_field=PRICE_FIELD)
+
+
+def current_prices(product_ids):
+    """{product_id: (effective price, is_for_sale)} in one query"""
+    rows = (
+        Product.objects.filter(pk__in=product_ids)
+        .annotate(price=effective_price())
+        .values_list('pk', 'price', 'is_for_sale')
+    )
+    return {pk: (price, is_for_sale) for pk, price, is_for_sale in rows}
@@ -0,0 +1,133 @@
+"""
+Instant price estimates for custom 3D print requests.
+Works from mesh measurements (products.mesh.measure) or from stated
+dimensions, with per-material rates from settings.QUOTE_MATERIAL_RATES.
+"""
+import math
+
+from django.conf import settings
+
+from .mesh import face_count, is_mesh_file, measure, read_mesh
+from .models import CustomRequest
+
+# Slicer assumptions used for every estimate
+WALL_THICKNESS_CM = 0.12
+INFILL_RATIO = 0.2
+LAYER_HEIGHT_CM = 0.02
+SECONDS_PER_LAYER = 4
+# Share of a bounding box a typical printed object fills
+BOUNDING_BOX_FILL = 0.5
+# STL/OBJ exports are in millimetres
+MM3_PER_CM3 = 1000
+MM2_PER_CM2 = 100
+MM_PER_CM = 10
+
+
+class QuoteError(ValueError):
+    """Raised when a request does not contain enough information to quote"""
+
+
+def resolve_material(material, service_category=None):
+    """Requested material, or the default one when the category doesn't ask for it"""
+    if material:
+        if material not in settings.QUOTE_MATERIAL_RATES:
+            raise QuoteError(f"Unknown material: {material}")
+        return material
+    if service_category is not None and service_category.requires_material:
+        raise QuoteError("This service requires a material")
+    return settings.QUOTE_DEFAULT_MATERIAL
+
+
+def estimate(volume_cm3, surface_area_cm2, height_cm, material, basis):
+    """Price breakdown for printing a part of the given volume, surface and height"""
+    rates = settings.QUOTE_MATERIAL_RATES[material]
+
+    # Solid walls plus sparse infill inside them
+    shell_cm3 = min(surface_area_cm2 * WALL_THICKNESS_CM, volume_cm3)
+    material_cm3 = shell_cm3 + INFILL_RATIO * (volume_cm3 - shell_cm3)
+    weight_g = material_cm3 * rates['density']
+
+    layers = math.ceil(height_cm / LAYER_HEIGHT_CM)
+    print_hours = material_cm3 / rates['print_speed'] + layers * SECONDS_PER_LAYER / 3600
+
+    # Whole RWF, so the breakdown adds up to the total
+    material_cost = round(weight_g * rates['price_per_gram'])
+    machine_cost = round(print_hours * settings.QUOTE_MACHINE_HOURLY_RATE)
+
+    return {
+        'basis': basis,
+        'material': material,
+        'volume_cm3': round(volume_cm3, 2),
+        'material_cm3': round(material_cm3, 2),
+        'weight_g': round(weight_g, 1),
+        'print_hours': round(print_hours, 2),
+        'setup_fee': settings.QUOTE_SETUP_FEE,
+        'material_cost': material_cost,
+        'machine_cost': machine_cost,
+        'total': settings.QUOTE_SETUP_FEE + material_cost + machine_cost,
+        'currency': 'RWF',
+    }
+
+
+def estimate_from_mesh(stats, material):
+    """Quote from products.mesh.measure() output (millimetres)"""
+    return estimate(
+        stats['volume'] / MM3_PER_CM3,
+        stats['surface_area'] / MM2_PER_CM2,
+        stats['bounding_box']['size'][2] / MM_PER_CM,
+        material,
+        basis='mesh',
+    )
+
+
+def estimate_from_dimensions(length, width, height, material):
+    """Quote from stated outer dimensions in centimetres"""
+    length, width, height = float(length), float(width), float(height)
+    return estimate(
+        length * width * height * BOUNDING_BOX_FILL,
+        2 * (length * width + length * height + width * height),
+        height,
+        material,
+        basis='dimensions',
+    )
+
+
+def estimate_upload(upload, material):
+    """Quote an uploaded STL/OBJ file"""
+    if not is_mesh_file(upload):
+        raise QuoteError("Only STL and OBJ files can be quoted")
+    upload.seek(0)
+    data = upload.read()
+    upload.seek(0)
+    too_many = QuoteError(f"Models with more than {settings.QUOTE_MAX_FACES} faces can't be quoted instantly")
+    if face_count(data, upload.name) > settings.QUOTE_MAX_FACES:
+        raise too_many
+    triangles = read_mesh(data, upload.name)
+    # The parser has the last word on the count
+    if len(triangles) > settings.QUOTE_MAX_FACES:
+        raise too_many
+    stats = measure(triangles)
+    return estimate_from_mesh(stats, material)
+
+
+def quote_custom_request(custom_request):
+    """
+    Quote a custom request from its measured 3D model, else from its stated
+    dimensions, and store it on the request. Returns {} when neither is known.
+    """
+    try:
+        material = resolve_material(custom_request.material, custom_request.service_category)
+        if custom_request.reference_metadata.get('volume'):
+            quote = estimate_from_mesh(custom_request.reference_metadata, material)
+        elif custom_request.length and custom_request.width and custom_request.height:
+            quote = estimate_from_dimensions(
+                custom_request.length, custom_request.width, custom_request.height, material
+            )
+        else:
+            quote = {}
+    except QuoteError:
+        quote = {}
+
+    CustomRequest.objects.filter(pk=custom_request.pk).update(quote=quote)
+    custom_request.quote = quote
+    return quote
@@ -1,5 +1,37 @@
+import os
+from django.conf import settings
+from django.db import models
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
-from .models import CustomRequest, ServiceCategory, Product, ProductMedia, Feedback, Wishlist, WishlistItem, Discount, ProductDiscount
+from utils.storage import IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, cached_url, file_digest
+from utils.throttling import is_duplicate_submission, submission_fingerprint
+from .mesh import MESH_EXTENSIONS
+from .models import (
+    CustomRequest, ServiceCategory, Product, ProductMedia, Feedback, Wishlist, WishlistItem, Discount, ProductDiscount,
+    validate_image_size, validate_video_size,
+)
+from .pricing import current_prices
+
+
+class CachedURLMixin:
+    """Resolve file URLs through the per-process URL cache instead of the storage SDK"""
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        url = cached_url(value)
+        request = self.context.get('request', None)
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+
+class CachedURLFileField(CachedURLMixin, serializers.FileField):
+    pass
+
+
+class CachedURLImageField(CachedURLMixin, serializers.ImageField):
+    pass
 
 
 
@@ -26,6 +58,12 @@ class ServiceCategorySerializer(serializers.ModelSerializer):
 
 
 class ProductMediaSerializer(serializers.ModelSerializer):
+    serializer_field_mapping = {
+        **serializers.ModelSerializer.serializer_field_mapping,
+        models.FileField: CachedURLFileField,
+        models.ImageField: CachedURLImageField,
+    }
+
     class Meta:
         model = ProductMedia
         fields = [
@@ -35,11 +73,64 @@ class ProductMediaSerializer(serializers.ModelSerializer):
             "image",
             "video_file",
             "video_url",
+            "image_width",
+            "image_height",
+            "dominant_color",
+            "placeholder",
+            "model_preview",
+            "model_metadata",
             "alt_text",
             "display_order",
             "uploaded_at",
         ]
-        read_only_fields = ["id", "uploaded_at"]
+        read_only_fields = [
+            "id",
+            "image_width",
+            "image_height",
+            "dominant_color",
+            "placeholder",
+            "model_preview",
+            "model_metadata",
+            "uploaded_at",
+        ]
+
+
+class ProductMediaReorderSerializer(serializers.Serializer):
+    product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all())
+    media = serializers.ListField(child=serializers.UUIDField(), allow_empty=False)
+
+    def validate_media(self, value):
+        if len(set(value)) != len(value):
+            raise serializers.ValidationError("Media ids must not repeat.")
+        return value
+
+
+class ProductMediaBulkUploadSerializer(serializers.Serializer):
+    MAX_FILES = 20
+
+    product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all())
+    files = serializers.ListField(child=serializers.FileField(), allow_empty=False, max_length=MAX_FILES)
+    alt_text = serializers.CharField(max_length=200, required=False, allow_blank=True)
+
+    def validate_files(self, value):
+        """Pair each file with the ProductMedia field it belongs in"""
+        files = []
+        for file in value:
+            extension = os.path.splitext(file.name)[1].lower()
+            try:
+                if extension in IMAGE_EXTENSIONS:
+                    validate_image_size(file)
+                    files.append(('image', file))
+                elif extension in VIDEO_EXTENSIONS:
+                    validate_video_size(file)
+                    files.append(('video_file', file))
+                elif extension in MESH_EXTENSIONS:
+                    files.append(('model_3d', file))
+                else:
+                    raise serializers.ValidationError(f"Unsupported file type: {file.name}")
+            except DjangoValidationError as e:
+                raise serializers.ValidationError(f"{file.name}: {e.messages[0]}")
+        return files
 
 
 class ProductSerializer(serializers.ModelSerializer):
@@ -136,19 +227,7 @@ class ProductSerializer(serializers.ModelSerializer):
         return data
     
     def get_final_price(self, obj):
-        """
-        Calculate final price with discount if available.
-        """
-        # Try to get the active discount for the product
-        active_discounts = obj.product_discounts.filter(is_valid=True)
-        if active_discounts.exists():
-            discount = active_discounts.first().discount
-            if discount.discount_type == 'percentage':
-                return obj.unit_price * (1 - discount.discount_value / 100)
-            elif discount.discount_type == 'fixed':
-                return max(obj.unit_price - discount.discount_value, 0)
-        # No discount
-        return obj.unit_price
+        return obj.get_final_price()
 
 
 class FeedbackSerializer(serializers.ModelSerializer):
@@ -170,6 +249,35 @@ class FeedbackSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['id', 'published', 'created_at','user']
 
+    def validate(self, data):
+        if self.instance is None:
+            request = self.context.get('request')
+            user = request.user if request and request.user.is_authenticated else None
+            fingerprint = submission_fingerprint(
+                data['product'].pk, getattr(user, 'pk', ''), data['client_name'], data['message'], data['rating']
+            )
+            if is_duplicate_submission(Feedback, fingerprint):
+                raise serializers.ValidationError("This feedback has already been submitted.")
+            data['content_hash'] = fingerprint
+        return data
+
+
+class ProductFeedbackSerializer(serializers.ModelSerializer):
+    """Columns used by the product review widget"""
+    product_name = serializers.ReadOnlyField(source='product.name')
+
+    class Meta:
+        model = Feedback
+        fields = ['id', 'product_name', 'client_name', 'message', 'rating', 'created_at']
+        read_only_fields = fields
+
+
+class FeedbackBulkModerateSerializer(serializers.Serializer):
+    MAX_IDS = 500
+
+    ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False, max_length=MAX_IDS)
+    published = serializers.BooleanField()
+
 
 class ProductListSerializer(serializers.ModelSerializer):
     """serializer for product lists"""
@@ -177,17 +285,19 @@ class ProductListSerializer(serializers.ModelSerializer):
     average_rating = serializers.FloatField(read_only=True)
     thumbnail = serializers.SerializerMethodField()
     final_price = serializers.SerializerMethodField()
+    in_wishlist = serializers.SerializerMethodField()
     class Meta:
         model = Product
         fields = ['id', 'name', 'short_description', 'unit_price',
                   'currency', 'published', 'category_name',
-                  'average_rating', 'thumbnail', 'final_price', 'is_for_sale']
+                  'average_rating', 'thumbnail', 'final_price', 'is_for_sale', 'in_wishlist']
  
     def get_thumbnail(self, obj) -> str:
-        first_media = obj.media.first()
-        if first_media and first_media.image:
-            return first_media.image.url
-        return None
+        return obj.thumbnail_url or None
+
+    def get_in_wishlist(self, obj) -> bool:
+        # Filled once per page by ProductViewSet.get_serializer_context
+        return obj.pk in self.context.get('wishlisted_ids', ())
     def get_final_price(self, obj):
         return obj.get_final_price()
 class CustomRequestSerializer(serializers.ModelSerializer):
@@ -204,15 +314,37 @@ class CustomRequestSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'client_name', 'client_email', 'client_phone',
             'service_category', 'service_category_name', 'title', 
-            'description', 'reference_file', 'budget', 'status',
-            'created_at', 'updated_at'
+            'description', 'reference_file', 'reference_preview', 'reference_metadata',
+            'processing_status', 'processing_error', 'material', 'length', 'width', 'height',
+            'quote', 'budget', 'status', 'assigned_to', 'assigned_at', 'created_at', 'updated_at'
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        read_only_fields = [
+            'id', 'reference_preview', 'reference_metadata', 'processing_status',
+            'processing_error', 'quote', 'assigned_to', 'assigned_at', 'created_at', 'updated_at'
+        ]
+
+    def validate_material(self, value):
+        if value and value not in settings.QUOTE_MATERIAL_RATES:
+            raise serializers.ValidationError(f"Choose one of: {', '.join(settings.QUOTE_MATERIAL_RATES)}")
+        return value
 
     def validate_status(self, value):
         if value not in ['PENDING', 'IN_PROGRESS', 'COMPLETED', 'CANCELLED']:
             raise serializers.ValidationError("Invalid status")
         return value
+
+    def validate(self, data):
+        if self.instance is None:
+            reference_file = data.get('reference_file')
+            fingerprint = submission_fingerprint(
+                data['client_email'], data['title'], data['description'],
+                file_digest(reference_file) if reference_file else '',
+            )
+            if is_duplicate_submission(CustomRequest, fingerprint):
+                raise serializers.ValidationError("This request has already been submitted.")
+            data['content_hash'] = fingerprint
+        return data
+
     def update(self, instance, validated_data):
         request = self.context.get('request')
         if request and request.user and request.user.is_staff:
@@ -228,11 +360,45 @@ class CustomRequestSerializer(serializers.ModelSerializer):
         instance.description = validated_data.get('description', instance.description)
         instance.reference_file = validated_data.get('reference_file', instance.reference_file)
         instance.budget = validated_data.get('budget', instance.budget)
+        instance.material = validated_data.get('material', instance.material)
+        instance.length = validated_data.get('length', instance.length)
+        instance.width = validated_data.get('width', instance.width)
+        instance.height = validated_data.get('height', instance.height)
 
         instance.save()
         return instance
 
 
+class CustomRequestClaimSerializer(serializers.Serializer):
+    service_category = serializers.PrimaryKeyRelatedField(
+        queryset=ServiceCategory.objects.all(), required=False, allow_null=True
+    )
+
+
+class QuoteEstimateSerializer(serializers.Serializer):
+    """Either an STL/OBJ file or the outer dimensions in centimetres"""
+    service_category = serializers.PrimaryKeyRelatedField(
+        queryset=ServiceCategory.objects.all(), required=False, allow_null=True
+    )
+    material = serializers.ChoiceField(choices=list(settings.QUOTE_MATERIAL_RATES), required=False, allow_blank=True)
+    reference_file = serializers.FileField(required=False)
+    length = serializers.DecimalField(max_digits=6, decimal_places=2, min_value=0, required=False)
+    width = serializers.DecimalField(max_digits=6, decimal_places=2, min_value=0, required=False)
+    height = serializers.DecimalField(max_digits=6, decimal_places=2, min_value=0, required=False)
+
+    def validate_reference_file(self, value):
+        limit_mb = settings.QUOTE_MAX_UPLOAD_MB
+        if value.size > limit_mb * 1024 * 1024:
+            raise serializers.ValidationError(f"Max file size for instant quotes is {limit_mb}MB")
+        return value
+
+    def validate(self, data):
+        dimensions = [data.get(name) for name in ('length', 'width', 'height')]
+        if not data.get('reference_file') and not all(dimensions):
+            raise serializers.ValidationError("Upload an STL/OBJ file or give length, width and height.")
+        return data
+
+
 class WishlistItemSerializer(serializers.ModelSerializer):
     product_name = serializers.ReadOnlyField(source='product.name')
     product_price = serializers.ReadOnlyField(source='product.unit_price')
@@ -249,10 +415,22 @@ class WishlistItemSerializer(serializers.ModelSerializer):
     
    
     def get_product_thumbnail(self, obj) -> str:
-        first_media = obj.product.media.first()
-        if first_media and first_media.image:
-            return first_media.image.url
-        return None
+        return obj.product.thumbnail_url or None
+
+
+class WishlistSyncSerializer(serializers.Serializer):
+    MAX_PRODUCTS = 500
+
+    products = serializers.ListField(child=serializers.UUIDField(), allow_empty=True, max_length=MAX_PRODUCTS)
+
+    def validate_products(self, value):
+        """{product_id: (effective price, is_for_sale)}, the prices become the new items' baselines"""
+        product_ids = set(value)
+        prices = current_prices(product_ids)
+        missing = product_ids - prices.keys()
+        if missing:
+            raise serializers.ValidationError(f"Unknown products: {', '.join(sorted(map(str, missing)))}")
+        return prices
 
 
 class WishlistSerializer(serializers.ModelSerializer):
@@ -267,19 +445,6 @@ class WishlistSerializer(serializers.ModelSerializer):
             'items', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'user', 'created_at', 'updated_at']    
-    def get_final_price(self, obj):
-        """
-        Calculate final price with discount if available.
-        """
-        active_discounts = obj.product_discounts.filter(is_valid=True)
-        if active_discounts.exists():
-            discount = active_discounts.first().discount
-            if discount.discount_type == 'percentage':
-                return obj.unit_price * (1 - discount.discount_value / 100)
-            elif discount.discount_type == 'fixed':
-                return max(obj.unit_price - discount.discount_value, 0)
-        # No discount
-        return obj.unit_price
 
 
 class DiscountSerializer(serializers.ModelSerializer):
@@ -0,0 +1,188 @@
+"""
+Background processing of uploaded media.
+Scheduled with utils.background.run_in_background from the views.
+"""
+import logging
+import os
+from decimal import Decimal
+
+from django.core.files.base import ContentFile, File
+from django.db import transaction
+from django.utils import timezone
+
+from PIL import UnidentifiedImageError
+
+from utils.storage import IMAGE_EXTENSIONS, spool_storage
+
+from .imaging import image_metadata, preview_image
+from .mesh import MeshError, decimate, is_mesh_file, measure, read_mesh, write_binary_stl
+from .models import CustomRequest, Product, ProductMedia
+from .quotes import quote_custom_request
+
+logger = logging.getLogger(__name__)
+
+# STL/OBJ exports are in millimetres, product dimensions are in centimetres
+MESH_UNITS_PER_CM = Decimal("10")
+
+
+def _load_triangles(field_file):
+    with field_file.open('rb') as f:
+        data = f.read()
+    return read_mesh(data, field_file.name)
+
+
+def fill_product_dimensions(product, stats):
+    """
+    Fill length/width/height from the model's bounding box for categories
+    that require dimensions. Values typed in by staff are never overwritten.
+    """
+    if not product.category.requires_dimensions:
+        return False
+
+    length, width, height = (
+        (Decimal(str(size)) / MESH_UNITS_PER_CM).quantize(Decimal("0.01"))
+        for size in stats['bounding_box']['size']
+    )
+    updated = Product.objects.filter(
+        pk=product.pk,
+        length__isnull=True,
+        width__isnull=True,
+        height__isnull=True,
+    ).update(length=length, width=width, height=height)
+    return bool(updated)
+
+
+def analyze_product_media(media_id):
+    """Measure a product's 3D model, store a preview mesh and fill product dimensions"""
+    media = ProductMedia.objects.select_related('product__category').filter(pk=media_id).first()
+    if not media or not is_mesh_file(media.model_3d):
+        return
+
+    try:
+        triangles = _load_triangles(media.model_3d)
+    except MeshError as e:
+        logger.warning(f"Could not analyze 3D model of media {media_id}: {str(e)}")
+        return
+
+    stats = measure(triangles)
+    preview = decimate(triangles)
+    stats['preview_triangle_count'] = int(len(preview))
+
+    stem = os.path.splitext(os.path.basename(media.model_3d.name))[0]
+    media.model_preview.save(f"{stem}-preview.stl", ContentFile(write_binary_stl(preview)), save=False)
+    ProductMedia.objects.filter(pk=media.pk).update(
+        model_metadata=stats,
+        model_preview=media.model_preview.name,
+    )
+    fill_product_dimensions(media.product, stats)
+
+
+def extract_image_metadata(media_id):
+    """Store dimensions, dominant color and placeholder of a media image"""
+    media = ProductMedia.objects.filter(pk=media_id).first()
+    if not media or not media.image:
+        return
+
+    try:
+        with media.image.open('rb') as f:
+            metadata = image_metadata(f)
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Could not read image of media {media_id}: {str(e)}")
+        return
+
+    ProductMedia.objects.filter(pk=media_id).update(**metadata)
+
+
+def spool_reference_file(custom_request, upload):
+    """
+    Write a custom request upload to local spool storage and mark it queued.
+    The view schedules process_reference_file once the request is saved.
+    """
+    spool = spool_storage()
+    name = spool.save(f"custom_requests/{custom_request.pk}/{os.path.basename(upload.name)}", upload)
+    with transaction.atomic():
+        # Locked so a worker can't claim the previous upload between the read and the swap
+        previous, status = (
+            CustomRequest.objects.select_for_update()
+            .filter(pk=custom_request.pk)
+            .values_list('spooled_file', 'processing_status')
+            .get()
+        )
+        CustomRequest.objects.filter(pk=custom_request.pk).update(
+            spooled_file=name,
+            processing_status=CustomRequest.PROCESSING_QUEUED,
+            processing_error='',
+            updated_at=timezone.now(),
+        )
+    # A running worker is still reading the previous upload, it deletes it once done
+    if previous and previous != name and status != CustomRequest.PROCESSING_RUNNING:
+        spool.delete(previous)
+    custom_request.spooled_file = name
+    custom_request.processing_status = CustomRequest.PROCESSING_QUEUED
+    custom_request.processing_error = ''
+
+
+def _reference_preview(spool, name):
+    """Measurements, preview name and preview bytes of a spooled reference file"""
+    stem, extension = os.path.splitext(os.path.basename(name))
+    try:
+        if is_mesh_file(name):
+            with spool.open(name, 'rb') as f:
+                triangles = read_mesh(f.read(), name)
+            metadata = measure(triangles)
+            preview = decimate(triangles)
+            metadata['preview_triangle_count'] = int(len(preview))
+            return metadata, f"{stem}-preview.stl", write_binary_stl(preview)
+        if extension.lower() in IMAGE_EXTENSIONS:
+            with spool.open(name, 'rb') as f:
+                return {}, f"{stem}-preview.jpg", preview_image(f)
+    except (MeshError, UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Could not preview reference file {name}: {str(e)}")
+    return {}, None, None
+
+
+def process_reference_file(request_id):
+    """
+    Push a spooled custom request upload to media storage, measure it,
+    store its preview and delete the spool copy.
+    """
+    claimed = CustomRequest.objects.filter(
+        pk=request_id,
+        processing_status=CustomRequest.PROCESSING_QUEUED,
+    ).update(processing_status=CustomRequest.PROCESSING_RUNNING, updated_at=timezone.now())
+    if not claimed:
+        return
+
+    custom_request = CustomRequest.objects.get(pk=request_id)
+    spooled_name = custom_request.spooled_file
+    spool = spool_storage()
+    try:
+        with spool.open(spooled_name, 'rb') as f:
+            custom_request.reference_file.save(os.path.basename(spooled_name), File(f), save=False)
+        metadata, preview_name, preview = _reference_preview(spool, spooled_name)
+        if preview:
+            custom_request.reference_preview.save(preview_name, ContentFile(preview), save=False)
+    except Exception as e:
+        logger.error(f"Failed to process reference file of request {request_id}. Error: {str(e)}")
+        failed = CustomRequest.objects.filter(pk=request_id, spooled_file=spooled_name).update(
+            processing_status=CustomRequest.PROCESSING_FAILED,
+            processing_error=str(e)[:255],
+            updated_at=timezone.now(),
+        )
+        if not failed:
+            # Replaced by a newer upload meanwhile, nothing will retry this one
+            spool.delete(spooled_name)
+        return
+
+    # A newer upload may have replaced this one meanwhile, it is queued on its own
+    CustomRequest.objects.filter(pk=request_id, spooled_file=spooled_name).update(
+        reference_file=custom_request.reference_file.name,
+        reference_preview=custom_request.reference_preview.name or None,
+        reference_metadata=metadata,
+        processing_status=CustomRequest.PROCESSING_READY,
+        processing_error='',
+        spooled_file='',
+        updated_at=timezone.now(),
+    )
+    spool.delete(spooled_name)
+    quote_custom_request(CustomRequest.objects.get(pk=request_id))
@@ -1,14 +1,55 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.contrib.admin.sites import site as admin_site
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from decimal import Decimal
 from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest.mock import Mock, call, patch
+from rest_framework.test import APIClient
+import numpy as np
+from PIL import Image
 
+from accounts.models import User
 from products.models import (
     ServiceCategory,
     Product,
+    ProductMedia,
+    Feedback,
+    CustomRequest,
+    Wishlist,
+    WishlistItem,
     Discount,
-    ProductDiscount
+    ProductDiscount,
+    Stock,
 )
+from products.admin import CustomRequestAdmin, ProductAdmin, ProductMediaAdmin
+from products.imaging import image_metadata
+from products.mesh import MeshError, decimate, face_count, measure, read_mesh, write_binary_stl
+from products.pricing import effective_price
+from products.quotes import QuoteError, estimate_from_dimensions, estimate_from_mesh, resolve_material
+from products.serializers import ProductListSerializer
+from products import tasks
+from products.tasks import (
+    analyze_product_media, extract_image_metadata, fill_product_dimensions, process_reference_file, spool_reference_file,
+)
+from utils.storage import ContentAddressedFileSystemStorage, cached_url
+from utils.throttling import get_limiter
+
+# Query counts in the wishlist tests are about model queries, keep database cache reads out of them
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "tests"},
+    "throttle": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "tests-throttle"},
+}
 
 
 class DiscountModelTest(TestCase):
@@ -91,3 +132,1092 @@ class ProductPricingTest(TestCase):
 
         final_price = self.product.get_final_price()
         self.assertEqual(final_price, Decimal("0.00"))
+
+
+CUBE_TRIANGLES = np.array([
+    [[0, 0, 0], [0, 1, 0], [1, 1, 0]], [[0, 0, 0], [1, 1, 0], [1, 0, 0]],
+    [[0, 0, 1], [1, 0, 1], [1, 1, 1]], [[0, 0, 1], [1, 1, 1], [0, 1, 1]],
+    [[0, 0, 0], [1, 0, 0], [1, 0, 1]], [[0, 0, 0], [1, 0, 1], [0, 0, 1]],
+    [[0, 1, 0], [0, 1, 1], [1, 1, 1]], [[0, 1, 0], [1, 1, 1], [1, 1, 0]],
+    [[0, 0, 0], [0, 0, 1], [0, 1, 1]], [[0, 0, 0], [0, 1, 1], [0, 1, 0]],
+    [[1, 0, 0], [1, 1, 0], [1, 1, 1]], [[1, 0, 0], [1, 1, 1], [1, 0, 1]],
+], dtype=float) * 20
+
+
+class MeshAnalysisTest(TestCase):
+
+    def assert_cube_stats(self, stats):
+        self.assertEqual(stats['triangle_count'], 12)
+        self.assertEqual(stats['bounding_box']['size'], [20.0, 20.0, 20.0])
+        self.assertAlmostEqual(stats['volume'], 8000.0)
+        self.assertAlmostEqual(stats['surface_area'], 2400.0)
+
+    def test_binary_stl(self):
+        data = write_binary_stl(CUBE_TRIANGLES)
+        self.assert_cube_stats(measure(read_mesh(data, "cube.stl")))
+        self.assertEqual(face_count(data, "cube.stl"), 12)
+
+    def test_ascii_stl(self):
+        facets = "".join(
+            "facet normal 0 0 0\nouter loop\n"
+            + "".join("vertex %f %f %f\n" % tuple(v) for v in triangle)
+            + "endloop\nendfacet\n"
+            for triangle in CUBE_TRIANGLES
+        )
+        data = ("solid cube\n" + facets + "endsolid cube\n").encode()
+        self.assert_cube_stats(measure(read_mesh(data, "cube.STL")))
+        self.assertEqual(face_count(data, "cube.STL"), 12)
+
+    def test_obj_with_quads_and_negative_indices(self):
+        data = b"\n".join([
+            b"v 0 0 0", b"v 20 0 0", b"v 20 20 0", b"v 0 20 0",
+            b"v 0 0 20", b"v 20 0 20", b"v 20 20 20", b"v 0 20 20",
+            b"f 1 4 3 2", b"f 5 6 7 8", b"f 1/1 2/1 6/1 5/1",
+            b"f 4 8 7 3", b"f 1 5 8 4", b"f -7 -6 -2 -3",
+        ])
+        self.assert_cube_stats(measure(read_mesh(data, "cube.obj")))
+        self.assertEqual(face_count(data, "cube.obj"), 12)
+
+    def test_invalid_file_is_rejected(self):
+        with self.assertRaises(MeshError):
+            read_mesh(b"not a mesh", "broken.stl")
+
+    def test_decimate_reduces_dense_mesh(self):
+        # 100x100 grid of quads on a 10x10 plane: 20000 triangles
+        xs, ys = np.meshgrid(np.linspace(0, 10, 101), np.linspace(0, 10, 101))
+        grid = np.stack([xs, ys, np.zeros_like(xs)], axis=-1)
+        a, b, c, d = grid[:-1, :-1], grid[:-1, 1:], grid[1:, 1:], grid[1:, :-1]
+        triangles = np.concatenate([
+            np.stack([a, b, c], axis=-2).reshape(-1, 3, 3),
+            np.stack([a, c, d], axis=-2).reshape(-1, 3, 3),
+        ])
+
+        preview = decimate(triangles, max_triangles=2000)
+
+        self.assertLessEqual(len(preview), 2000)
+        self.assertGreater(len(preview), 0)
+        self.assertAlmostEqual(measure(preview)['surface_area'], 100.0, delta=10.0)
+
+
+class ProductDimensionFillTest(TestCase):
+
+    def setUp(self):
+        self.stats = measure(CUBE_TRIANGLES)
+        self.category = ServiceCategory.objects.create(name="3D Printing", requires_dimensions=True)
+
+    def test_dimensions_filled_from_model(self):
+        product = Product.objects.create(category=self.category, name="Vase", short_description="Vase")
+
+        self.assertTrue(fill_product_dimensions(product, self.stats))
+        product.refresh_from_db()
+        self.assertEqual(product.length, Decimal("2.00"))
+        self.assertEqual(product.height, Decimal("2.00"))
+
+    def test_manual_dimensions_are_kept(self):
+        product = Product.objects.create(
+            category=self.category, name="Vase", short_description="Vase",
+            length=Decimal("5"), width=Decimal("5"), height=Decimal("5"),
+        )
+
+        self.assertFalse(fill_product_dimensions(product, self.stats))
+        product.refresh_from_db()
+        self.assertEqual(product.length, Decimal("5.00"))
+
+    def test_category_without_dimensions_is_skipped(self):
+        category = ServiceCategory.objects.create(name="Design")
+        product = Product.objects.create(category=category, name="Logo", short_description="Logo")
+
+        self.assertFalse(fill_product_dimensions(product, self.stats))
+
+
+class CachedMediaURLTest(TestCase):
+
+    def setUp(self):
+        self.category = ServiceCategory.objects.create(name="Decor")
+        self.product = Product.objects.create(category=self.category, name="Lamp", short_description="Lamp")
+
+    def test_url_resolved_once_per_name(self):
+        storage = Mock()
+        storage.url.side_effect = lambda name: f"https://cdn.example.com/{name}"
+        image = Mock(storage=storage, __bool__=lambda self: True)
+        image.name = "products/images/ab/ab12.jpg"
+
+        self.assertEqual(cached_url(image), "https://cdn.example.com/products/images/ab/ab12.jpg")
+        self.assertEqual(cached_url(image), "https://cdn.example.com/products/images/ab/ab12.jpg")
+        storage.url.assert_called_once()
+
+        image.name = "products/images/cd/cd34.jpg"
+        self.assertEqual(cached_url(image), "https://cdn.example.com/products/images/cd/cd34.jpg")
+        self.assertEqual(storage.url.call_count, 2)
+
+    def test_list_thumbnail_comes_from_product_row(self):
+        self.product.thumbnail_url = "https://cdn.example.com/lamp.jpg"
+        self.product.save()
+
+        with self.assertNumQueries(0):
+            thumbnail = ProductListSerializer().get_thumbnail(self.product)
+        self.assertEqual(thumbnail, "https://cdn.example.com/lamp.jpg")
+
+    def test_refresh_thumbnail_without_media_clears_it(self):
+        Product.objects.filter(pk=self.product.pk).update(thumbnail_url="https://cdn.example.com/old.jpg")
+
+        self.product.refresh_thumbnail()
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.thumbnail_url, "")
+
+
+class ImageMetadataTest(TestCase):
+
+    def make_image(self, size, color, fmt='JPEG', exif=None):
+        buffer = BytesIO()
+        image = Image.new('RGB', size, color)
+        if exif:
+            image.save(buffer, format=fmt, exif=exif)
+        else:
+            image.save(buffer, format=fmt)
+        buffer.seek(0)
+        return buffer
+
+    def test_dimensions_color_and_placeholder(self):
+        metadata = image_metadata(self.make_image((640, 480), (200, 30, 30)))
+
+        self.assertEqual(metadata['image_width'], 640)
+        self.assertEqual(metadata['image_height'], 480)
+        self.assertEqual(len(metadata['dominant_color']), 7)
+        red, green = int(metadata['dominant_color'][1:3], 16), int(metadata['dominant_color'][3:5], 16)
+        self.assertGreater(red, 150)
+        self.assertLess(green, 80)
+        self.assertTrue(metadata['placeholder'].startswith("data:image/jpeg;base64,"))
+        self.assertLess(len(metadata['placeholder']), 2000)
+
+    def test_rotated_photo_reports_display_dimensions(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        metadata = image_metadata(self.make_image((640, 480), (0, 0, 255), exif=exif))
+
+        self.assertEqual((metadata['image_width'], metadata['image_height']), (480, 640))
+
+
+class ProductMediaBatchTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email="staff@example.com", full_name="Staff", phone_number="0780000001", password="pass12345",
+            is_staff=True,
+        )
+        self.client.force_authenticate(self.user)
+        self.category = ServiceCategory.objects.create(name="Prints")
+        self.product = Product.objects.create(category=self.category, name="Bust", short_description="Bust")
+        self.location = tempfile.mkdtemp()
+        self.storage = ContentAddressedFileSystemStorage(location=self.location, base_url="/media/")
+
+    def tearDown(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+
+    def test_reorder_applies_whole_gallery(self):
+        media = [
+            ProductMedia.objects.create(product=self.product, video_url=f"https://v.example.com/{i}", display_order=i)
+            for i in range(3)
+        ]
+        new_order = [str(media[2].pk), str(media[0].pk), str(media[1].pk)]
+
+        response = self.client.post(
+            "/api/v1/products/media/reorder/",
+            {"product": str(self.product.pk), "media": new_order},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        ordered = list(self.product.media.values_list("id", flat=True))
+        self.assertEqual([str(pk) for pk in ordered], new_order)
+
+    def test_reorder_rejects_partial_gallery(self):
+        media = [
+            ProductMedia.objects.create(product=self.product, video_url=f"https://v.example.com/{i}", display_order=i)
+            for i in range(2)
+        ]
+
+        response = self.client.post(
+            "/api/v1/products/media/reorder/",
+            {"product": str(self.product.pk), "media": [str(media[0].pk)]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_upload_creates_media_and_refreshes_thumbnail_once(self):
+        png = BytesIO()
+        Image.new("RGB", (4, 4), (10, 20, 30)).save(png, format="PNG")
+        files = [
+            SimpleUploadedFile("front.png", png.getvalue(), content_type="image/png"),
+            SimpleUploadedFile("back.png", png.getvalue() + b"\0", content_type="image/png"),
+            SimpleUploadedFile("bust.stl", write_binary_stl(CUBE_TRIANGLES), content_type="model/stl"),
+        ]
+        ProductMedia.objects.create(product=self.product, video_url="https://v.example.com/0", display_order=4)
+
+        with patch.object(ProductMedia._meta.get_field("image"), "storage", self.storage), \
+                patch.object(ProductMedia._meta.get_field("model_3d"), "storage", self.storage), \
+                patch.object(Product, "refresh_thumbnail") as refresh_thumbnail:
+            response = self.client.post(
+                "/api/v1/products/media/bulk_upload/",
+                {"product": str(self.product.pk), "files": files},
+                format="multipart",
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 3)
+        refresh_thumbnail.assert_called_once()
+        uploaded = self.product.media.exclude(video_url="https://v.example.com/0")
+        self.assertEqual(list(uploaded.values_list("display_order", flat=True)), [5, 6, 7])
+        self.assertEqual(uploaded.exclude(model_3d="").exclude(model_3d__isnull=True).count(), 1)
+
+    def test_admin_upload_queues_image_metadata(self):
+        png = BytesIO()
+        Image.new("RGB", (4, 4), (10, 20, 30)).save(png, format="PNG")
+        media = ProductMedia(product=self.product, image=SimpleUploadedFile("front.png", png.getvalue()))
+        model_admin = ProductMediaAdmin(ProductMedia, admin_site)
+
+        with patch.object(ProductMedia._meta.get_field("image"), "storage", self.storage), \
+                patch("products.admin.run_in_background") as run_in_background:
+            model_admin.save_model(RequestFactory().post("/admin/"), media, Mock(changed_data=["image"]), change=False)
+
+        run_in_background.assert_called_once_with(extract_image_metadata, media.pk)
+
+    def test_inline_media_on_product_page_are_queued(self):
+        added = ProductMedia(product=self.product, image="front.png")
+        replaced = ProductMedia(product=self.product, model_3d="cube.stl")
+        relabelled = ProductMedia(product=self.product, image="side.png")
+        formset = Mock(
+            model=ProductMedia,
+            new_objects=[added],
+            changed_objects=[(replaced, ["model_3d"]), (relabelled, ["alt_text"])],
+        )
+        model_admin = ProductAdmin(Product, admin_site)
+
+        with patch("products.admin.run_in_background") as run_in_background:
+            model_admin.save_formset(RequestFactory().post("/admin/"), Mock(), formset, change=True)
+
+        self.assertEqual(run_in_background.call_args_list, [
+            call(extract_image_metadata, added.pk),
+            call(analyze_product_media, replaced.pk),
+        ])
+
+    def test_gallery_actions_are_staff_only(self):
+        customer = User.objects.create_user(
+            email="customer@example.com", full_name="Customer", phone_number="0780000021", password="pass12345"
+        )
+        self.client.force_authenticate(customer)
+        media = ProductMedia.objects.create(product=self.product, video_url="https://v.example.com/0")
+
+        reorder = self.client.post(
+            "/api/v1/products/media/reorder/",
+            {"product": str(self.product.pk), "media": [str(media.pk)]},
+            format="json",
+        )
+        upload = self.client.post(
+            "/api/v1/products/media/bulk_upload/",
+            {"product": str(self.product.pk), "files": [SimpleUploadedFile("front.png", b"png")]},
+            format="multipart",
+        )
+
+        self.assertEqual((reorder.status_code, upload.status_code), (403, 403))
+        self.assertEqual(self.product.media.count(), 1)
+
+    def test_bulk_upload_rejects_unknown_file_type(self):
+        response = self.client.post(
+            "/api/v1/products/media/bulk_upload/",
+            {"product": str(self.product.pk), "files": [SimpleUploadedFile("notes.txt", b"hi")]},
+            format="multipart",
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+
+class FeedbackModerationTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.staff = User.objects.create_user(
+            email="mod@example.com", full_name="Moderator", phone_number="0780000002",
+            password="pass12345", is_staff=True
+        )
+        self.client.force_authenticate(self.staff)
+        category = ServiceCategory.objects.create(name="Toys")
+        self.car = Product.objects.create(category=category, name="Car", short_description="Car")
+        self.boat = Product.objects.create(category=category, name="Boat", short_description="Boat")
+        self.feedback = [
+            Feedback.objects.create(product=product, client_name=f"Client {i}", message="Nice", rating=rating)
+            for i, (product, rating) in enumerate([(self.car, 5), (self.car, 3), (self.boat, 4)])
+        ]
+
+    def test_bulk_publish_updates_ratings_per_product(self):
+        response = self.client.post(
+            "/api/v1/products/feedback/bulk_moderate/",
+            {"ids": [str(f.pk) for f in self.feedback], "published": True},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["updated"], 3)
+        self.car.refresh_from_db()
+        self.boat.refresh_from_db()
+        self.assertEqual((self.car.average_rating, self.car.rating_count), (4.0, 2))
+        self.assertEqual((self.boat.average_rating, self.boat.rating_count), (4.0, 1))
+
+    def test_bulk_unpublish_clears_ratings(self):
+        Feedback.objects.update(published=True)
+        Product.refresh_ratings([self.car.pk, self.boat.pk])
+
+        self.client.post(
+            "/api/v1/products/feedback/bulk_moderate/",
+            {"ids": [str(self.feedback[2].pk)], "published": False},
+            format="json",
+        )
+
+        self.boat.refresh_from_db()
+        self.assertIsNone(self.boat.average_rating)
+        self.assertEqual(self.boat.rating_count, 0)
+
+    def test_moderation_queue_pages_pending_feedback_oldest_first(self):
+        Feedback.objects.filter(pk=self.feedback[1].pk).update(published=True)
+
+        response = self.client.get("/api/v1/products/feedback/moderation_queue/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [item["id"] for item in response.data["results"]],
+            [str(self.feedback[0].pk), str(self.feedback[2].pk)],
+        )
+        self.assertIn("next", response.data)
+
+    def test_customers_cannot_moderate(self):
+        customer = User.objects.create_user(
+            email="buyer@example.com", full_name="Buyer", phone_number="0780000003", password="pass12345"
+        )
+        self.client.force_authenticate(customer)
+
+        response = self.client.post(
+            "/api/v1/products/feedback/bulk_moderate/",
+            {"ids": [str(self.feedback[0].pk)], "published": True},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 403)
+
+
+class ProductFeedbackListingTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        category = ServiceCategory.objects.create(name="Jewelry")
+        self.ring = Product.objects.create(category=category, name="Ring", short_description="Ring", published=True)
+        other = Product.objects.create(category=category, name="Chain", short_description="Chain", published=True)
+        self.draft = Product.objects.create(category=category, name="Draft", short_description="Draft")
+        Feedback.objects.create(product=self.draft, client_name="Early", message="Nice", rating=5, published=True)
+        for i in range(25):
+            Feedback.objects.create(product=self.ring, client_name=f"Client {i}", message="Great", rating=5, published=True)
+        Feedback.objects.create(product=self.ring, client_name="Hidden", message="Spam", rating=1)
+        Feedback.objects.create(product=other, client_name="Other", message="Fine", rating=4, published=True)
+
+    def test_lists_published_feedback_of_product_with_cursor(self):
+        url = f"/api/v1/products/products/{self.ring.pk}/feedback/"
+
+        with self.assertNumQueries(2):
+            first = self.client.get(url)
+        second = self.client.get(first.data["next"])
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(len(first.data["results"]), 20)
+        self.assertEqual(len(second.data["results"]), 5)
+        self.assertEqual(first.data["results"][0]["product_name"], "Ring")
+        names = {item["client_name"] for item in first.data["results"] + second.data["results"]}
+        self.assertEqual(len(names), 25)
+        self.assertNotIn("Hidden", names)
+
+    def test_unknown_product_is_404(self):
+        response = self.client.get("/api/v1/products/products/not-a-uuid/feedback/")
+        self.assertEqual(response.status_code, 404)
+
+    def test_unpublished_product_feedback_is_hidden(self):
+        response = self.client.get(f"/api/v1/products/products/{self.draft.pk}/feedback/")
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(SUBMISSION_LIMITER_BACKEND="utils.throttling.LocalMemoryLimiter", SUBMISSION_RATE="3/hour")
+class SubmissionGuardTest(TestCase):
+
+    def setUp(self):
+        get_limiter().reset()
+        self.client = APIClient()
+        self.customer = User.objects.create_user(
+            email="fan@example.com", full_name="Fan", phone_number="0780000004", password="pass12345"
+        )
+        category = ServiceCategory.objects.create(name="Decor")
+        self.vase = Product.objects.create(category=category, name="Vase", short_description="Vase")
+
+    def custom_request(self, **overrides):
+        data = {
+            "client_name": "Aline",
+            "client_email": "aline@example.com",
+            "client_phone": "0780000005",
+            "title": "Custom lamp",
+            "description": "A lamp shaped like a volcano",
+        }
+        data.update(overrides)
+        return self.client.post("/api/v1/products/custom-requests/", data, format="json")
+
+    def test_identical_feedback_is_rejected(self):
+        self.client.force_authenticate(self.customer)
+        data = {"product": str(self.vase.pk), "client_name": "Fan", "message": "Lovely vase", "rating": 5}
+
+        first = self.client.post("/api/v1/products/feedback/", data, format="json")
+        data["message"] = "  lovely   VASE"
+        second = self.client.post("/api/v1/products/feedback/", data, format="json")
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 400)
+        self.assertEqual(Feedback.objects.count(), 1)
+
+    def test_duplicate_outside_window_is_accepted(self):
+        self.assertEqual(self.custom_request().status_code, 201)
+        CustomRequest.objects.update(created_at=timezone.now() - timedelta(hours=2))
+
+        self.assertEqual(self.custom_request().status_code, 201)
+
+    def test_identical_custom_request_is_rejected(self):
+        self.assertEqual(self.custom_request().status_code, 201)
+        self.assertEqual(self.custom_request().status_code, 400)
+
+    def test_burst_submissions_are_throttled(self):
+        for i in range(3):
+            self.assertEqual(self.custom_request(title=f"Lamp {i}").status_code, 201)
+
+        response = self.custom_request(title="Lamp 4")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(CustomRequest.objects.count(), 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WishlistFlagTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email="saver@example.com", full_name="Saver", phone_number="0780000006", password="pass12345"
+        )
+        category = ServiceCategory.objects.create(name="Prints")
+        self.mug = Product.objects.create(category=category, name="Mug", short_description="Mug")
+        self.cup = Product.objects.create(category=category, name="Cup", short_description="Cup")
+
+    def flags(self):
+        response = self.client.get("/api/v1/products/products/")
+        return {item["name"]: item["in_wishlist"] for item in response.data["results"]}
+
+    def test_anonymous_users_get_false(self):
+        self.assertEqual(self.flags(), {"Mug": False, "Cup": False})
+
+    def test_toggle_updates_flags(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.flags(), {"Mug": False, "Cup": False})
+
+        self.client.post("/api/v1/products/wishlist-items/toggle/", {"product": str(self.mug.pk)}, format="json")
+        self.assertEqual(self.flags(), {"Mug": True, "Cup": False})
+
+        self.client.post("/api/v1/products/wishlist-items/toggle/", {"product": str(self.mug.pk)}, format="json")
+        self.assertEqual(self.flags(), {"Mug": False, "Cup": False})
+
+    def test_create_and_clear_invalidate_cached_ids(self):
+        self.client.force_authenticate(self.user)
+        self.client.post("/api/v1/products/wishlist-items/", {"product": str(self.cup.pk)}, format="json")
+        self.assertEqual(self.flags(), {"Mug": False, "Cup": True})
+
+        self.client.delete("/api/v1/products/wishlist-items/clear/")
+        self.assertEqual(self.flags(), {"Mug": False, "Cup": False})
+
+    def test_update_invalidates_cached_ids(self):
+        self.client.force_authenticate(self.user)
+        item_id = self.client.post(
+            "/api/v1/products/wishlist-items/", {"product": str(self.cup.pk)}, format="json"
+        ).data["id"]
+        self.assertEqual(self.flags(), {"Mug": False, "Cup": True})
+
+        self.client.patch(f"/api/v1/products/wishlist-items/{item_id}/", {"product": str(self.mug.pk)}, format="json")
+
+        self.assertEqual(self.flags(), {"Mug": True, "Cup": False})
+
+    def test_set_read_before_a_write_is_never_served(self):
+        wishlist = Wishlist.objects.create(user=self.user)
+        # A slow read takes the version, then a write commits and invalidates
+        version = Wishlist.cache_version(self.user.pk)
+        WishlistItem.objects.create(wishlist=wishlist, product=self.mug)
+        Wishlist.invalidate_cache(self.user.pk)
+        # ...before the slow read caches what it saw
+        cache.set(Wishlist.cache_key(self.user.pk, version), frozenset())
+
+        self.assertEqual(Wishlist.product_ids_for(self.user), {self.mug.pk})
+
+    def test_wishlisted_ids_are_cached(self):
+        wishlist = Wishlist.objects.create(user=self.user)
+        WishlistItem.objects.create(wishlist=wishlist, product=self.mug)
+
+        self.assertEqual(Wishlist.product_ids_for(self.user), {self.mug.pk})
+        with self.assertNumQueries(0):
+            self.assertEqual(Wishlist.product_ids_for(self.user), {self.mug.pk})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class WishlistSyncTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email="offline@example.com", full_name="Offline", phone_number="0780000007", password="pass12345"
+        )
+        self.client.force_authenticate(self.user)
+        category = ServiceCategory.objects.create(name="Figures")
+        self.products = [
+            Product.objects.create(category=category, name=f"Figure {i}", short_description="Figure")
+            for i in range(4)
+        ]
+        self.wishlist = Wishlist.objects.create(user=self.user)
+        for product in self.products[:2]:
+            WishlistItem.objects.create(wishlist=self.wishlist, product=product)
+
+    def sync(self, products):
+        return self.client.post(
+            "/api/v1/products/wishlist-items/sync/",
+            {"products": [str(p.pk) for p in products]},
+            format="json",
+        )
+
+    def test_applies_difference(self):
+        Wishlist.product_ids_for(self.user)
+
+        response = self.sync(self.products[1:])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["added"], response.data["removed"]), (2, 1))
+        expected = {p.pk for p in self.products[1:]}
+        self.assertEqual(set(self.wishlist.items.values_list("product_id", flat=True)), expected)
+        self.assertEqual(Wishlist.product_ids_for(self.user), expected)
+
+    def test_query_count_does_not_grow_with_changes(self):
+        with self.assertNumQueries(7):
+            self.sync(self.products[2:])
+
+    def test_empty_set_clears_wishlist(self):
+        self.sync([])
+        self.assertFalse(self.wishlist.items.exists())
+
+    def test_unknown_products_are_rejected(self):
+        response = self.client.post(
+            "/api/v1/products/wishlist-items/sync/",
+            {"products": [str(self.products[0].pk), "00000000-0000-0000-0000-000000000000"]},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.wishlist.items.count(), 2)
+
+
+class WishlistSerializationQueryTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            email="collector@example.com", full_name="Collector", phone_number="0780000008", password="pass12345"
+        )
+        self.client.force_authenticate(self.user)
+        self.category = ServiceCategory.objects.create(name="Models")
+        self.wishlist = Wishlist.objects.create(user=self.user)
+
+    def add_items(self, count):
+        for i in range(count):
+            product = Product.objects.create(category=self.category, name=f"Model {i}", short_description="Model")
+            WishlistItem.objects.create(wishlist=self.wishlist, product=product)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response
+
+    def test_my_wishlist_query_count_is_constant(self):
+        self.add_items(1)
+        small, _ = self.count_queries("/api/v1/products/wishlist/my_wishlist/")
+        self.add_items(15)
+        large, response = self.count_queries("/api/v1/products/wishlist/my_wishlist/")
+
+        self.assertEqual(small, large)
+        self.assertEqual(response.data["item_count"], 16)
+        self.assertEqual(len(response.data["items"]), 16)
+
+    def test_list_query_count_is_constant(self):
+        self.add_items(1)
+        small, _ = self.count_queries("/api/v1/products/wishlist/")
+        self.add_items(15)
+        large, response = self.count_queries("/api/v1/products/wishlist/")
+
+        self.assertEqual(small, large)
+        self.assertEqual(response.data["results"][0]["item_count"], 16)
+
+    def test_my_wishlist_is_created_on_first_visit(self):
+        Wishlist.objects.all().delete()
+
+        _, response = self.count_queries("/api/v1/products/wishlist/my_wishlist/")
+
+        self.assertEqual(response.data["item_count"], 0)
+        self.assertEqual(Wishlist.objects.filter(user=self.user).count(), 1)
+
+
+class PriceDropAlertTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="bargain@example.com", full_name="Bargain", phone_number="0780000009", password="pass12345"
+        )
+        category = ServiceCategory.objects.create(name="Lamps")
+        self.lamp = Product.objects.create(
+            category=category, name="Lamp", short_description="Lamp",
+            unit_price=Decimal("10000"), published=True, is_for_sale=True
+        )
+        self.shade = Product.objects.create(
+            category=category, name="Shade", short_description="Shade",
+            unit_price=Decimal("4000"), published=True, is_for_sale=False
+        )
+        self.wishlist = Wishlist.objects.create(user=self.user)
+
+    def discount(self, product, discount_type, value):
+        discount = Discount.objects.create(
+            name=f"{value} off", discount_type=discount_type, discount_value=Decimal(value),
+            start_date=timezone.now() - timedelta(days=1), end_date=timezone.now() + timedelta(days=1),
+        )
+        ProductDiscount.objects.create(product=product, discount=discount)
+
+    def test_sql_price_matches_get_final_price(self):
+        self.discount(self.lamp, Discount.PERCENTAGE, "10")
+        self.discount(self.lamp, Discount.PERCENTAGE, "5")
+        self.discount(self.lamp, Discount.FIXED, "500")
+        self.discount(self.shade, Discount.FIXED, "5000")
+
+        prices = dict(Product.objects.annotate(price=effective_price()).values_list("name", "price"))
+
+        self.assertEqual(prices["Lamp"], self.lamp.get_final_price())
+        self.assertEqual(prices["Lamp"], Decimal("8050.00"))
+        self.assertEqual(prices["Shade"], Decimal("0.00"))
+
+    def test_sql_price_is_rounded_to_cents(self):
+        Product.objects.filter(pk=self.lamp.pk).update(unit_price=Decimal("10.01"))
+        self.discount(self.lamp, Discount.PERCENTAGE, "15")
+        self.discount(self.shade, Discount.PERCENTAGE, "100")
+
+        prices = dict(Product.objects.annotate(price=effective_price()).values_list("name", "price"))
+
+        self.assertEqual(prices["Lamp"], Decimal("8.51"))
+        self.assertEqual(prices["Shade"], Decimal("0.00"))
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.get_final_price(), prices["Lamp"])
+
+    def test_list_and_detail_show_the_checkout_price(self):
+        self.discount(self.lamp, Discount.PERCENTAGE, "10")
+        self.discount(self.lamp, Discount.PERCENTAGE, "10")
+        client = APIClient()
+
+        listed = {item["name"]: item["final_price"] for item in client.get("/api/v1/products/products/").data["results"]}
+        detail = client.get(f"/api/v1/products/products/{self.lamp.pk}/").data["final_price"]
+
+        self.assertEqual(Decimal(listed["Lamp"]), Decimal("8100.00"))
+        self.assertEqual(Decimal(detail), Decimal("8100.00"))
+
+    def test_price_is_recorded_when_added(self):
+        self.discount(self.lamp, Discount.PERCENTAGE, "20")
+
+        item = WishlistItem.objects.create(wishlist=self.wishlist, product=self.lamp)
+
+        self.assertEqual(item.price_at_add, Decimal("8000.00"))
+        self.assertEqual(item.alert_price, Decimal("8000.00"))
+        self.assertTrue(item.alert_for_sale)
+
+    def test_digest_lists_drops_and_back_on_sale_once(self):
+        WishlistItem.objects.create(wishlist=self.wishlist, product=self.lamp)
+        WishlistItem.objects.create(wishlist=self.wishlist, product=self.shade)
+        self.discount(self.lamp, Discount.PERCENTAGE, "25")
+        Product.objects.filter(pk=self.shade.pk).update(is_for_sale=True)
+
+        call_command("send_price_drop_alerts", stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 1)
+        body = mail.outbox[0].body
+        self.assertEqual(mail.outbox[0].to, ["bargain@example.com"])
+        self.assertIn("Lamp", body)
+        self.assertIn("7500.00", body)
+        self.assertIn("Available for sale again", body)
+        lamp_item = WishlistItem.objects.get(product=self.lamp)
+        self.assertEqual(lamp_item.alert_price, Decimal("7500.00"))
+        self.assertEqual(lamp_item.price_at_add, Decimal("10000.00"))
+
+        call_command("send_price_drop_alerts", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_back_on_sale_after_going_off_sale(self):
+        WishlistItem.objects.create(wishlist=self.wishlist, product=self.lamp)
+        Product.objects.filter(pk=self.lamp.pk).update(is_for_sale=False)
+        call_command("send_price_drop_alerts", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+
+        Product.objects.filter(pk=self.lamp.pk).update(is_for_sale=True)
+        call_command("send_price_drop_alerts", stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("Available for sale again", mail.outbox[0].body)
+
+    def test_price_increase_sends_nothing(self):
+        WishlistItem.objects.create(wishlist=self.wishlist, product=self.lamp)
+        Product.objects.filter(pk=self.lamp.pk).update(unit_price=Decimal("12000"))
+
+        call_command("send_price_drop_alerts", stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_untracked_items_get_a_baseline(self):
+        WishlistItem.objects.create(wishlist=self.wishlist, product=self.lamp)
+        WishlistItem.objects.update(price_at_add=None, alert_price=None, alert_for_sale=False)
+
+        call_command("send_price_drop_alerts", stdout=StringIO())
+
+        item = WishlistItem.objects.get()
+        self.assertEqual((item.price_at_add, item.alert_price, item.alert_for_sale), (Decimal("10000.00"), Decimal("10000.00"), True))
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class CustomRequestIntakeTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.media_root = tempfile.mkdtemp()
+        self.spool_root = tempfile.mkdtemp()
+        self.storage = ContentAddressedFileSystemStorage(location=self.media_root, base_url="/media/")
+        storages = dict(settings.STORAGES, spool={
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": self.spool_root},
+        })
+        overrides = override_settings(STORAGES=storages, SUBMISSION_LIMITER_BACKEND="utils.throttling.LocalMemoryLimiter")
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        for field_name in ("reference_file", "reference_preview"):
+            storage_patch = patch.object(CustomRequest._meta.get_field(field_name), "storage", self.storage)
+            storage_patch.start()
+            self.addCleanup(storage_patch.stop)
+        get_limiter().reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        shutil.rmtree(self.spool_root, ignore_errors=True)
+
+    def submit(self, upload):
+        return self.client.post("/api/v1/products/custom-requests/", {
+            "client_name": "Eric",
+            "client_email": "eric@example.com",
+            "client_phone": "0780000010",
+            "title": f"Print {upload.name}",
+            "description": "Please print this",
+            "reference_file": upload,
+        }, format="multipart")
+
+    def spooled_files(self):
+        return [name for _, _, names in os.walk(self.spool_root) for name in names]
+
+    def test_create_spools_upload_and_returns_queued(self):
+        response = self.submit(SimpleUploadedFile("cube.stl", write_binary_stl(CUBE_TRIANGLES)))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["processing_status"], CustomRequest.PROCESSING_QUEUED)
+        self.assertIsNone(response.data["reference_file"])
+        self.assertEqual(self.spooled_files(), ["cube.stl"])
+
+    def test_worker_pushes_mesh_and_builds_preview(self):
+        response = self.submit(SimpleUploadedFile("cube.stl", write_binary_stl(CUBE_TRIANGLES)))
+
+        process_reference_file(response.data["id"])
+
+        custom_request = CustomRequest.objects.get(pk=response.data["id"])
+        self.assertEqual(custom_request.processing_status, CustomRequest.PROCESSING_READY)
+        self.assertTrue(self.storage.exists(custom_request.reference_file.name))
+        self.assertTrue(custom_request.reference_file.name.startswith("custom_requests/"))
+        self.assertTrue(custom_request.reference_preview.name.endswith(".stl"))
+        self.assertEqual(custom_request.reference_metadata["triangle_count"], 12)
+        self.assertEqual(custom_request.quote["basis"], "mesh")
+        self.assertEqual(custom_request.spooled_file, "")
+        self.assertEqual(self.spooled_files(), [])
+
+    def test_worker_builds_image_preview(self):
+        buffer = BytesIO()
+        Image.new("RGB", (1200, 600), (10, 120, 200)).save(buffer, format="PNG")
+        response = self.submit(SimpleUploadedFile("sketch.png", buffer.getvalue()))
+
+        process_reference_file(response.data["id"])
+
+        custom_request = CustomRequest.objects.get(pk=response.data["id"])
+        with custom_request.reference_preview.open("rb") as f, Image.open(f) as preview:
+            self.assertEqual(preview.size, (512, 256))
+
+    def test_failed_push_is_retried_by_sweep(self):
+        response = self.submit(SimpleUploadedFile("cube.stl", write_binary_stl(CUBE_TRIANGLES)))
+        with patch.object(self.storage, "save", side_effect=OSError("upload failed")):
+            process_reference_file(response.data["id"])
+
+        custom_request = CustomRequest.objects.get(pk=response.data["id"])
+        self.assertEqual(custom_request.processing_status, CustomRequest.PROCESSING_FAILED)
+        self.assertEqual(custom_request.processing_error, "upload failed")
+        self.assertEqual(self.spooled_files(), ["cube.stl"])
+
+        CustomRequest.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        call_command("process_spooled_uploads", "--retry-failed", stdout=StringIO())
+
+        custom_request.refresh_from_db()
+        self.assertEqual(custom_request.processing_status, CustomRequest.PROCESSING_READY)
+        self.assertEqual(self.spooled_files(), [])
+
+    def test_replacing_a_queued_upload_deletes_it(self):
+        response = self.submit(SimpleUploadedFile("cube.stl", write_binary_stl(CUBE_TRIANGLES)))
+
+        spool_reference_file(
+            CustomRequest.objects.get(pk=response.data["id"]),
+            SimpleUploadedFile("part.stl", write_binary_stl(CUBE_TRIANGLES)),
+        )
+
+        self.assertEqual(self.spooled_files(), ["part.stl"])
+
+    def test_upload_replaced_while_processing_is_kept_until_its_worker_is_done(self):
+        response = self.submit(SimpleUploadedFile("cube.stl", write_binary_stl(CUBE_TRIANGLES)))
+        reference_preview = tasks._reference_preview
+
+        def replace_midway(spool, name):
+            spool_reference_file(
+                CustomRequest.objects.get(pk=response.data["id"]),
+                SimpleUploadedFile("part.stl", write_binary_stl(CUBE_TRIANGLES)),
+            )
+            self.assertCountEqual(self.spooled_files(), ["cube.stl", "part.stl"])
+            return reference_preview(spool, name)
+
+        with patch.object(tasks, "_reference_preview", side_effect=replace_midway):
+            process_reference_file(response.data["id"])
+
+        custom_request = CustomRequest.objects.get(pk=response.data["id"])
+        self.assertEqual(custom_request.processing_status, CustomRequest.PROCESSING_QUEUED)
+        self.assertEqual(self.spooled_files(), ["part.stl"])
+
+        process_reference_file(response.data["id"])
+
+        custom_request.refresh_from_db()
+        self.assertEqual(custom_request.processing_status, CustomRequest.PROCESSING_READY)
+        self.assertEqual(self.spooled_files(), [])
+
+
+class QuoteEstimateTest(TestCase):
+
+    def setUp(self):
+        get_limiter().reset()
+        self.client = APIClient()
+        self.printing = ServiceCategory.objects.create(name="3D Printing", requires_material=True)
+
+    def test_mesh_estimate(self):
+        quote = estimate_from_mesh(measure(CUBE_TRIANGLES), "PLA")
+
+        # 2 cm cube: 2.88 cm3 of walls plus 20% of the 5.12 cm3 inside
+        self.assertEqual(quote["volume_cm3"], 8.0)
+        self.assertEqual(quote["material_cm3"], 3.9)
+        self.assertEqual(quote["weight_g"], 4.8)
+        self.assertEqual(quote["basis"], "mesh")
+        self.assertEqual(quote["total"], quote["setup_fee"] + quote["material_cost"] + quote["machine_cost"])
+
+    def test_material_and_size_change_the_price(self):
+        small = estimate_from_dimensions(2, 2, 2, "PLA")
+        large = estimate_from_dimensions(10, 10, 10, "PLA")
+        resin = estimate_from_dimensions(10, 10, 10, "RESIN")
+
+        self.assertLess(small["total"], large["total"])
+        self.assertLess(large["material_cost"], resin["material_cost"])
+
+    def test_material_resolution(self):
+        self.assertEqual(resolve_material("", None), "PLA")
+        with self.assertRaises(QuoteError):
+            resolve_material("", self.printing)
+        with self.assertRaises(QuoteError):
+            resolve_material("GOLD", None)
+
+    def test_estimate_endpoint_with_mesh(self):
+        response = self.client.post("/api/v1/products/custom-requests/estimate/", {
+            "material": "PETG",
+            "reference_file": SimpleUploadedFile("cube.stl", write_binary_stl(CUBE_TRIANGLES)),
+        }, format="multipart")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["basis"], response.data["material"]), ("mesh", "PETG"))
+
+    def test_estimate_endpoint_with_dimensions(self):
+        response = self.client.post("/api/v1/products/custom-requests/estimate/", {
+            "service_category": str(self.printing.pk), "material": "ABS",
+            "length": "5", "width": "4", "height": "3",
+        }, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["basis"], "dimensions")
+
+    def test_estimate_endpoint_rejects_incomplete_input(self):
+        url = "/api/v1/products/custom-requests/estimate/"
+        self.assertEqual(self.client.post(url, {"length": "5"}, format="json").status_code, 400)
+        response = self.client.post(url, {
+            "service_category": str(self.printing.pk), "length": "5", "width": "4", "height": "3",
+        }, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, {
+            "reference_file": SimpleUploadedFile("notes.pdf", b"%PDF-1.4"),
+        }, format="multipart")
+        self.assertEqual(response.status_code, 400)
+
+    def test_estimate_endpoint_rejects_large_models_before_parsing(self):
+        url = "/api/v1/products/custom-requests/estimate/"
+        for limits in ({"QUOTE_MAX_UPLOAD_MB": 0}, {"QUOTE_MAX_FACES": len(CUBE_TRIANGLES) - 1}):
+            with self.subTest(**limits), override_settings(**limits), \
+                    patch("products.quotes.read_mesh") as read_mesh:
+                response = self.client.post(url, {
+                    "reference_file": SimpleUploadedFile("cube.stl", write_binary_stl(CUBE_TRIANGLES)),
+                }, format="multipart")
+
+            self.assertEqual(response.status_code, 400)
+            read_mesh.assert_not_called()
+
+    @override_settings(QUOTE_MAX_FACES=100)
+    def test_face_cap_counts_triangles_the_parser_builds(self):
+        url = "/api/v1/products/custom-requests/estimate/"
+        # ASCII STL without facet/endfacet records, only vertices
+        vertices = b"".join(b"vertex %d 0 %d\n" % (i, i % 7) for i in range(3 * 101))
+        # One OBJ polygon fanned into 101 triangles
+        polygon = b"\n".join([b"v %d %d 0" % (i, i % 5) for i in range(103)] + [b"f " + b" ".join(b"%d" % i for i in range(1, 104))])
+        for name, data in (("bare.stl", b"solid bare\n" + vertices), ("fan.obj", polygon)):
+            with self.subTest(name), patch("products.quotes.read_mesh") as read_mesh:
+                response = self.client.post(url, {"reference_file": SimpleUploadedFile(name, data)}, format="multipart")
+
+            self.assertEqual(response.status_code, 400)
+            read_mesh.assert_not_called()
+
+    def test_request_with_dimensions_is_quoted_on_create(self):
+        response = self.client.post("/api/v1/products/custom-requests/", {
+            "client_name": "Grace", "client_email": "grace@example.com", "client_phone": "0780000011",
+            "title": "Phone stand", "description": "Simple stand", "material": "PLA",
+            "length": "8", "width": "6", "height": "10",
+        }, format="json")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["quote"]["basis"], "dimensions")
+        self.assertEqual(CustomRequest.objects.get().quote["material"], "PLA")
+
+
+class CustomRequestClaimTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.staff = User.objects.create_user(
+            email="maker@example.com", full_name="Maker", phone_number="0780000012",
+            password="pass12345", is_staff=True
+        )
+        self.client.force_authenticate(self.staff)
+        self.printing = ServiceCategory.objects.create(name="Printing")
+        self.design = ServiceCategory.objects.create(name="Design")
+        now = timezone.now()
+        self.requests = []
+        for i, category in enumerate([self.design, self.printing, self.printing]):
+            custom_request = CustomRequest.objects.create(
+                client_name=f"Client {i}", client_email=f"c{i}@example.com", client_phone="0780000013",
+                title=f"Request {i}", description="Details", service_category=category
+            )
+            CustomRequest.objects.filter(pk=custom_request.pk).update(created_at=now - timedelta(hours=10 - i))
+            self.requests.append(custom_request)
+
+    def claim(self, **data):
+        return self.client.post("/api/v1/products/custom-requests/claim_next/", data, format="json")
+
+    def test_claims_oldest_pending_request_of_category(self):
+        first = self.claim(service_category=str(self.printing.pk))
+        second = self.claim(service_category=str(self.printing.pk))
+        third = self.claim(service_category=str(self.printing.pk))
+
+        self.assertEqual(first.data["id"], str(self.requests[1].pk))
+        self.assertEqual(second.data["id"], str(self.requests[2].pk))
+        self.assertEqual(third.status_code, 204)
+        claimed = CustomRequest.objects.get(pk=self.requests[1].pk)
+        self.assertEqual((claimed.status, claimed.assigned_to), ("IN_PROGRESS", self.staff))
+        self.assertIsNotNone(claimed.assigned_at)
+
+    def test_claims_oldest_of_any_category(self):
+        response = self.claim()
+        self.assertEqual(response.data["id"], str(self.requests[0].pk))
+
+    def test_customers_cannot_claim(self):
+        customer = User.objects.create_user(
+            email="shopper@example.com", full_name="Shopper", phone_number="0780000014", password="pass12345"
+        )
+        self.client.force_authenticate(customer)
+        self.assertEqual(self.claim().status_code, 403)
+
+    def test_admin_mark_in_progress_skips_claimed_requests(self):
+        other = User.objects.create_user(
+            email="other@example.com", full_name="Other", phone_number="0780000015",
+            password="pass12345", is_staff=True
+        )
+        self.claim(service_category=str(self.printing.pk))
+        request = RequestFactory().post("/admin/")
+        request.user = other
+        model_admin = CustomRequestAdmin(CustomRequest, admin_site)
+
+        with patch.object(model_admin, "message_user") as message_user:
+            model_admin.mark_in_progress(request, CustomRequest.objects.filter(service_category=self.printing))
+
+        self.assertIn("1 skipped", message_user.call_args[0][1])
+        self.assertEqual(CustomRequest.objects.get(pk=self.requests[1].pk).assigned_to, self.staff)
+        self.assertEqual(CustomRequest.objects.get(pk=self.requests[2].pk).assigned_to, other)
+
+
+class StockAdminTest(TestCase):
+
+    def setUp(self):
+        admin_user = User.objects.create_superuser(
+            email="owner@example.com", full_name="Owner", phone_number="0780000020", password="pass12345"
+        )
+        self.client.force_login(admin_user)
+        category = ServiceCategory.objects.create(name="Prints")
+        self.product = Product.objects.create(category=category, name="Vase", short_description="Vase")
+        self.stock = Stock.objects.create(product=self.product, on_hand=10, reserved=4)
+        self.url = f"/admin/products/stock/{self.stock.pk}/change/"
+
+    def post(self, on_hand, loaded_on_hand):
+        return self.client.post(self.url, {
+            "product": str(self.product.pk), "variant": "", "on_hand": on_hand, "loaded_on_hand": loaded_on_hand,
+        })
+
+    def test_edit_is_applied_on_top_of_concurrent_changes(self):
+        # Two units shipped after the form was opened at 10
+        Stock.objects.filter(pk=self.stock.pk).update(on_hand=8, reserved=2)
+
+        response = self.post(15, 10)
+
+        self.assertEqual(response.status_code, 302)
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.on_hand, self.stock.reserved), (13, 2))
+
+    def test_edit_below_reserved_is_a_form_error(self):
+        Stock.objects.filter(pk=self.stock.pk).update(reserved=8)
+
+        response = self.post(7, 10)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("8 units are reserved", response.content.decode())
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.on_hand, 10)
@@ -1,22 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
 from rest_framework import viewsets, permissions, filters
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import status
-from django.db.models import Avg
+from django.db import transaction
+from django.db.models import Count, Max, Prefetch
+from django.http import HttpResponseRedirect
+from django.utils import timezone
 from .models import ServiceCategory, Product, ProductMedia, Feedback, CustomRequest, Wishlist, WishlistItem, Discount, ProductDiscount
+from .quotes import QuoteError, estimate_from_dimensions, estimate_upload, quote_custom_request, resolve_material
+from .pagination import FeedbackCursorPagination, ModerationQueuePagination
 from .permissions import AnyoneCanCreateRequest, IsOwnerOnly, IsStaffOnly, CustomerCanCreateFeedback
 from drf_spectacular.utils import extend_schema, OpenApiResponse
+from utils.background import run_in_background
+from utils.storage import cached_url
+from utils.streaming import ranged_file_response
+from utils.throttling import EstimateRateThrottle, SubmissionRateThrottle
+from .mesh import MeshError, is_mesh_file
+from .tasks import analyze_product_media, extract_image_metadata, process_reference_file, spool_reference_file
 from .serializers import (
     CustomRequestSerializer,
+    CustomRequestClaimSerializer,
     ServiceCategorySerializer,
     ProductSerializer,
     ProductListSerializer,
     ProductMediaSerializer,
+    ProductMediaReorderSerializer,
+    ProductMediaBulkUploadSerializer,
+    QuoteEstimateSerializer,
     FeedbackSerializer,
+    FeedbackBulkModerateSerializer,
+    ProductFeedbackSerializer,
     WishlistSerializer,
     WishlistItemSerializer,
+    WishlistSyncSerializer,
     DiscountSerializer,
     ProductDiscountSerializer,
     CategoryRequiredFieldSerializer,
@@ -42,9 +61,7 @@ class ServiceCategoryViewSet(viewsets.ModelViewSet):
 
 @extend_schema(tags=["Listing Product"])
 class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.all().annotate(
-        average_rating=Avg("feedbacks__rating")
-    )
+    queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
@@ -56,6 +73,12 @@ class ProductViewSet(viewsets.ModelViewSet):
         if self.action == 'list':
             return ProductListSerializer
         return ProductSerializer
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action == 'list' and self.request.user.is_authenticated:
+            context['wishlisted_ids'] = Wishlist.product_ids_for(self.request.user)
+        return context
     
     def get_queryset(self):
         qs = super().get_queryset()
@@ -88,6 +111,24 @@ class ProductViewSet(viewsets.ModelViewSet):
         product.published = False
         product.save()
         return Response({"status": "Product unpublished"})
+
+    @extend_schema(responses=ProductFeedbackSerializer(many=True))
+    @action(detail=True, methods=["get"], url_path="feedback")
+    def feedback(self, request, pk=None):
+        """Published reviews of a product, newest first, cursor paginated"""
+        product = self.get_object()
+        # Reviews of unpublished products stay hidden like the products themselves
+        if not product.published and not request.user.is_staff:
+            return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+        queryset = (
+            Feedback.objects.filter(product=product, published=True)
+            .select_related('product')
+            .only('id', 'client_name', 'message', 'rating', 'created_at', 'product__name')
+        )
+        paginator = FeedbackCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = ProductFeedbackSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
     
 @extend_schema(tags=["Product Images"])
 class ProductMediaViewSet(viewsets.ModelViewSet):
@@ -102,16 +143,135 @@ class ProductMediaViewSet(viewsets.ModelViewSet):
             qs = qs.filter(product_id=product_id)
         return qs
 
+    def perform_create(self, serializer):
+        media = serializer.save()
+        media.product.refresh_thumbnail()
+        if media.image:
+            run_in_background(extract_image_metadata, media.pk)
+        if is_mesh_file(media.model_3d):
+            run_in_background(analyze_product_media, media.pk)
+
+    def perform_update(self, serializer):
+        previous_product = serializer.instance.product
+        media = serializer.save()
+        media.product.refresh_thumbnail()
+        if previous_product.pk != media.product_id:
+            previous_product.refresh_thumbnail()
+        # Only re-analyze files that were replaced
+        if 'image' in serializer.validated_data and media.image:
+            run_in_background(extract_image_metadata, media.pk)
+        if 'model_3d' in serializer.validated_data and is_mesh_file(media.model_3d):
+            run_in_background(analyze_product_media, media.pk)
+
+    def perform_destroy(self, instance):
+        product = instance.product
+        instance.delete()
+        product.refresh_thumbnail()
+
+    @extend_schema(request=ProductMediaReorderSerializer)
+    @action(detail=False, methods=['post'], permission_classes=[IsStaffOnly])
+    def reorder(self, request):
+        """Set display_order of a whole gallery from an ordered list of media ids"""
+        serializer = ProductMediaReorderSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        product = serializer.validated_data['product']
+        ordered_ids = serializer.validated_data['media']
+
+        gallery = {media.pk: media for media in product.media.only('id', 'product_id', 'display_order')}
+        if set(gallery) != set(ordered_ids):
+            return Response(
+                {"error": "The list must contain every media item of the product exactly once"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        for position, media_id in enumerate(ordered_ids):
+            gallery[media_id].display_order = position
+        ProductMedia.objects.bulk_update(gallery.values(), ['display_order'])
+        product.refresh_thumbnail()
+
+        return Response({"product": product.pk, "media": ordered_ids})
+
+    @extend_schema(request=ProductMediaBulkUploadSerializer, responses=ProductMediaSerializer(many=True))
+    @action(detail=False, methods=['post'], permission_classes=[IsStaffOnly])
+    def bulk_upload(self, request):
+        """Upload several media files for one product in a single request"""
+        serializer = ProductMediaBulkUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        product = serializer.validated_data['product']
+        files = serializer.validated_data['files']
+        alt_text = serializer.validated_data.get('alt_text', '')
+
+        last_order = product.media.aggregate(last=Max('display_order'))['last']
+        start = 0 if last_order is None else last_order + 1
+        rows = [
+            ProductMedia(product=product, alt_text=alt_text, display_order=start + position)
+            for position in range(len(files))
+        ]
+
+        def store(row_and_file):
+            row, (field_name, file) = row_and_file
+            field = ProductMedia._meta.get_field(field_name)
+            name = field.generate_filename(row, file.name)
+            setattr(row, field_name, field.storage.save(name, file, max_length=field.max_length))
+
+        # Storage uploads are network bound, push the files concurrently
+        with ThreadPoolExecutor(max_workers=min(4, len(files))) as executor:
+            list(executor.map(store, zip(rows, files)))
+
+        with transaction.atomic():
+            ProductMedia.objects.bulk_create(rows)
+            product.refresh_thumbnail()
+            for row in rows:
+                if row.image:
+                    run_in_background(extract_image_metadata, row.pk)
+                if is_mesh_file(row.model_3d):
+                    run_in_background(analyze_product_media, row.pk)
+
+        return Response(
+            ProductMediaSerializer(rows, many=True, context=self.get_serializer_context()).data,
+            status=status.HTTP_201_CREATED
+        )
+
+    @action(detail=True, methods=['get'])
+    def stream(self, request, pk=None):
+        """Stream the video file with HTTP Range support"""
+        media = self.get_object()
+        if not media.video_file:
+            return Response(
+                {"error": "This media has no video file"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        try:
+            path = media.video_file.path
+        except NotImplementedError:
+            # Remote storages (Cloudinary) serve ranges from their CDN
+            return HttpResponseRedirect(cached_url(media.video_file))
+        return ranged_file_response(request, path)
+
 @extend_schema(tags=["Feedback on Product"])
 class FeedbackViewSet(viewsets.ModelViewSet):
     queryset = Feedback.objects.all()
     serializer_class = FeedbackSerializer
     permission_classes = [CustomerCanCreateFeedback]
-    authentication_classes = []
+
+    def get_throttles(self):
+        if self.action == 'create':
+            return [SubmissionRateThrottle()]
+        return super().get_throttles()
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def perform_update(self, serializer):
+        feedback = serializer.save()
+        Product.refresh_ratings([feedback.product_id])
+
+    def perform_destroy(self, instance):
+        product_id = instance.product_id
+        instance.delete()
+        Product.refresh_ratings([product_id])
+
     def get_queryset(self):
         qs = super().get_queryset()
         
@@ -130,16 +290,116 @@ class FeedbackViewSet(viewsets.ModelViewSet):
         """Toggle feedback published status (staff only)"""
         feedback = self.get_object()
         feedback.published = not feedback.published
-        feedback.save()
+        feedback.save(update_fields=['published'])
+        Product.refresh_ratings([feedback.product_id])
         return Response({
             "published": feedback.published,
             "message": f"Feedback {'published' if feedback.published else 'unpublished'}"
         })
+
+    @action(detail=False, methods=['get'], permission_classes=[IsStaffOnly])
+    def moderation_queue(self, request):
+        """Pending (unpublished) feedback, oldest first, keyset paginated (staff only)"""
+        queryset = Feedback.objects.filter(published=False).select_related('product', 'user')
+        paginator = ModerationQueuePagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @extend_schema(request=FeedbackBulkModerateSerializer)
+    @action(detail=False, methods=['post'], permission_classes=[IsStaffOnly])
+    def bulk_moderate(self, request):
+        """Publish or unpublish many feedback entries with one UPDATE (staff only)"""
+        serializer = FeedbackBulkModerateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        published = serializer.validated_data['published']
+
+        with transaction.atomic():
+            changed = Feedback.objects.select_for_update().filter(
+                pk__in=serializer.validated_data['ids']
+            ).exclude(published=published)
+            product_ids = set(changed.values_list('product_id', flat=True))
+            updated = changed.update(published=published)
+            Product.refresh_ratings(product_ids)
+
+        return Response({
+            "updated": updated,
+            "published": published,
+            "message": f"{updated} feedback {'published' if published else 'unpublished'}"
+        })
 @extend_schema(tags=["Booking or Custom Request"])
 class CustomRequestViewSet(viewsets.ModelViewSet):
     queryset = CustomRequest.objects.all()
     serializer_class = CustomRequestSerializer
     permission_classes = [AnyoneCanCreateRequest]
+
+    def get_throttles(self):
+        if self.action == 'create':
+            return [SubmissionRateThrottle()]
+        if self.action == 'estimate':
+            return [EstimateRateThrottle()]
+        return super().get_throttles()
+
+    def perform_create(self, serializer):
+        # Spool the upload locally and respond; the push to media storage runs in the background
+        upload = serializer.validated_data.pop('reference_file', None)
+        custom_request = serializer.save()
+        if upload:
+            spool_reference_file(custom_request, upload)
+            run_in_background(process_reference_file, custom_request.pk)
+        # Mesh uploads are quoted again once measured
+        quote_custom_request(custom_request)
+
+    def perform_update(self, serializer):
+        upload = serializer.validated_data.pop('reference_file', None)
+        custom_request = serializer.save()
+        if upload:
+            spool_reference_file(custom_request, upload)
+            run_in_background(process_reference_file, custom_request.pk)
+        quote_custom_request(custom_request)
+
+    @extend_schema(request=CustomRequestClaimSerializer, responses=CustomRequestSerializer)
+    @action(detail=False, methods=['post'], permission_classes=[IsStaffOnly])
+    def claim_next(self, request):
+        """Assign the oldest pending request (optionally of one category) to the calling staff member"""
+        serializer = CustomRequestClaimSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        service_category = serializer.validated_data.get('service_category')
+
+        with transaction.atomic():
+            queryset = CustomRequest.objects.filter(status='PENDING')
+            if service_category:
+                queryset = queryset.filter(service_category=service_category)
+            # Rows another staff member is claiming right now are skipped, not waited on
+            custom_request = queryset.order_by('created_at').select_for_update(skip_locked=True).first()
+            if custom_request is None:
+                return Response(status=status.HTTP_204_NO_CONTENT)
+
+            custom_request.status = 'IN_PROGRESS'
+            custom_request.assigned_to = request.user
+            custom_request.assigned_at = timezone.now()
+            custom_request.save(update_fields=['status', 'assigned_to', 'assigned_at', 'updated_at'])
+
+        return Response(CustomRequestSerializer(custom_request, context=self.get_serializer_context()).data)
+
+    @extend_schema(request=QuoteEstimateSerializer)
+    @action(detail=False, methods=['post'], permission_classes=[permissions.AllowAny])
+    def estimate(self, request):
+        """Instant price estimate from an STL/OBJ file or stated dimensions, nothing is stored"""
+        serializer = QuoteEstimateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        try:
+            material = resolve_material(data.get('material'), data.get('service_category'))
+            if data.get('reference_file'):
+                quote = estimate_upload(data['reference_file'], material)
+            else:
+                quote = estimate_from_dimensions(data['length'], data['width'], data['height'], material)
+        except (QuoteError, MeshError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(quote)
     
     
 @extend_schema(tags=["View Wishlist"])
@@ -152,12 +412,20 @@ class WishlistViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsOwnerOnly]
     
     def get_queryset(self):
-        return Wishlist.objects.filter(user=self.request.user)
+        # Constant number of queries whatever the wishlist size
+        return (
+            Wishlist.objects.filter(user=self.request.user)
+            .select_related('user')
+            .annotate(item_count=Count('items'))
+            .prefetch_related(Prefetch('items', queryset=WishlistItem.objects.select_related('product')))
+            .order_by('-created_at')
+        )
     
     @action(detail=False, methods=['get'])
     def my_wishlist(self, request):
         """Get or create user's wishlist"""
-        wishlist, created = Wishlist.objects.get_or_create(user=request.user)
+        Wishlist.objects.get_or_create(user=request.user)
+        wishlist = self.get_queryset().get()
         serializer = self.get_serializer(wishlist)
         return Response(serializer.data)
 
@@ -173,13 +441,22 @@ class WishlistItemViewSet(viewsets.ModelViewSet):
         # Get user's wishlist items
         wishlist = Wishlist.objects.filter(user=self.request.user).first()
         if wishlist:
-            return WishlistItem.objects.filter(wishlist=wishlist)
+            return WishlistItem.objects.filter(wishlist=wishlist).select_related('product')
         return WishlistItem.objects.none()
     
     def perform_create(self, serializer):
         # Get or create user's wishlist
         wishlist, created = Wishlist.objects.get_or_create(user=self.request.user)
         serializer.save(wishlist=wishlist)
+        Wishlist.invalidate_cache(self.request.user.pk)
+
+    def perform_update(self, serializer):
+        serializer.save()
+        Wishlist.invalidate_cache(self.request.user.pk)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        Wishlist.invalidate_cache(self.request.user.pk)
     
     @action(detail=False, methods=['post'])
     def toggle(self, request):
@@ -212,6 +489,7 @@ class WishlistItemViewSet(viewsets.ModelViewSet):
         if wishlist_item:
             # Remove from wishlist
             wishlist_item.delete()
+            Wishlist.invalidate_cache(request.user.pk)
             return Response({
                 "message": "Removed from wishlist",
                 "in_wishlist": False
@@ -219,11 +497,44 @@ class WishlistItemViewSet(viewsets.ModelViewSet):
         else:
             # Add to wishlist
             WishlistItem.objects.create(wishlist=wishlist, product=product)
+            Wishlist.invalidate_cache(request.user.pk)
             return Response({
                 "message": "Added to wishlist",
                 "in_wishlist": True
             }, status=status.HTTP_201_CREATED)
     
+    @extend_schema(request=WishlistSyncSerializer)
+    @action(detail=False, methods=['post'])
+    def sync(self, request):
+        """Replace the wishlist with the given set of product ids, applying only the difference"""
+        serializer = WishlistSyncSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        prices = serializer.validated_data['products']
+        desired = set(prices)
+
+        with transaction.atomic():
+            wishlist, created = Wishlist.objects.get_or_create(user=request.user)
+            current = set(wishlist.items.order_by().values_list('product_id', flat=True))
+            to_add = desired - current
+            to_remove = current - desired
+
+            # bulk_create skips save(), so record the price baselines looked up during validation
+            items = []
+            for product_id in to_add:
+                item = WishlistItem(wishlist=wishlist, product_id=product_id)
+                item.set_price_baseline(*prices[product_id])
+                items.append(item)
+            WishlistItem.objects.bulk_create(items, ignore_conflicts=True)
+            if to_remove:
+                wishlist.items.filter(product_id__in=to_remove).delete()
+        Wishlist.invalidate_cache(request.user.pk)
+
+        return Response({
+            "added": len(to_add),
+            "removed": len(to_remove),
+            "products": sorted(desired, key=str),
+        })
+
     @action(detail=False, methods=['delete'])
     def clear(self, request):
         """Clear all items from wishlist"""
@@ -231,6 +542,7 @@ class WishlistItemViewSet(viewsets.ModelViewSet):
         if wishlist:
             count = wishlist.items.count()
             wishlist.items.all().delete()
+            Wishlist.invalidate_cache(request.user.pk)
             return Response({
                 "message": f"Removed {count} items from wishlist"
             })
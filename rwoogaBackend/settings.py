@@ -4,6 +4,7 @@ from dotenv import load_dotenv
 from datetime import timedelta
 from pathlib import Path
 import cloudinary
+from corsheaders.defaults import default_headers
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -95,6 +96,25 @@ DATABASES = {
     }
 }
 
+# Shared by every worker, so rate limits and cached wishlists are the same in all of them.
+# The database cache needs `python manage.py createcachetable`. For Redis, set CACHE_BACKEND
+# and THROTTLE_CACHE_BACKEND to django.core.cache.backends.redis.RedisCache and the locations
+# to two redis:// databases.
+CACHE_BACKEND = config('CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': config('CACHE_LOCATION', default='rwooga_cache'),
+    },
+    # Rate limit counters (utils.throttling.CacheLimiter), apart so resetting them keeps everything else.
+    # The backend has to increment atomically: Redis, Memcached or the counter-only database cache,
+    # never the plain DatabaseCache, whose incr() is a read then a write that loses concurrent hits.
+    'throttle': {
+        'BACKEND': config('THROTTLE_CACHE_BACKEND', default='utils.cache.CounterDatabaseCache'),
+        'LOCATION': config('THROTTLE_CACHE_LOCATION', default='rwooga_throttle_cache'),
+    },
+}
+
 
 
 # Password validation
@@ -148,6 +168,7 @@ CORS_ALLOWED_ORIGINS = [
     "http://127.0.0.1:3000",
 ]
 CORS_ALLOW_CREDENTIALS = True
+CORS_ALLOW_HEADERS = (*default_headers, "idempotency-key")
 
 
 
@@ -156,6 +177,46 @@ COMPANY_NAME = "Rwooga"
 SUPPORT_EMAIL = "support@rwooga.com"
 VERIFICATION_CODE_EXPIRY_MINUTES = 10 
 
+# Feedback and custom request submissions (see utils.throttling)
+# CacheLimiter shares its counters through the 'throttle' cache, LocalMemoryLimiter is per process
+SUBMISSION_RATE = config("SUBMISSION_RATE", default="10/hour")
+SUBMISSION_LIMITER_BACKEND = config("SUBMISSION_LIMITER_BACKEND", default="utils.throttling.CacheLimiter")
+DUPLICATE_SUBMISSION_WINDOW_MINUTES = 60
+
+# Instant quotes for custom print requests (see products.quotes), prices in RWF
+# price_per_gram: filament/resin cost, density: g/cm^3, print_speed: cm^3 printed per hour
+QUOTE_MATERIAL_RATES = {
+    'PLA': {'price_per_gram': 60, 'density': 1.24, 'print_speed': 12},
+    'PETG': {'price_per_gram': 70, 'density': 1.27, 'print_speed': 10},
+    'ABS': {'price_per_gram': 70, 'density': 1.04, 'print_speed': 10},
+    'TPU': {'price_per_gram': 110, 'density': 1.21, 'print_speed': 6},
+    'RESIN': {'price_per_gram': 150, 'density': 1.10, 'print_speed': 18},
+}
+QUOTE_DEFAULT_MATERIAL = 'PLA'
+QUOTE_MACHINE_HOURLY_RATE = 1000
+QUOTE_SETUP_FEE = 3000
+# Limits for files quoted by the anonymous estimate endpoint, checked before parsing
+QUOTE_MAX_UPLOAD_MB = 20
+QUOTE_MAX_FACES = 500_000
+ESTIMATE_RATE = config("ESTIMATE_RATE", default="60/hour")
+
+# Seconds a user's wishlisted product ids stay cached. API writes replace the cache version
+# at once, this bounds how long changes made elsewhere (admin, deleted products) take to show.
+WISHLIST_CACHE_TIMEOUT = 5 * 60
+
+# Hours a stored Idempotency-Key response is replayed for (see orders.idempotency)
+IDEMPOTENCY_KEY_TTL_HOURS = config("IDEMPOTENCY_KEY_TTL_HOURS", default=24, cast=int)
+
+# Order lifecycle events, delivered by the drain_outbox command (see orders.outbox)
+# A failing event is retried after OUTBOX_RETRY_SECONDS, doubling each attempt up to OUTBOX_MAX_RETRY_SECONDS
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_RETRY_SECONDS = 30
+OUTBOX_MAX_RETRY_SECONDS = 60 * 60
+# Seconds a worker holds the events it claimed, long enough to run a whole batch;
+# events of a worker that died are picked up again after it
+OUTBOX_LEASE_SECONDS = 10 * 60
+
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
@@ -212,6 +273,28 @@ SPECTACULAR_SETTINGS = {
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Resolved media URLs kept in memory per process (see utils.storage.cached_url)
+MEDIA_URL_CACHE_SIZE = 4096
+
+# Cache lifetime (seconds) of media streamed from local storage
+MEDIA_CACHE_MAX_AGE = 60 * 60
+
+# Custom request uploads are written here first, then pushed to media storage in the background
+UPLOAD_SPOOL_ROOT = config("UPLOAD_SPOOL_ROOT", default=str(BASE_DIR / 'spool'))
+# Spooled uploads still queued/processing after this long are picked up by process_spooled_uploads
+UPLOAD_SPOOL_STALE_MINUTES = 15
+
+# Order receipts (customer name, email, address). Kept off the public media storage and
+# only served through the authenticated receipt endpoint. Must be shared by the web
+# processes and the drain_outbox worker that renders them.
+RECEIPT_ROOT = config("RECEIPT_ROOT", default=str(BASE_DIR / 'private' / 'receipts'))
+
+# Hash uploads while they stream in (used by the content-addressed storages)
+FILE_UPLOAD_HANDLERS = [
+    'utils.upload_handlers.HashingMemoryFileUploadHandler',
+    'utils.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 DEFAULT_FILE_STORAGE = "cloudinary_storage.storage.MediaCloudinaryStorage"
 
@@ -225,10 +308,30 @@ cloudinary.config(
     api_key=os.environ.get("CLOUDINARY_API_KEY"),
     api_secret=os.environ.get("CLOUDINARY_API_SECRET"),
 )
+# Product media and custom request uploads are stored content-addressed,
+# set MEDIA_STORAGE_BACKEND=utils.storage.ContentAddressedFileSystemStorage for local storage
+MEDIA_STORAGE_BACKEND = config(
+    'MEDIA_STORAGE_BACKEND',
+    default='utils.storage.ContentAddressedCloudinaryStorage',
+)
+
 STORAGES = {
     'default': {
         'BACKEND': 'cloudinary_storage.storage.MediaCloudinaryStorage',
     },
+    'media': {
+        'BACKEND': MEDIA_STORAGE_BACKEND,
+    },
+    # Local disk where uploads wait for background processing
+    'spool': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+        'OPTIONS': {'location': UPLOAD_SPOOL_ROOT},
+    },
+    # Private, no public URL is ever handed out for these files
+    'receipts': {
+        'BACKEND': 'utils.storage.ContentAddressedFileSystemStorage',
+        'OPTIONS': {'location': RECEIPT_ROOT},
+    },
     'staticfiles': {
         'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'
     }
@@ -1,9 +1,10 @@
 from .registration_verification import send_registration_verification
 from .send_password_reset_verification import send_password_reset_verification
-from .send_email import send_email_custom
+from .send_email import send_email_batch, send_email_custom
 
 __all__ = [
     'send_registration_verification',
     'send_password_reset_verification',
     'send_email_custom',
+    'send_email_batch',
 ]
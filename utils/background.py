@@ -0,0 +1,31 @@
+import logging
+import threading
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+def _run_task(func, args, kwargs):
+    """Runs in background thread — executes the task and releases its DB connection"""
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        logger.error(f"Background task {func.__name__} failed. Error: {str(e)}")
+    finally:
+        connection.close()
+
+
+def run_in_background(func, *args, **kwargs):
+    """
+    Run a task in a background thread once the current transaction commits,
+    so the request returns without waiting for it and the task sees the saved rows.
+    """
+    def start():
+        thread = threading.Thread(
+            target=_run_task,
+            args=(func, args, kwargs),
+            daemon=True
+        )
+        thread.start()
+
+    transaction.on_commit(start)
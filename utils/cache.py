@@ -0,0 +1,95 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.db import DatabaseCache
+from django.db import connections, router
+from django.utils.timezone import now as tz_now
+
+
+class CounterDatabaseCache(DatabaseCache):
+    """
+    Database cache holding integer counters only, for the 'throttle' alias.
+    Values are stored as plain text rather than pickled, so incr() is a single
+    UPDATE ... SET value = value + n that the database applies atomically, and
+    add() a single upsert. Needs PostgreSQL or SQLite (ON CONFLICT and RETURNING).
+    """
+
+    def get_many(self, keys, version=None):
+        if not keys:
+            return {}
+        key_map = {self.make_and_validate_key(key, version=version): key for key in keys}
+        connection, table = self._connection(router.db_for_read(self.cache_model_class))
+        quote_name = connection.ops.quote_name
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT %s, %s FROM %s WHERE %s IN (%s) AND %s > %%s" % (
+                    quote_name('cache_key'), quote_name('value'), table,
+                    quote_name('cache_key'), ', '.join(['%s'] * len(key_map)), quote_name('expires'),
+                ),
+                [*key_map, self._now(connection)],
+            )
+            return {key_map[key]: int(value) for key, value in cursor.fetchall()}
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._upsert(self.make_and_validate_key(key, version=version), value, timeout, replace_live=True)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._upsert(self.make_and_validate_key(key, version=version), value, timeout, replace_live=False)
+
+    def incr(self, key, delta=1, version=None):
+        cache_key = self.make_and_validate_key(key, version=version)
+        connection, table = self._connection(router.db_for_write(self.cache_model_class))
+        quote_name = connection.ops.quote_name
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE %s SET %s = CAST(CAST(%s AS integer) + %%s AS text) "
+                "WHERE %s = %%s AND %s > %%s RETURNING %s" % (
+                    table, quote_name('value'), quote_name('value'),
+                    quote_name('cache_key'), quote_name('expires'), quote_name('value'),
+                ),
+                [delta, cache_key, self._now(connection)],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise ValueError(f"Key '{key}' not found")
+        return int(row[0])
+
+    def _upsert(self, cache_key, value, timeout, replace_live):
+        connection, table = self._connection(router.db_for_write(self.cache_model_class))
+        quote_name = connection.ops.quote_name
+        now = self._now(connection)
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            expires = datetime.max
+        else:
+            expires = datetime.fromtimestamp(timeout, tz=timezone.utc if settings.USE_TZ else None)
+        expires = connection.ops.adapt_datetimefield_value(expires.replace(microsecond=0))
+
+        sql = (
+            "INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s) "
+            "ON CONFLICT (%s) DO UPDATE SET %s = excluded.%s, %s = excluded.%s" % (
+                table, quote_name('cache_key'), quote_name('value'), quote_name('expires'),
+                quote_name('cache_key'), quote_name('value'), quote_name('value'),
+                quote_name('expires'), quote_name('expires'),
+            )
+        )
+        params = [cache_key, str(int(value)), expires]
+        if not replace_live:
+            sql += " WHERE %s.%s <= %%s" % (table, quote_name('expires'))
+            params.append(now)
+
+        with connection.cursor() as cursor:
+            # Counters are keyed by window, so expired rows are never reused: drop them as new ones come in
+            cursor.execute("DELETE FROM %s WHERE %s <= %%s" % (table, quote_name('expires')), [now])
+            cursor.execute(sql, params)
+            return cursor.rowcount > 0
+
+    def _connection(self, db):
+        connection = connections[db]
+        return connection, connection.ops.quote_name(self._table)
+
+    def _now(self, connection):
+        return connection.ops.adapt_datetimefield_value(tz_now().replace(microsecond=0))
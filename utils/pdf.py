@@ -0,0 +1,91 @@
+"""
+Minimal PDF writer for plain text documents (receipts). Pages are A4 with
+the standard Type 1 fonts, so no font files or PDF library are needed.
+The output only depends on the input lines, identical documents produce
+identical bytes.
+"""
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+MARGIN = 50
+LINE_SPACING = 1.4
+
+# Name used in content streams -> standard Type 1 font
+FONTS = {
+    'regular': 'Helvetica',
+    'bold': 'Helvetica-Bold',
+    'mono': 'Courier',
+}
+
+
+def _escape(text):
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    # WinAnsiEncoding, characters outside it are replaced with '?'
+    return text.encode('cp1252', errors='replace')
+
+
+def _paginate(lines):
+    pages, page, used = [], [], 0
+    for line in lines:
+        height = line[1] * LINE_SPACING
+        if page and used + height > PAGE_HEIGHT - 2 * MARGIN:
+            pages.append(page)
+            page, used = [], 0
+        page.append(line)
+        used += height
+    pages.append(page)
+    return pages
+
+
+def _content_stream(lines):
+    y = PAGE_HEIGHT - MARGIN
+    parts = [b'BT']
+    for font, size, text in lines:
+        y -= size * LINE_SPACING
+        if text:
+            parts.append(b'/%s %d Tf 1 0 0 1 %d %.1f Tm (%s) Tj' % (font.encode(), size, MARGIN, y, _escape(text)))
+    parts.append(b'ET')
+    return b'\n'.join(parts)
+
+
+def render_pdf(lines):
+    """
+    Render (font, size, text) lines, top to bottom, into PDF bytes.
+    `font` is a key of FONTS, an empty text leaves a blank line.
+    """
+    objects = [b'', b'']  # catalog and page tree, filled in once the pages are known
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    font_refs = b' '.join(
+        b'/%s %d 0 R' % (
+            name.encode(),
+            add(b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % base.encode()),
+        )
+        for name, base in FONTS.items()
+    )
+
+    kids = []
+    for page_lines in _paginate(lines):
+        stream = _content_stream(page_lines)
+        contents = add(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        kids.append(add(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << %s >> >> /Contents %d 0 R >>'
+            % (PAGE_WIDTH, PAGE_HEIGHT, font_refs, contents)
+        ))
+
+    objects[0] = b'<< /Type /Catalog /Pages 2 0 R >>'
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+
+    output = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(output)
@@ -1,10 +1,10 @@
 import logging
 import threading
-from typing import Dict, Any
+from typing import Any, Dict, Iterable, Set
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 
 logger = logging.getLogger(__name__)
 
@@ -58,4 +58,34 @@ def send_email_custom(
 
     except Exception as e:
         logger.error(f"Failed to prepare email to {recipient}: {subject}. Error: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+
+def send_email_batch(messages: Iterable[Dict[str, Any]]) -> Set[str]:
+    """
+    Send many HTML emails synchronously over one SMTP connection.
+    Each message is a dict with recipient, subject, template and context.
+    Meant for periodic jobs (digests); returns the recipients that were sent to.
+    """
+    sent = set()
+    with get_connection(fail_silently=False) as connection:
+        for message in messages:
+            recipient = message['recipient']
+            subject = message['subject']
+            try:
+                html_content = render_to_string(message['template'], message['context'])
+                email = EmailMultiAlternatives(
+                    subject=subject,
+                    body=strip_tags(html_content),
+                    from_email=settings.EMAIL_HOST_USER,
+                    to=[recipient],
+                    connection=connection,
+                )
+                email.attach_alternative(html_content, "text/html")
+                if email.send(fail_silently=False):
+                    sent.add(recipient)
+            except Exception as e:
+                logger.error(f"Failed to send email to {recipient}: {subject}. Error: {str(e)}")
+
+    logger.info(f"Sent {len(sent)} emails over one connection")
+    return sent
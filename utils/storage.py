@@ -0,0 +1,128 @@
+import hashlib
+import os
+import posixpath
+from functools import lru_cache
+
+import cloudinary.uploader
+from cloudinary_storage.storage import MediaCloudinaryStorage, RESOURCE_TYPES
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, storages
+from django.utils.deconstruct import deconstructible
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.webm', '.mkv', '.avi'}
+
+
+def file_digest(content):
+    """
+    Return the SHA-256 hex digest of an uploaded file.
+    Uses the digest computed by the hashing upload handlers when available,
+    otherwise hashes the file chunk by chunk.
+    """
+    digest = getattr(content, 'content_hash', None)
+    if digest:
+        return digest
+
+    hasher = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        hasher.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+
+    content.content_hash = hasher.hexdigest()
+    return content.content_hash
+
+
+class ContentAddressedStorageMixin:
+    """
+    Store each file under a name derived from its content hash.
+    `products/images/photo.jpg` becomes `products/images/ab/ab12...ef.jpg`,
+    so uploading the same bytes again reuses the existing blob.
+    """
+
+    def content_name(self, name, content):
+        digest = file_digest(content)
+        dirname, filename = posixpath.split(name.replace('\\', '/'))
+        extension = os.path.splitext(filename)[1].lower()
+        return posixpath.join(dirname, digest[:2], f"{digest}{extension}")
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        name = self.content_name(name, content)
+
+        # Same content already stored: skip the write/upload entirely
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+
+@deconstructible
+class ContentAddressedFileSystemStorage(ContentAddressedStorageMixin, FileSystemStorage):
+    """Content-addressed storage on the local filesystem (dev, tests, on-prem mirror)"""
+
+
+@deconstructible
+class ContentAddressedCloudinaryStorage(ContentAddressedStorageMixin, MediaCloudinaryStorage):
+    """Content-addressed storage on Cloudinary"""
+
+    def _get_resource_type(self, name):
+        extension = os.path.splitext(name)[1].lower()
+        if extension in IMAGE_EXTENSIONS:
+            return RESOURCE_TYPES['IMAGE']
+        if extension in VIDEO_EXTENSIONS:
+            return RESOURCE_TYPES['VIDEO']
+        return RESOURCE_TYPES['RAW']
+
+    def _upload(self, name, content):
+        resource_type = self._get_resource_type(name)
+        public_id = name
+        if resource_type != RESOURCE_TYPES['RAW']:
+            # Cloudinary keeps the extension only in raw public ids
+            public_id = os.path.splitext(name)[0]
+        return cloudinary.uploader.upload(
+            content,
+            public_id=public_id,
+            resource_type=resource_type,
+            tags=self.TAG,
+            overwrite=False,
+            unique_filename=False,
+        )
+
+    def _save(self, name, content):
+        super()._save(name, content)
+        # Keep the extension so the stored name matches what exists() checks
+        return self._normalise_name(name)
+
+
+def media_storage():
+    """Storage used for product media and custom request uploads."""
+    return storages['media']
+
+
+def spool_storage():
+    """Local storage holding uploads until a background task processes them."""
+    return storages['spool']
+
+
+def receipt_storage():
+    """Private local storage for order receipts, streamed only by the receipt endpoint."""
+    return storages['receipts']
+
+
+@lru_cache(maxsize=getattr(settings, 'MEDIA_URL_CACHE_SIZE', 4096))
+def _resolve_url(storage, name):
+    return storage.url(name)
+
+
+def cached_url(field_file):
+    """
+    Public URL of a stored file, resolved once per storage and name.
+    Content-addressed names change whenever the content does, so the
+    name doubles as the version and cached entries never go stale.
+    """
+    if not field_file:
+        return None
+    return _resolve_url(field_file.storage, field_file.name)
@@ -0,0 +1,114 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeFile:
+    """
+    File wrapper limited to one byte range.
+    read() stops at the end of the range when Django streams the file itself.
+    fileno() exposes the descriptor, already positioned at the range start, so
+    servers with a sendfile-based wsgi.file_wrapper (gunicorn) send exactly
+    Content-Length bytes without copying them through Python.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) for a single `bytes=` range, None when the header
+    should be ignored and the full file served, or False when unsatisfiable.
+    """
+    match = RANGE_HEADER.match(header.strip())
+    if not match:
+        # Missing, malformed or multi-range: serve the whole file
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def ranged_file_response(request, path, content_type=None, max_age=None):
+    """
+    Serve a local file with Range, ETag and caching support.
+    Seeking in a video player only transfers the requested bytes.
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    last_modified = int(stat.st_mtime)
+    etag = f'"{last_modified:x}-{size:x}"'
+    if max_age is None:
+        max_age = getattr(settings, 'MEDIA_CACHE_MAX_AGE', 3600)
+
+    def finalize(response):
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, public=True, max_age=max_age)
+        return response
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return finalize(not_modified)
+
+    byte_range = parse_range(request.headers.get('Range', ''), size)
+    if_range = request.headers.get('If-Range')
+    if byte_range and if_range and if_range not in (etag, http_date(last_modified)):
+        # The client's copy is stale, send the whole current file
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return finalize(response)
+
+    content_type = content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    file = open(path, 'rb')
+    if byte_range is None:
+        return finalize(FileResponse(file, content_type=content_type))
+
+    start, end = byte_range
+    length = end - start + 1
+    response = FileResponse(RangeFile(file, start, length), status=206, content_type=content_type)
+    response['Content-Length'] = str(length)
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return finalize(response)
@@ -1,3 +1,271 @@
-from django.test import TestCase
+import hashlib
+import os
+import re
+import shutil
+import tempfile
 
-# Create your tests here.
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.test import RequestFactory, TestCase, override_settings
+
+from utils.cache import CounterDatabaseCache
+from utils.pdf import render_pdf
+from utils.storage import ContentAddressedFileSystemStorage, file_digest
+from utils.streaming import RangeFile, ranged_file_response
+from utils.throttling import CacheLimiter, LocalMemoryLimiter, get_limiter, parse_rate, submission_fingerprint
+from utils.upload_handlers import HashingMemoryFileUploadHandler
+
+
+class ContentAddressedStorageTest(TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = ContentAddressedFileSystemStorage(location=self.location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+
+    def stored_files(self):
+        return [
+            os.path.join(root, name)
+            for root, _, names in os.walk(self.location)
+            for name in names
+        ]
+
+    def test_name_is_derived_from_content_hash(self):
+        digest = hashlib.sha256(b"sketch").hexdigest()
+        name = self.storage.save("custom_requests/sketch.PNG", ContentFile(b"sketch"))
+        self.assertEqual(name, f"custom_requests/{digest[:2]}/{digest}.png")
+
+    def test_repeat_upload_is_stored_once(self):
+        first = self.storage.save("products/images/a.jpg", ContentFile(b"same bytes"))
+        second = self.storage.save("products/images/b.jpg", ContentFile(b"same bytes"))
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_different_content_is_stored_separately(self):
+        first = self.storage.save("products/images/a.jpg", ContentFile(b"one"))
+        second = self.storage.save("products/images/a.jpg", ContentFile(b"two"))
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.stored_files()), 2)
+
+    def test_precomputed_hash_is_reused(self):
+        content = ContentFile(b"data")
+        content.content_hash = "f" * 64
+        self.assertEqual(file_digest(content), "f" * 64)
+
+
+class HashingUploadHandlerTest(TestCase):
+
+    def test_digest_is_attached_to_uploaded_file(self):
+        handler = HashingMemoryFileUploadHandler()
+        handler.handle_raw_input(None, {}, 10, b"boundary")
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file("file", "model.stl", "application/sla", 10)
+        handler.receive_data_chunk(b"hello", 0)
+        handler.receive_data_chunk(b"world", 5)
+        uploaded = handler.file_complete(10)
+
+        self.assertEqual(uploaded.content_hash, hashlib.sha256(b"helloworld").hexdigest())
+
+
+class RangedFileResponseTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        handle, self.path = tempfile.mkstemp(suffix=".mp4")
+        self.content = bytes(range(256)) * 40
+        with os.fdopen(handle, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def get(self, **headers):
+        request = self.factory.get("/media/video/stream/", headers=headers)
+        return ranged_file_response(request, self.path)
+
+    def body(self, response):
+        data = b"".join(response.streaming_content)
+        response.close()
+        return data
+
+    def test_full_file(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response["Content-Type"], "video/mp4")
+        self.assertIn("ETag", response)
+        self.assertIn("max-age", response["Cache-Control"])
+        self.assertEqual(self.body(response), self.content)
+
+    def test_byte_range(self):
+        response = self.get(Range="bytes=100-199")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 100-199/{len(self.content)}")
+        self.assertEqual(response["Content-Length"], "100")
+        self.assertEqual(self.body(response), self.content[100:200])
+
+    def test_open_ended_and_suffix_ranges(self):
+        self.assertEqual(self.body(self.get(Range="bytes=10000-")), self.content[10000:])
+        self.assertEqual(self.body(self.get(Range="bytes=-24")), self.content[-24:])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(Range=f"bytes={len(self.content)}-")
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.content)}")
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.get()["ETag"]
+        response = self.get(If_None_Match=etag)
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_stale_if_range_sends_full_file(self):
+        response = self.get(Range="bytes=0-9", If_Range='"stale"')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+
+    def test_range_file_exposes_descriptor_at_range_start(self):
+        with open(self.path, "rb") as f:
+            ranged = RangeFile(f, 500, 10)
+            self.assertEqual(os.lseek(ranged.fileno(), 0, os.SEEK_CUR), 500)
+            self.assertEqual(ranged.read(), self.content[500:510])
+            self.assertEqual(ranged.read(), b"")
+
+
+class SlidingWindowLimiterTest(TestCase):
+
+    def assert_sliding_window(self, limiter):
+        self.assertIsNone(limiter.hit("ip:1", 2, 60, now=1000))
+        self.assertIsNone(limiter.hit("ip:1", 2, 60, now=1010))
+        self.assertIsNotNone(limiter.hit("ip:1", 2, 60, now=1020))
+        # Other identities have their own window
+        self.assertIsNone(limiter.hit("ip:2", 2, 60, now=1020))
+        # Both earlier hits have slid out of the window
+        self.assertIsNone(limiter.hit("ip:1", 2, 60, now=1200))
+
+    def test_local_memory_limiter(self):
+        self.assert_sliding_window(LocalMemoryLimiter())
+
+    def test_local_memory_limiter_drops_expired_identities(self):
+        limiter = LocalMemoryLimiter()
+        limiter.hit("ip:1", 2, 60, now=1000)
+        limiter.hit("ip:2", 2, 600, now=1000)
+
+        limiter.hit("ip:3", 2, 60, now=1100)
+
+        self.assertEqual(set(limiter.hits), {"ip:2", "ip:3"})
+
+    def test_cache_limiter_reset_keeps_other_cached_data(self):
+        cache.set("wishlist:product_ids:1", frozenset())
+        limiter = CacheLimiter()
+        limiter.hit("ip:1", 2, 60, now=1000)
+
+        limiter.reset()
+
+        self.assertIsNone(limiter.hit("ip:1", 1, 60, now=1000))
+        self.assertEqual(cache.get("wishlist:product_ids:1"), frozenset())
+
+    def test_cache_limiter(self):
+        limiter = CacheLimiter()
+        limiter.reset()
+        self.assert_sliding_window(limiter)
+
+    def test_cache_limiter_weights_previous_window(self):
+        limiter = CacheLimiter()
+        limiter.reset()
+        for _ in range(4):
+            limiter.hit("ip:1", 4, 60, now=150)
+
+        # A quarter into the next window, 3 of the 4 previous hits still count
+        self.assertIsNone(limiter.hit("ip:1", 4, 60, now=195))
+        self.assertIsNotNone(limiter.hit("ip:1", 4, 60, now=196))
+
+    def test_cache_limiter_counts_a_hit_in_two_statements(self):
+        limiter = CacheLimiter()
+        limiter.reset()
+        limiter.hit("ip:1", 5, 60, now=1000)
+
+        # One atomic increment and the previous window's count
+        with self.assertNumQueries(2):
+            limiter.hit("ip:1", 5, 60, now=1010)
+
+    @override_settings(SUBMISSION_LIMITER_BACKEND="utils.throttling.LocalMemoryLimiter")
+    def test_backend_is_configurable(self):
+        self.assertIsInstance(get_limiter(), LocalMemoryLimiter)
+        self.assertIs(get_limiter(), get_limiter())
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate("10/hour"), (10, 3600))
+        self.assertEqual(parse_rate("3/min"), (3, 60))
+
+    def test_fingerprint_ignores_case_and_whitespace(self):
+        self.assertEqual(
+            submission_fingerprint("Great  product", "a@b.com"),
+            submission_fingerprint("great product ", "A@B.com"),
+        )
+        self.assertNotEqual(submission_fingerprint("a", "b"), submission_fingerprint("a b"))
+
+
+class CounterDatabaseCacheTest(TestCase):
+
+    def setUp(self):
+        self.counters = caches["throttle"]
+        self.counters.clear()
+
+    def test_throttle_alias_uses_counter_cache(self):
+        self.assertIsInstance(self.counters, CounterDatabaseCache)
+
+    def test_incr_is_a_single_update(self):
+        self.counters.add("hits", 0, timeout=60)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.counters.incr("hits"), 1)
+        self.assertEqual(self.counters.incr("hits", 4), 5)
+        self.assertEqual(self.counters.get("hits"), 5)
+
+    def test_incr_of_missing_counter_raises(self):
+        with self.assertRaises(ValueError):
+            self.counters.incr("missing")
+
+    def test_add_keeps_a_live_counter(self):
+        self.assertTrue(self.counters.add("hits", 0, timeout=60))
+        self.counters.incr("hits")
+
+        self.assertFalse(self.counters.add("hits", 0, timeout=60))
+        self.assertEqual(self.counters.get("hits"), 1)
+
+    def test_expired_counter_is_gone(self):
+        self.counters.set("hits", 7, timeout=-1)
+
+        self.assertIsNone(self.counters.get("hits"))
+        with self.assertRaises(ValueError):
+            self.counters.incr("hits")
+        self.assertTrue(self.counters.add("hits", 0, timeout=60))
+        self.assertEqual(self.counters.get("hits"), 0)
+
+
+class RenderPdfTest(TestCase):
+
+    def test_cross_reference_table_points_at_every_object(self):
+        pdf = render_pdf([("regular", 10, f"Line (#{i}) \\ café") for i in range(120)])
+
+        xref = int(re.search(rb"startxref\n(\d+)", pdf).group(1))
+        self.assertTrue(pdf[xref:].startswith(b"xref"))
+        offsets = re.findall(rb"(\d{10}) 00000 n", pdf[xref:])
+        for number, offset in enumerate(offsets, start=1):
+            self.assertTrue(pdf[int(offset):].startswith(b"%d 0 obj" % number))
+        self.assertEqual(re.search(rb"/Count (\d+)", pdf).group(1), b"3")
+        self.assertIn(b"(Line \\(#0\\) \\\\ caf\xe9) Tj", pdf)
+
+    def test_output_only_depends_on_the_lines(self):
+        lines = [("bold", 16, "Receipt"), ("regular", 10, ""), ("mono", 9, "Item x 2")]
+        self.assertEqual(render_pdf(lines), render_pdf(lines))
@@ -0,0 +1,164 @@
+import hashlib
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+
+
+def parse_rate(rate):
+    """'10/hour' -> (10, 3600)"""
+    count, period = rate.split('/')
+    return int(count), RATE_PERIODS[period[0]]
+
+
+class LocalMemoryLimiter:
+    """
+    Exact sliding-window log kept in process memory.
+    Only sees the current process: meant for tests and single-worker setups.
+    """
+    # Seconds between sweeps dropping identities whose window has passed
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = defaultdict(deque)
+        self.windows = {}
+        self.last_sweep = None
+
+    def hit(self, key, limit, window, now=None):
+        """Record a hit. Return the seconds to wait when over the limit, otherwise None."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.sweep(now)
+            hits = self.hits[key]
+            self.windows[key] = window
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+            if len(hits) >= limit:
+                return hits[0] + window - now
+            hits.append(now)
+            return None
+
+    def sweep(self, now):
+        if self.last_sweep is not None and now - self.last_sweep < self.SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        expired = [key for key, hits in self.hits.items() if not hits or hits[-1] <= now - self.windows[key]]
+        for key in expired:
+            del self.hits[key]
+            del self.windows[key]
+
+    def reset(self):
+        with self.lock:
+            self.hits.clear()
+            self.windows.clear()
+
+
+class CacheLimiter:
+    """
+    Sliding-window counter in a shared Django cache, so every worker sees the same state.
+    The previous fixed window is weighted by how much of it still overlaps the sliding window.
+    Counters live in their own cache alias ('throttle'), which only this limiter writes to.
+    Its backend must increment atomically (Redis, Memcached or utils.cache.CounterDatabaseCache),
+    otherwise concurrent hits overwrite each other's counts.
+    """
+
+    def __init__(self, alias='throttle'):
+        self.cache = caches[alias]
+
+    def hit(self, key, limit, window, now=None):
+        now = time.time() if now is None else now
+        current = int(now // window)
+        elapsed = now - current * window
+
+        current_key = f"{key}:{current}"
+        try:
+            count = self.cache.incr(current_key)
+        except ValueError:
+            # First hit of the window. add() keeps a counter another worker created meanwhile
+            self.cache.add(current_key, 0, timeout=window * 2)
+            count = self.cache.incr(current_key)
+
+        previous = self.cache.get(f"{key}:{current - 1}", 0)
+        if previous * (window - elapsed) / window + count > limit:
+            return window - elapsed
+        return None
+
+    def reset(self):
+        """Forget every counter, the alias holds nothing else"""
+        self.cache.clear()
+
+
+_limiters = {}
+
+
+def get_limiter():
+    """Limiter configured by SUBMISSION_LIMITER_BACKEND, one instance per process"""
+    path = getattr(settings, 'SUBMISSION_LIMITER_BACKEND', 'utils.throttling.CacheLimiter')
+    if path not in _limiters:
+        _limiters[path] = import_string(path)()
+    return _limiters[path]
+
+
+class SubmissionRateThrottle(BaseThrottle):
+    """
+    Limit submissions per client IP, per user and per submitted email.
+    Every identity present in the request has to stay under SUBMISSION_RATE.
+    """
+    scope = 'submission'
+    rate_setting = 'SUBMISSION_RATE'
+    default_rate = '10/hour'
+    email_field = 'client_email'
+
+    def get_keys(self, request):
+        keys = [f"ip:{self.get_ident(request)}"]
+        if request.user and request.user.is_authenticated:
+            keys.append(f"user:{request.user.pk}")
+        email = request.data.get(self.email_field)
+        if isinstance(email, str) and email.strip():
+            keys.append(f"email:{email.strip().lower()}")
+        return keys
+
+    def allow_request(self, request, view):
+        limit, window = parse_rate(getattr(settings, self.rate_setting, self.default_rate))
+        limiter = get_limiter()
+        self.wait_time = None
+        for key in self.get_keys(request):
+            wait = limiter.hit(f"throttle:{self.scope}:{key}", limit, window)
+            if wait is not None:
+                self.wait_time = wait
+                return False
+        return True
+
+    def wait(self):
+        return self.wait_time
+
+
+class EstimateRateThrottle(SubmissionRateThrottle):
+    """Looser limit for instant quote estimates, which don't store anything"""
+    scope = 'estimate'
+    rate_setting = 'ESTIMATE_RATE'
+    default_rate = '60/hour'
+
+
+def submission_fingerprint(*parts):
+    """Content hash of a submission, whitespace and case insensitive"""
+    normalized = '\x1f'.join(' '.join(str(part).split()).lower() for part in parts)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def is_duplicate_submission(model, fingerprint):
+    """True when the same content was submitted within DUPLICATE_SUBMISSION_WINDOW_MINUTES"""
+    window = timedelta(minutes=getattr(settings, 'DUPLICATE_SUBMISSION_WINDOW_MINUTES', 60))
+    return model.objects.filter(
+        content_hash=fingerprint,
+        created_at__gte=timezone.now() - window,
+    ).exists()